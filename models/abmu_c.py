@@ -8,7 +8,7 @@ import json
 import matplotlib
 matplotlib.use("Agg", warn=False)
 import matplotlib.pyplot as plt
-from npsgd.standalone_task import StandaloneTask 
+from npsgd.standalone_task import StandaloneTask, splitRange
 from npsgd.model_parameters import *
 
 class ABMU(StandaloneTask): 
@@ -60,6 +60,10 @@ class ABMU(StandaloneTask):
     attachments   = ['spectral_distribution.csv', 'reflectance.png', 'transmittance.png', 'absorptance.png']
 
     def executableParameters(self):
+        return self.wavelengthParameters(self.wavelengths.value[0], self.wavelengths.value[1],
+                "spectral_distribution.csv")
+
+    def wavelengthParameters(self, wavelengthStart, wavelengthEnd, outputFile):
         if self.surfaceOfIncidence.value == "Abaxial":
             angleIn = 180 - self.angleOfIncidence.value
         else:
@@ -70,19 +74,35 @@ class ABMU(StandaloneTask):
             "-n", str(self.nSamples.value),
             "-p", str(angleIn),
             "-s", str(5), #step
-            "-w", str(self.wavelengths.value[0]),
-            "-e", str(self.wavelengths.value[1]),
+            "-w", str(wavelengthStart),
+            "-e", str(wavelengthEnd),
         ]
 
         if not self.sieveDetourEffects.value:
             params.append("-q")
 
         params += ["sample.json",
-                   "spectral_distribution.csv"
+                   outputFile
         ]
         
         return params
 
+    def executableShards(self, count):
+        """Shards the run into disjoint wavelength sub-ranges, one output file each."""
+        start, end = self.wavelengths.value
+        return [self.wavelengthParameters(s, e, "spectral_distribution.%d.csv" % i)
+                for (i, (s, e)) in enumerate(splitRange(start, end, 5, count))]
+
+    def mergeShards(self, count):
+        """Concatenates the per-shard spectral distributions (in wavelength order)."""
+        with open(os.path.join(self.workingDirectory, "spectral_distribution.csv"), 'w') as out:
+            for i in xrange(count):
+                with open(os.path.join(self.workingDirectory, "spectral_distribution.%d.csv" % i)) as f:
+                    header = f.readline()
+                    if i == 0:
+                        out.write(header)
+                    out.writelines(line for line in f if line.strip() != "")
+
     def readDataTable(self):
         wavelengths, reflectance, transmittance, absorptance = ([], [], [], [])
         with open(os.path.join(self.workingDirectory, "spectral_distribution.csv"), 'r') as f:
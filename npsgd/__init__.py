@@ -1,7 +1,7 @@
 """Package containing helper modules for all NPSGD daemons."""
 
 __all__ = [
-    "config", "confirmation_map", "email_manager", 
-    "matlab_task", "model_manager", "model_task",
-    "standalone_task", "task_queue", "text_helpers", "ui_modules"
+    "artifact_store", "config", "confirmation_map", "email_manager", 
+    "matlab_task", "model_manager", "model_manifest", "model_task",
+    "queue_client", "queue_store", "result_cache", "standalone_task", "task_queue", "task_record", "text_helpers", "ui_modules", "wire"
 ]
@@ -0,0 +1,95 @@
+# For distribution details, see LICENSE
+"""Content-addressed store of result files, for delivering results by download link.
+
+Workers copy the result files of a run into the store and e-mail links to
+them instead of attaching them. The web daemon serves the links straight
+from the store (see npsgd_web.ArtifactDownload), so the store directory has
+to be shared between the workers and the web daemon.
+"""
+import os
+import time
+import uuid
+import urllib
+import hashlib
+import logging
+from config import config
+
+class ArtifactStore(object):
+    """Files on local disk keyed by the SHA-256 of their contents.
+
+    Identical files are stored once. Each file lives for ttl seconds from the
+    last time it was stored; its modification time is the clock.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl       = ttl
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def putFile(self, sourcePath):
+        """Copies a file into the store (streaming it), returning its key."""
+        tmpPath = os.path.join(self.directory, ".tmp-%s" % uuid.uuid4())
+        digest = hashlib.sha256()
+        with open(sourcePath, 'rb') as source:
+            with open(tmpPath, 'wb') as target:
+                for chunk in iter(lambda: source.read(64 * 1024), ""):
+                    digest.update(chunk)
+                    target.write(chunk)
+
+        key = digest.hexdigest()
+        path = self.path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        if os.path.exists(path):
+            os.remove(tmpPath)
+            os.utime(path, None)
+        else:
+            os.rename(tmpPath, path)
+
+        return key
+
+    def expiryTime(self, key):
+        """Returns the time the file for key expires, or None if it is not (or no longer) stored."""
+        try:
+            expiry = os.path.getmtime(self.path(key)) + self.ttl
+        except OSError:
+            return None
+
+        if expiry <= time.time():
+            return None
+
+        return expiry
+
+    def link(self, key, name):
+        """Returns the public download URL of a stored file, under a given file name."""
+        return "%s/results/%s/%s" % (config.advertisedRoot.rstrip("/"), key, urllib.quote(name))
+
+    def expire(self):
+        """Removes files that have outlived the ttl (and leftovers of interrupted copies)."""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for root, dirs, files in os.walk(self.directory):
+            for fileName in files:
+                path = os.path.join(root, fileName)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+
+        if removed > 0:
+            logging.info("Expired %d files from the artifact store", removed)
+
+artifactStore = None
+def getArtifactStore():
+    global artifactStore
+    if artifactStore == None:
+        artifactStore = ArtifactStore(config.artifactDirectory, config.artifactTTL * 3600)
+
+    return artifactStore
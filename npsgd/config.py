@@ -12,6 +12,7 @@ import os
 import sys
 import logging
 import ConfigParser
+import multiprocessing
 import tornado.template
 import datetime
 
@@ -65,10 +66,29 @@ class Config(object):
         self.confirmTemplatePath      = config.get('npsgd', 'confirmTemplatePath')
         self.confirmedTemplatePath    = config.get('npsgd', 'confirmedTemplatePath')
         self.confirmTimeout           = datetime.timedelta(minutes=config.getint('npsgd', 'confirmTimeout'))
+        self.confirmedCodeTimeout     = datetime.timedelta(minutes=self.getDefault(config, "npsgd", "confirmedCodeTimeout", 10080, "getint"))
+        self.confirmSweepInterval     = self.getDefault(config, "npsgd", "confirmSweepInterval", 60, "getint")
         self.maxJobFailures           = config.getint("npsgd", "maxJobFailures")
         self.keepAliveInterval        = config.getint("npsgd", "keepAliveInterval")
         self.keepAliveTimeout         = config.getint("npsgd", "keepAliveTimeout")
+        self.longPollTimeout          = self.getDefault(config, "npsgd", "longPollTimeout", 60, "getint")
+        self.queueRequestTimeout      = self.getDefault(config, "npsgd", "queueRequestTimeout", 30, "getint")
+        self.queueRequestRetries      = self.getDefault(config, "npsgd", "queueRequestRetries", 3, "getint")
+        self.queueWireFormat          = self.getDefault(config, "npsgd", "queueWireFormat", "json")
+        self.workerSlots              = self.getDefault(config, "npsgd", "workerSlots", 0, "getint")
+        if self.workerSlots <= 0:
+            self.workerSlots = multiprocessing.cpu_count()
+        self.modelRunTimeout          = self.getDefault(config, "npsgd", "modelRunTimeout", 86400, "getint")
+        self.modelShards              = self.getDefault(config, "npsgd", "modelShards", 0, "getint")
+        self.resultCacheDirectory     = self.getDefault(config, "npsgd", "resultCacheDirectory", "")
+        self.resultCacheSize          = self.getDefault(config, "npsgd", "resultCacheSize", 1024, "getint")
+        self.emailOutboxDirectory     = self.getDefault(config, "npsgd", "emailOutboxDirectory", "")
+        self.modelManifestDirectory   = self.getDefault(config, "npsgd", "modelManifestDirectory", "")
+        self.resultsDelivery          = self.getDefault(config, "npsgd", "resultsDelivery", "attach")
+        self.artifactDirectory        = self.getDefault(config, "npsgd", "artifactDirectory", "")
+        self.artifactTTL              = self.getDefault(config, "npsgd", "artifactTTL", 168, "getint")
         self.modelScanInterval        = config.getint("npsgd", "modelScanInterval")
+        self.modelVersionGrace        = self.getDefault(config, "npsgd", "modelVersionGrace", 3600, "getint")
         self.queueServerAddress       = config.get("npsgd", "queueServerAddress")
         self.queueServerPort          = config.getint("npsgd", "queueServerPort")
         self.modelDirectory           = config.get("npsgd", "modelDirectory")
@@ -79,6 +99,22 @@ class Config(object):
         self.listModelsTemplatePath   = config.get("npsgd", 'listModelsTemplatePath')
         self.advertisedRoot           = config.get("npsgd", "advertisedRoot")
         self.alreadyConfirmedTemplatePath    = config.get('npsgd', 'alreadyConfirmedTemplatePath')
+        self.queueStore               = self.getDefault(config, "npsgd", "queueStore", "shelve")
+        self.queueSnapshotInterval    = self.getDefault(config, "npsgd", "queueSnapshotInterval", 1000, "getint")
+        self.queueFlushInterval       = self.getDefault(config, "npsgd", "queueFlushInterval", 20, "getint") / 1000.0
+        self.queueFlushBatchSize      = self.getDefault(config, "npsgd", "queueFlushBatchSize", 100, "getint")
+
+        if self.queueStore not in ["shelve", "journal", "sqlite"]:
+            raise ConfigError("Unknown queue store '%s'" % self.queueStore)
+
+        if self.queueWireFormat not in ["auto", "msgpack", "json", "form"]:
+            raise ConfigError("Unknown queue wire format '%s'" % self.queueWireFormat)
+
+        if self.resultsDelivery not in ["attach", "link"]:
+            raise ConfigError("Unknown results delivery '%s'" % self.resultsDelivery)
+
+        if self.resultsDelivery == "link" and self.artifactDirectory == "":
+            raise ConfigError("Delivering results by link needs an artifactDirectory")
 
         if not os.path.exists(self.htmlTemplateDirectory):
             raise ConfigError("HTML template directory '%s' does not exist" % self.htmlTemplateDirectory)
@@ -110,6 +146,13 @@ class Config(object):
         self.loadEmail(config)
         self.checkIntegrity()
 
+    def getDefault(self, config, section, option, default, getter="get"):
+        """Reads an optional config value, falling back to a default when it is absent."""
+        if not config.has_option(section, option):
+            return default
+
+        return getattr(config, getter)(section, option)
+
     def loadEmail(self, config):
         self.smtpUsername = config.get("email", "smtpUsername")
         self.smtpPassword = config.get("email", "smtpPassword")
@@ -119,6 +162,12 @@ class Config(object):
         self.smtpUseAuth  = config.getboolean("email", "smtpUseAuth")
         self.fromAddress  = config.get("email", "fromAddress")
         self.maxAttempts  = config.getint("email", "maxAttempts")
+        self.smtpSenderThreads = self.getDefault(config, "email", "smtpSenderThreads", 4, "getint")
+        self.smtpPoolSize = self.getDefault(config, "email", "smtpPoolSize", self.smtpSenderThreads, "getint")
+        self.smtpMaxIdle  = self.getDefault(config, "email", "smtpMaxIdle", 60, "getint")
+        self.smtpTimeout  = self.getDefault(config, "email", "smtpTimeout", 30, "getint")
+        self.emailRetryDelay    = self.getDefault(config, "email", "retryDelay", 30, "getint")
+        self.emailMaxRetryDelay = self.getDefault(config, "email", "maxRetryDelay", 3600, "getint")
         self.bcc          = [e.strip() for e in config.get("email", "bcc").split(",") if e.strip() != ""]
         self.cc           = [e.strip() for e in config.get("email", "cc").split(",") if e.strip() != ""]
 
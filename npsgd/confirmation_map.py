@@ -2,36 +2,105 @@
 # Date:   January 2011
 # For distribution details, see LICENSE
 """Module used within the queue daemon for keeping track of confirmation codes."""
+import time
 import random
 import string
 import logging
 import threading
-from datetime import datetime
+from collections import OrderedDict, deque
 from config import config
 
 class ConfirmationEntry(object):
     def __init__(self, request):
-        self.timestamp  = datetime.now()
-        self.expiryTime = datetime.now() + config.confirmTimeout
+        self.timestamp  = time.time()
+        self.expiryTime = self.timestamp + config.confirmTimeout.total_seconds()
         self.request    = request
 
-    def expired(self):
-        return datetime.now() >= self.expiryTime
+    def expired(self, now=None):
+        if now == None:
+            now = time.time()
+        return now >= self.expiryTime
+
+class RecentCodeSet(object):
+    """Set of codes that forgets each code some time after it was added (thread safe).
+
+    Codes are kept in a ring of time buckets, each covering ttl / numBuckets
+    seconds. Whole buckets are dropped once their newest possible code is
+    older than the ttl, so memory is bounded by the number of codes added
+    within ttl + bucketWidth and a code is remembered for between ttl and
+    ttl + bucketWidth seconds.
+    """
+
+    def __init__(self, ttl, numBuckets=24):
+        self.ttl         = ttl
+        self.bucketWidth = float(ttl) / numBuckets
+        self.buckets     = deque()
+        self.lock        = threading.RLock()
+
+    def bucketStart(self, when):
+        return when - when % self.bucketWidth
+
+    def prune(self, now=None):
+        """Drops buckets that have fallen out of the ttl."""
+        if now == None:
+            now = time.time()
+
+        with self.lock:
+            while len(self.buckets) > 0 and self.buckets[0][0] + self.bucketWidth <= now - self.ttl:
+                self.buckets.popleft()
+
+    def add(self, code, when=None):
+        if when == None:
+            when = time.time()
+
+        start = self.bucketStart(when)
+        with self.lock:
+            self.prune()
+            if len(self.buckets) == 0 or self.buckets[-1][0] < start:
+                self.buckets.append((start, set()))
+
+            for bucketStart, codes in reversed(self.buckets):
+                if bucketStart <= start:
+                    codes.add(code)
+                    break
+
+    def __contains__(self, code):
+        with self.lock:
+            self.prune()
+            return any(code in codes for (bucketStart, codes) in self.buckets)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(codes) for (bucketStart, codes) in self.buckets)
+
+    def entries(self):
+        """Returns a dictionary of code -> (bucketed) time added, for serialization."""
+        with self.lock:
+            return dict((code, bucketStart) for (bucketStart, codes) in self.buckets for code in codes)
+
+    def load(self, entries):
+        """Adds codes from a dictionary of code -> time added, as returned by entries."""
+        for code, when in sorted(entries.iteritems(), key=lambda e: e[1]):
+            self.add(code, when)
 
 class ExistingCodeError(RuntimeError): pass
 class ConfirmationMap(object):
     """Confirmation code map (thread safe). 
 
     Essentially this is a wrapped hash from code string -> request with some
-    helper methods to expire old confirmation entries.
+    helper methods to expire old confirmation entries. Every entry lives for
+    the same confirmTimeout, so insertion order is also expiry order and the
+    map can be swept from the front without looking at live entries.
     """
     def __init__(self):
-        self.codeToRequest = {}
+        self.codeToRequest = OrderedDict()
         self.codeLength    = 16
         self.lock          = threading.RLock()
 
     def getRequestsWithCodes(self):
-        return [(code,c.request) for code,c in self.codeToRequest.iteritems()]
+        """Returns a list of (code, request) pairs, oldest first."""
+        with self.lock:
+            return [(code,c.request) for code,c in self.codeToRequest.iteritems()]
 
     def putRequestWithCode(self, request, code):
         with self.lock:
@@ -48,23 +117,51 @@ class ConfirmationMap(object):
         return code
 
     def getRequest(self, code):
+        """Pops the request for a code. Expired codes are left for the sweep to record."""
         with self.lock:
-            if code in self.codeToRequest:
+            if code in self.codeToRequest and not self.codeToRequest[code].expired():
                 request = self.codeToRequest[code].request
                 del self.codeToRequest[code]
                 return request
             else:
                 raise KeyError("Code does not exist")
 
-    def expireConfirmations(self):
-        """Expire old confirmations - meant to be called at a regular rate."""
+    def modelVersions(self):
+        """Returns the set of (model name, version) pairs of the requests awaiting confirmation."""
+        with self.lock:
+            return set((e.request.modelName, e.request.modelVersion) for e in self.codeToRequest.itervalues())
+
+    def pullRequestsMatching(self, predicate):
+        """Removes and returns the (code, request) pairs whose request satisfies predicate."""
+        with self.lock:
+            pulled = [(code, e.request) for (code, e) in self.codeToRequest.iteritems() if predicate(e.request)]
+            for code, request in pulled:
+                del self.codeToRequest[code]
+
+            return pulled
+
+    def expireConfirmations(self, maxCount=None):
+        """Expire old confirmations - meant to be called at a regular rate.
+
+        Only the expired entries at the front of the map are touched, at most
+        maxCount of them if given. Returns the list of codes that were expired.
+        """
 
+        now = time.time()
+        delKeys = []
         with self.lock:
-            delKeys = [k for (k,v) in self.codeToRequest.iteritems() if v.expired()]
-            if len(delKeys) > 0:
-                logging.info("Expiring %d confirmations" % (len(delKeys)))
-                for k in delKeys:
-                    del self.codeToRequest[k]
+            for code, entry in self.codeToRequest.iteritems():
+                if not entry.expired(now) or len(delKeys) == maxCount:
+                    break
+                delKeys.append(code)
+
+            for code in delKeys:
+                del self.codeToRequest[code]
+
+        if len(delKeys) > 0:
+            logging.info("Expiring %d confirmations" % (len(delKeys)))
+
+        return delKeys
 
     def generateCode(self):
         return "".join(random.choice(string.letters + string.digits)\
@@ -11,7 +11,16 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.Utils import formatdate
 from email import Encoders
-from threading import Thread
+from threading import Thread, Lock, RLock
+import os
+import time
+import uuid
+import fcntl
+import heapq
+import pickle
+import random
+import select
+import itertools
 import mimetypes
 import logging
 import socket
@@ -20,36 +29,64 @@ from config import config
 class EmailSendError(RuntimeError): pass
 
 def blockingEmailSend(email):
-    """Attempt to send an e-mail synchronously, reporting an error if we fail."""
+    """Attempt to send an e-mail synchronously, reporting an error if we fail.
+
+    The e-mail goes out over a pooled SMTP session, which the pool has just
+    checked is alive. A send that fails part way is never repeated here: the
+    server may already have accepted the message.
+    """
     try:
-        s = smtpServer()
+        s = smtpPool.acquire()
     except socket.gaierror, e:
         raise EmailSendError("Unable to connect to smtp server")
-    
 
     try:
         logging.info("Connected to SMTP server, sending email")
         email.sendThrough(s)
-    finally:
-        s.close()
+    except:
+        smtpPool.discard(s)
+        raise
+
+    smtpPool.release(s)
+
+outbox = None
+outboxLock = RLock()
+def setupOutbox(name):
+    """Sets up the background e-mail outbox of a daemon, resuming e-mails left by an earlier run.
+
+    Pending e-mails are kept in a directory of the configured outbox directory
+    named after the daemon. If that directory is in use by another running
+    process (e.g. a second worker on the same machine), name-1, name-2, ...
+    are tried instead.
+    """
+    global outbox
+    with outboxLock:
+        directory = None
+        if name != None and config.emailOutboxDirectory != "":
+            for i in itertools.count():
+                directory = os.path.join(config.emailOutboxDirectory, name if i == 0 else "%s-%d" % (name, i))
+                if Outbox.lockDirectory(directory):
+                    break
+
+        outbox = Outbox(directory)
+        outbox.start(config.smtpSenderThreads)
 
-email_manager_thread = None
 def backgroundEmailSend(email):
-    """Attempt to send an e-mail asynchronously, spawning a background thread if necesarry.
+    """Attempt to send an e-mail asynchronously, spawning background threads if necesarry.
 
-    This method sends an e-mail in the background using an e-mail thread. Note that
-    this has a side effect of actually spawning an e-mail thread if none exists already.
+    This method sends an e-mail in the background through the outbox. Note that
+    this has a side effect of setting up an (in memory) outbox and its e-mail
+    threads if the daemon has not set one up already.
     """
 
-    global email_manager_thread
-    if email_manager_thread == None:
-        email_manager_thread = EmailManagerThread()
-        email_manager_thread.start()
+    with outboxLock:
+        if outbox == None:
+            setupOutbox(None)
 
-    email_manager_thread.addEmail(email)
+    outbox.put(email)
 
 def smtpServer():
-    smtpserver = smtplib.SMTP(config.smtpServer, config.smtpPort)
+    smtpserver = smtplib.SMTP(config.smtpServer, config.smtpPort, timeout=config.smtpTimeout)
     smtpserver.ehlo()
     if config.smtpUseTLS:
         smtpserver.starttls()
@@ -59,31 +96,234 @@ def smtpServer():
 
     return smtpserver
 
-class EmailManagerThread(Thread):
-    """Thread for sending e-mail in the background (using a queue of e-mails)."""
+class SMTPPool(object):
+    """Pool of connected (and authenticated) SMTP sessions (thread safe).
+
+    Sessions are handed out most recently used first. A session that sat idle
+    for longer than smtpMaxIdle is closed rather than reused, since servers
+    drop idle clients, and every other session is checked with an RSET before
+    it is handed out, so a dropped session is found before any mail is sent.
+    """
 
     def __init__(self):
+        self.idle = []
+        self.lock = Lock()
+
+    def acquire(self):
+        """Returns a healthy session, from the pool if it has one."""
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                s, lastUsed = self.idle.pop()
+
+            if time.time() - lastUsed > config.smtpMaxIdle:
+                self.discard(s)
+                continue
+
+            try:
+                if s.rset()[0] != 250:
+                    raise smtplib.SMTPException("RSET refused")
+            except (smtplib.SMTPException, socket.error):
+                self.discard(s)
+                continue
+
+            return s
+
+        return smtpServer()
+
+    def release(self, s):
+        with self.lock:
+            if len(self.idle) < config.smtpPoolSize:
+                self.idle.append((s, time.time()))
+                return
+
+        self.discard(s)
+
+    def discard(self, s):
+        try:
+            s.quit()
+        except (smtplib.SMTPException, socket.error):
+            s.close()
+
+smtpPool = SMTPPool()
+
+class Outbox(object):
+    """Delay-ordered outbox of e-mails waiting to be sent in the background (thread safe).
+
+    E-mails that are due go on a ready queue served by the e-mail threads.
+    A failed e-mail is rescheduled with exponential backoff (emailRetryDelay
+    doubling up to emailMaxRetryDelay, with random jitter) on a heap ordered
+    by next attempt time. A scheduler thread sleeps in select until the
+    earliest of those is due, or until it is woken by a pipe when an earlier
+    one arrives, so waiting e-mails cost no CPU.
+
+    If a directory is given, every pending e-mail is also pickled to a file
+    there until it is sent or given up on, so that it survives a restart.
+    New e-mails are written (and synced) by a spooler thread before they are
+    put on the ready queue, so the thread putting an e-mail in (usually the
+    IOLoop) never waits on the disk, and no e-mail is attempted before it is
+    stored.
+    """
+    lockFiles = []
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.ready     = Queue.Queue()
+        self.incoming  = Queue.Queue()
+        self.delayed   = []
+        self.sequence  = itertools.count()
+        self.lock      = Lock()
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+
+    @staticmethod
+    def lockDirectory(directory):
+        """Creates and locks an outbox directory for this process, returning False if it is taken."""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        lockFile = open(os.path.join(directory, "outbox.lock"), "w")
+        try:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockFile.close()
+            return False
+
+        Outbox.lockFiles.append(lockFile)
+        return True
+
+    def start(self, numThreads):
+        """Resumes e-mails stored on disk and starts the scheduler and e-mail threads."""
+        if self.directory != None:
+            for fileName in os.listdir(self.directory):
+                if not fileName.endswith(".email"):
+                    continue
+
+                path = os.path.join(self.directory, fileName)
+                try:
+                    with open(path, "rb") as f:
+                        email, nextAttempt = pickle.load(f)
+                except Exception:
+                    logging.exception("Unable to read outbox e-mail '%s', removing it", path)
+                    os.remove(path)
+                    continue
+
+                email.outboxPath = path
+                self.schedule(email, nextAttempt)
+
+            logging.info("Resumed %d e-mails from the outbox", len(self.delayed))
+
+        scheduler = Thread(target=self.runScheduler)
+        scheduler.daemon = True
+        scheduler.start()
+        if self.directory != None:
+            spooler = Thread(target=self.runSpooler)
+            spooler.daemon = True
+            spooler.start()
+        for i in xrange(numThreads):
+            EmailManagerThread(self).start()
+
+    def save(self, email, nextAttempt):
+        if self.directory == None:
+            return
+
+        if email.outboxPath == None:
+            email.outboxPath = os.path.join(self.directory, "%s.email" % uuid.uuid4())
+
+        tmpPath = "%s.tmp" % email.outboxPath
+        try:
+            with open(tmpPath, "wb") as f:
+                pickle.dump((email, nextAttempt), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpPath, email.outboxPath)
+        except (IOError, OSError), e:
+            logging.warning("Unable to store e-mail to '%s' in the outbox: %s", email.recipient, e)
+
+    def remove(self, email):
+        if email.outboxPath != None:
+            try:
+                os.remove(email.outboxPath)
+            except OSError:
+                pass
+
+    def put(self, email):
+        """Adds an e-mail to the outbox to be sent right away (once it is stored, see runSpooler)."""
+        if self.directory == None:
+            self.ready.put(email)
+        else:
+            self.incoming.put(email)
+
+    def schedule(self, email, nextAttempt):
+        with self.lock:
+            heapq.heappush(self.delayed, (nextAttempt, self.sequence.next(), email))
+        os.write(self.wakeupWrite, "x")
+
+    def next(self):
+        """Blocks until an e-mail is due, then returns it."""
+        return self.ready.get(True)
+
+    def sent(self, email):
+        self.remove(email)
+
+    def failed(self, email):
+        """Reschedules an e-mail after a failed attempt, or drops it once it is out of attempts."""
+        if email.attempts > config.maxAttempts:
+            logging.warning("Timing out email to '%s' after %s attempts", email.recipient, email.attempts)
+            self.remove(email)
+            return
+
+        delay = min(config.emailMaxRetryDelay, config.emailRetryDelay * 2 ** (email.attempts - 1))
+        delay *= random.uniform(0.5, 1.5)
+        logging.info("Retrying email to '%s' in %.0f seconds", email.recipient, delay)
+        self.save(email, time.time() + delay)
+        self.schedule(email, time.time() + delay)
+
+    def runSpooler(self):
+        """Stores new e-mails on disk, then makes them ready to be sent."""
+        while True:
+            email = self.incoming.get(True)
+            self.save(email, time.time())
+            self.ready.put(email)
+
+    def runScheduler(self):
+        """Moves delayed e-mails to the ready queue as they become due."""
+        while True:
+            now = time.time()
+            with self.lock:
+                while len(self.delayed) > 0 and self.delayed[0][0] <= now:
+                    nextAttempt, seq, email = heapq.heappop(self.delayed)
+                    self.ready.put(email)
+
+                timeout = None
+                if len(self.delayed) > 0:
+                    timeout = self.delayed[0][0] - now
+
+            readable, writable, errors = select.select([self.wakeupRead], [], [], timeout)
+            if len(readable) > 0:
+                os.read(self.wakeupRead, 4096)
+
+class EmailManagerThread(Thread):
+    """Thread for sending e-mail in the background (from an outbox shared between threads)."""
+
+    def __init__(self, outbox):
         Thread.__init__(self)
         self.daemon = True
-        self.queue = Queue.Queue()
-
-    def addEmail(self, email):
-        self.queue.put(email)
+        self.outbox = outbox
 
     def run(self):
-        """Blocks on the queue until it has an e-mail in it, then send it."""
+        """Blocks on the outbox until it has an e-mail due, then send it."""
         while True:
+            email = self.outbox.next()
             try:
-                email = self.queue.get(True)
                 email.attempts += 1
-                logging.info("Email Manager: Found email in the queue, attempting to send")
+                logging.info("Email Manager: Found email in the outbox, attempting to send")
                 blockingEmailSend(email)
             except Exception:
                 logging.exception("Unhandled exception in email thread!")
-                if email.attempts > config.maxAttempts:
-                  logging.warning("Timing out email to '%s' after %s attempts", email.recipient, email.attempts)
-                else:
-                  self.queue.put(email)
+                self.outbox.failed(email)
+            else:
+                self.outbox.sent(email)
 
 class Email(object):
     """Actual e-mail object containing all information needed to send an e-mail.
@@ -97,7 +337,9 @@ class Email(object):
         self.body              = body
         self.binaryAttachments = binaryAttachments
         self.textAttachments   = textAttachments
+        self.links             = []
         self.attempts          = 0
+        self.outboxPath        = None
 
     def sendThrough(self, smtpServer):
         """Sends this e-mail through a given smtp server (blocking)."""
@@ -5,6 +5,7 @@
 import os
 import sys
 import imp
+import time
 import glob
 import hashlib
 import inspect
@@ -12,6 +13,8 @@ import logging
 import threading
 from npsgd.config import config
 from model_task import ModelTask
+import model_manifest
+import model_parameters
 
 class InvalidModelError(RuntimeError): pass
 class ModelManager(object):
@@ -19,12 +22,17 @@ class ModelManager(object):
     
     This essentially takes the form of hash from (modelName, modelVersion) to 
     the actual model classes (from modules). This class is thread safe.
+
+    Old versions are unloaded by collectVersions once they have been superseded
+    by a newer version for longer than a grace period and nothing refers to them
+    any more.
     """
 
     def __init__(self):
         self.modelLock = threading.RLock()
         self.models = {}
         self.latestVersions = {}
+        self.supersededTimes = {}
 
     def modelNames(self):
         with self.modelLock:
@@ -71,15 +79,50 @@ class ModelManager(object):
         if not hasattr(cls, 'parameters'):
             raise InvalidModelError("Model '%s' has no parameters" % cls.__name__)
 
-        if self.hasModel(cls.short_name, version):
-            return
-
-        cls.version = version
         with self.modelLock:
+            if self.hasModel(cls.short_name, version):
+                #A file reverted to an older version that is still loaded
+                self.setLatest(self.models[(cls.short_name, version)])
+                return
+
+            cls.version = version
             self.models[(cls.short_name, version)] = cls
-            self.latestVersions[cls.short_name] = cls
+            self.setLatest(cls)
             logging.info("Found and loaded model '%s', version '%s'", cls.short_name, cls.version)
 
+    def setLatest(self, cls):
+        """Makes cls the latest version of its model, marking the previous latest as superseded."""
+        with self.modelLock:
+            previous = self.latestVersions.get(cls.short_name)
+            if previous is cls:
+                return
+
+            if previous != None:
+                self.supersededTimes[(previous.short_name, previous.version)] = time.time()
+
+            self.supersededTimes.pop((cls.short_name, cls.version), None)
+            self.latestVersions[cls.short_name] = cls
+
+    def collectVersions(self, referencedVersions, grace):
+        """Unloads versions superseded for more than grace seconds that are not in referencedVersions.
+
+        Returns the (name, version) pairs that were unloaded.
+        """
+        referenced = set(tuple(v) for v in referencedVersions)
+        cutoff = time.time() - grace
+        with self.modelLock:
+            collected = [k for (k, t) in self.supersededTimes.iteritems() if t <= cutoff and k not in referenced]
+            for key in collected:
+                del self.supersededTimes[key]
+                del self.models[key]
+                logging.info("Unloaded model '%s', version '%s'", key[0], key[1])
+
+            if len(collected) > 0:
+                model_parameters.ParameterValue.retainValueClasses(
+                        set(p.__class__ for cls in self.models.itervalues() for p in cls.parameters))
+
+            return collected
+
     def getModelVersion(self, cls):
         sourceCode = inspect.getsource(inspect.getmodule(cls))
         m = hashlib.md5()
@@ -94,34 +137,102 @@ def loadMembers(mod, version):
         if inspect.isclass(obj) and obj.__module__ == mod.__name__ and issubclass(obj, ModelTask):
             modelManager.addModel(obj, version)
 
+#Hash from model file path to ((mtime, size, inode), version) as of the last scan
+scannedFiles = {}
+scanLock = threading.Lock()
+
+#Whether models are loaded from manifests rather than imported (see useManifests)
+manifestsOnly = False
+
+#Function returning the model versions that must not be unloaded (see setVersionReferences)
+versionReferences = None
+
+def useManifests():
+    """Load models from their manifests (see npsgd.model_manifest) instead of importing them.
+
+    For daemons that never run models. Must be called before setupModels.
+    """
+    global manifestsOnly
+    manifestsOnly = True
+
+def fileSignature(pyfile):
+    st = os.stat(pyfile)
+    return (st.st_mtime, st.st_size, st.st_ino)
+
 def setupModels():
     """Attempts to do the initial load of all models. Must be called on script startup.
     
     This method scans the the model directory and finds all python scripts available.
     It computes a hash of the scripts (i.e. a 'version') then attempts to load all
     NPSGD models held within, using the version previously configured.
+
+    Scans are incremental: a file is only re-hashed when its stat signature
+    (modification time, size, inode) changed since the last scan, and only
+    re-imported when its hash changed too.
     """
     if config.modelDirectory not in sys.path:
         sys.path.append(config.modelDirectory)
-    t = 0
+
+    with scanLock:
+        try:
+            sys.dont_write_bytecode = True
+            pyfiles = glob.glob("%s/*.py" % config.modelDirectory)
+            for pyfile in set(scannedFiles) - set(pyfiles):
+                del scannedFiles[pyfile]
+
+            for pyfile in pyfiles:
+                scanFile(pyfile)
+        finally:
+            sys.dont_write_bytecode = False
+
+def setVersionReferences(references):
+    """Sets a function returning the (name, version) pairs still in use, e.g. by queued tasks.
+
+    Superseded versions outside that list are unloaded after the grace period.
+    The function is called from the scanner thread, and may raise to skip a collection.
+    """
+    global versionReferences
+    versionReferences = references
+
+def collectVersions():
+    """Unloads old model versions that are no longer in use."""
+    referenced = []
+    if versionReferences != None:
+        try:
+            referenced = versionReferences()
+        except Exception:
+            logging.exception("Unable to find model versions in use, not unloading any")
+            return
+
+    modelManager.collectVersions(referenced, config.modelVersionGrace)
+
+def scanFile(pyfile):
+    """Loads the models in a given file if it changed since it was last scanned."""
+    importName = os.path.basename(pyfile).rsplit(".", 1)[0]
     try:
-        sys.dont_write_bytecode = True
-        for pyfile in glob.glob("%s/*.py" % config.modelDirectory):
-            importName = os.path.basename(pyfile).rsplit(".", 1)[0]
-            t += 1
-            try:
-                m = hashlib.md5()
-                with open(pyfile) as f:
-                    m.update(f.read())
-
-                version = m.hexdigest()
-                module = imp.load_source(importName, pyfile)
-                loadMembers(module, version)
-            except Exception:
-                logging.exception("Unable to load model from '%s'" % importName)
-                continue
-    finally:
-        sys.dont_write_bytecode = False
+        signature = fileSignature(pyfile)
+        if pyfile in scannedFiles and scannedFiles[pyfile][0] == signature:
+            return
+
+        m = hashlib.md5()
+        with open(pyfile) as f:
+            m.update(f.read())
+
+        version = m.hexdigest()
+        if pyfile in scannedFiles and scannedFiles[pyfile][1] == version:
+            scannedFiles[pyfile] = (signature, version)
+            return
+
+        #Remember broken files too, so they are not retried until they change
+        scannedFiles[pyfile] = (signature, version)
+        if manifestsOnly:
+            for manifest in model_manifest.loadManifest(pyfile, version):
+                modelManager.addModel(model_manifest.modelFromManifest(manifest), version)
+        else:
+            module = imp.load_source(importName, pyfile)
+            loadMembers(module, version)
+    except Exception:
+        logging.exception("Unable to load model from '%s'" % importName)
 
 class ModelScannerThread(threading.Thread):
     """Thread for periodically loading new versions of models."""
@@ -137,6 +248,7 @@ class ModelScannerThread(threading.Thread):
                 break
             logging.debug("Model scanner thread scanning for models")
             setupModels()
+            collectVersions()
 
 modelScannerThread = None
 def startScannerThread():
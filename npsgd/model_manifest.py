@@ -0,0 +1,134 @@
+# For distribution details, see LICENSE
+"""Serialised descriptions of models, for daemons that never run them.
+
+The queue and web daemons only need a model's names, version and parameter
+declarations, not its code (or the heavy libraries the code imports). A
+manifest is a JSON description of the models in one model file. Manifests are
+built by importing the file in a separate process (this module run as a
+script), and are cached on disk by file version so that each version is only
+ever imported once. Daemons then rebuild lightweight model classes from them
+with modelFromManifest.
+"""
+import os
+import sys
+import imp
+import json
+import uuid
+import inspect
+import logging
+import subprocess
+
+from npsgd import model_parameters
+from npsgd.model_task import ModelTask
+from npsgd.config import config
+
+class ManifestError(RuntimeError): pass
+
+def isModelClass(obj, module):
+    """Whether obj is a concrete model declared in module (see ModelManager.addModel)."""
+    return inspect.isclass(obj) and obj.__module__ == module.__name__ and \
+            issubclass(obj, ModelTask) and hasattr(obj, 'abstractModel') and \
+            obj.abstractModel != obj.__name__
+
+def describeParameter(parameter):
+    return {
+        "type":       parameter.__class__.__name__,
+        "attributes": parameter.__dict__
+    }
+
+def describeModel(cls):
+    return {
+        "short_name": cls.short_name,
+        "full_name":  cls.full_name,
+        "subtitle":   cls.subtitle,
+        "parameters": [describeParameter(p) for p in cls.parameters]
+    }
+
+def describeFile(pyfile):
+    """Imports a model file, returning manifests for the models declared in it."""
+    importName = os.path.basename(pyfile).rsplit(".", 1)[0]
+    module = imp.load_source(importName, pyfile)
+    return [describeModel(obj) for (name, obj) in inspect.getmembers(module) if isModelClass(obj, module)]
+
+def buildManifest(pyfile):
+    """Describes the models in a model file from a child process, so that its code is never imported here."""
+    packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([packageRoot, config.modelDirectory] + [p for p in sys.path if p])
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+
+    process = subprocess.Popen([sys.executable, "-m", "npsgd.model_manifest", pyfile],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    if process.returncode != 0:
+        raise ManifestError("Unable to describe '%s': %s" % (pyfile, errors.strip()))
+
+    try:
+        return json.loads(output)
+    except ValueError, e:
+        raise ManifestError("Bad manifest for '%s': %s" % (pyfile, e))
+
+def manifestPath(version):
+    return os.path.join(config.modelManifestDirectory, "%s.json" % version)
+
+def loadManifest(pyfile, version):
+    """Returns the manifest of a given version of a model file, building (and caching) it if needed."""
+    if config.modelManifestDirectory != "":
+        try:
+            with open(manifestPath(version)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    manifest = buildManifest(pyfile)
+    if config.modelManifestDirectory != "":
+        tmpPath = os.path.join(config.modelManifestDirectory, ".tmp-%s" % uuid.uuid4())
+        try:
+            if not os.path.exists(config.modelManifestDirectory):
+                os.makedirs(config.modelManifestDirectory)
+
+            with open(tmpPath, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmpPath, manifestPath(version))
+        except (IOError, OSError), e:
+            logging.warning("Unable to cache manifest for '%s': %s", pyfile, e)
+
+    return manifest
+
+def parameterFromManifest(d):
+    """Rebuilds a parameter declaration (with its default value) from its manifest."""
+    cls = getattr(model_parameters, d["type"], None)
+    if not (inspect.isclass(cls) and issubclass(cls, model_parameters.ModelParameter)):
+        raise ManifestError("Unknown parameter type '%s'" % d["type"])
+
+    parameter = cls.__new__(cls)
+    for k, v in d["attributes"].iteritems():
+        setattr(parameter, str(k), v)
+
+    #JSON loses types such as tuples, setting the value again restores them
+    if getattr(parameter, "value", None) != None:
+        parameter.setValue(parameter.value)
+
+    return parameter
+
+def modelFromManifest(d):
+    """Returns a model class built from a manifest.
+
+    The class can create, validate, serialise and describe tasks (and write
+    their e-mails), but not run them.
+    """
+    return type(str(d["short_name"]), (ModelTask,), {
+        "short_name": d["short_name"],
+        "full_name":  d["full_name"],
+        "subtitle":   d["subtitle"],
+        "parameters": [parameterFromManifest(p) for p in d["parameters"]]
+    })
+
+if __name__ == "__main__":
+    #Run as a script, this module is __main__: use the package's own copy
+    from npsgd.model_manifest import describeFile
+
+    #Models may print while they are imported, keep stdout for the manifest
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    manifest = describeFile(sys.argv[1])
+    stdout.write(json.dumps(manifest))
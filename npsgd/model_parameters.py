@@ -2,7 +2,6 @@
 # Date:   January 2011
 # For distribution details, see LICENSE
 """Module holding all types of model parameters."""
-import copy
 import logging
 
 class ValidationError(RuntimeError): pass
@@ -14,8 +13,8 @@ class ModelParameter(object):
     This object has a dual purpose, first to declare the parameters
     that are actually needed by a module and secondly to keep track
     of the values of that parameter. To switch between the two, a 
-    call to "withValue" creates a copy of the parameter, this time
-    with a given value.
+    call to "withValue" returns a ParameterValue holding the given
+    value, which shares (rather than copies) the declaration.
 
     Note: this is a lot less screwy than it sounds.
     """
@@ -23,13 +22,13 @@ class ModelParameter(object):
         self.name = name
 
     def withValue(self, value):
-        """Instantiates a copy of the model parameter with a given value.
+        """Instantiates a ParameterValue of this parameter with a given value.
         
         The setValue method will return a ValidationError if validation fails, so
         this method implicitly performs parameter verification.
         """
 
-        ret = copy.copy(self)
+        ret = ParameterValue.valueClass(self.__class__)(self)
         ret.setValue(value)
         return ret
 
@@ -86,6 +85,65 @@ class ModelParameter(object):
         raise MissingError("Missing value")
 
 
+class ParameterValue(object):
+    """A value of a model parameter (see ModelParameter.withValue).
+
+    Tasks hold one of these per parameter, so they are kept tiny: just the
+    value and the (shared, never modified) parameter declaration. A value is
+    an instance of a subclass of its declaration's class (see valueClass), so
+    the declaration's methods run on it unchanged, while the declaration's
+    attributes are looked up on the declaration itself. Any other attribute a
+    method sets goes in an instance dictionary, only created when needed.
+
+    Value classes are cached by declaration class. Classes of unloaded models
+    are dropped from the cache by retainValueClasses.
+    """
+    __slots__    = ("parameter", "value")
+    valueClasses = {}
+
+    def __init__(self, parameter, value=None):
+        self.parameter = parameter
+        self.value     = value
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        try:
+            return self.parameter.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __reduce__(self):
+        return (parameterValue, (self.parameter, self.value))
+
+    def withValue(self, value):
+        return self.parameter.withValue(value)
+
+    @classmethod
+    def valueClass(cls, parameterClass):
+        """Returns the value class for a class of parameter declarations, creating it on first use."""
+        if parameterClass not in cls.valueClasses:
+            cls.valueClasses[parameterClass] = type("%sValue" % parameterClass.__name__,
+                    (cls, parameterClass), {"__slots__": ()})
+
+        return cls.valueClasses[parameterClass]
+
+    @classmethod
+    def retainValueClasses(cls, parameterClasses):
+        """Drops the cached value classes of every declaration class not in parameterClasses.
+
+        Values already handed out keep working, and a dropped value class is
+        simply created again if its declaration class is used again.
+        """
+        for parameterClass in list(cls.valueClasses):
+            if parameterClass not in parameterClasses:
+                cls.valueClasses.pop(parameterClass, None)
+
+def parameterValue(parameter, value):
+    """Rebuilds a pickled ParameterValue."""
+    return parameter.withValue(value)
+
 class SelectParameter(ModelParameter):
     """Parameter type for selecting from a fixed set of string options (like a combo box)."""
 
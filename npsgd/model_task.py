@@ -4,15 +4,30 @@
 """Module containing the main superclass for all models."""
 import os
 import sys
+import time
+import json
 import uuid
 import random
 import string
+import hashlib
 import logging
 import subprocess
 from email_manager import Email
 import shutil
 
 from config import config
+import result_cache
+import artifact_store
+
+def parameterHash(modelName, modelVersion, parameterDicts):
+    """Hashes a model version together with canonicalised parameter values.
+
+    parameterDicts is the "modelParameters" entry of a task dictionary. Values
+    are taken after validation, so equal runs always hash the same way.
+    """
+    values = dict((name, p["value"]) for (name, p) in parameterDicts.iteritems())
+    canonical = json.dumps([modelName, modelVersion, values], sort_keys=True)
+    return hashlib.sha1(canonical).hexdigest()
 
 class LatexError(RuntimeError): pass
 class ModelTask(object):
@@ -30,11 +45,12 @@ class ModelTask(object):
     subtitle    = "Unspecified Subtitle"
     attachments = []
 
-    def __init__(self, emailAddress, taskId, modelParameters={}, failureCount=0, visibleId=None):
+    def __init__(self, emailAddress, taskId, modelParameters={}, failureCount=0, visibleId=None, followers=[]):
         self.emailAddress      = emailAddress
         self.taskId            = taskId
         self.failureCount      = failureCount
         self.modelParameters   = []
+        self.followers         = list(followers)
         self.visibleId         = visibleId
         if self.visibleId == None:
             self.visibleId = "".join(random.choice(string.letters + string.digits)\
@@ -42,14 +58,16 @@ class ModelTask(object):
 
         self.workingDirectory  = "/var/tmp/npsgd/%s" % str(uuid.uuid4())
 
+        #Values are put in declaration order
+        parameterIndexes = self.__class__.parameterIndexes()
+        values = [None] * len(parameterIndexes)
         for k,v in modelParameters.iteritems():
-            param = self.parameterType(k).fromDict(v)
+            index = parameterIndexes[k]
+            param = self.__class__.parameters[index].fromDict(v)
             setattr(self, param.name, param)
-            self.modelParameters.append(param)
+            values[index] = param
 
-        #Recover ordering
-        parameterIndexes = dict((e.name, i) for (i,e) in enumerate(self.__class__.parameters))
-        self.modelParameters.sort(key=lambda x: parameterIndexes[x.name])
+        self.modelParameters = [p for p in values if p != None]
 
     def createWorkingDirectory(self):
         try:
@@ -57,14 +75,22 @@ class ModelTask(object):
         except OSError, e:
             logging.warning(e)
 
+    @classmethod
+    def parameterIndexes(cls):
+        """Returns a hash from parameter name to its index in this model's parameters (computed once per class)."""
+        if "parameterIndexMap" not in cls.__dict__:
+            cls.parameterIndexMap = dict((p.name, i) for (i, p) in enumerate(cls.parameters))
+
+        return cls.parameterIndexMap
+
     def parameterType(self, parameterName):
         """Returns an empty version the parameter class for a given parameter name."""
 
-        for pClass in self.__class__.parameters:
-            if parameterName == pClass.name:
-                return pClass
+        index = self.__class__.parameterIndexes().get(parameterName)
+        if index == None:
+            return None
 
-        return None
+        return self.__class__.parameters[index]
 
     @classmethod
     def fromDict(cls, dictionary):
@@ -72,9 +98,11 @@ class ModelTask(object):
         taskId       = dictionary["taskId"]
         visibleId    = dictionary["visibleId"]
         failureCount = dictionary["failureCount"]
+        followers    = dictionary.get("followers", [])
 
         return cls(emailAddress, taskId, failureCount=failureCount,
-                modelParameters=dictionary["modelParameters"], visibleId=visibleId)
+                modelParameters=dictionary["modelParameters"], visibleId=visibleId,
+                followers=followers)
 
     def asDict(self):
         return {
@@ -85,9 +113,29 @@ class ModelTask(object):
             "modelName":       self.__class__.short_name,
             "modelFullName":   self.__class__.full_name,
             "modelVersion":    self.__class__.version,
-            "modelParameters": dict((p.name, p.asDict()) for p in self.modelParameters)
+            "modelParameters": dict((p.name, p.asDict()) for p in self.modelParameters),
+            "followers":       self.followers
         }
 
+    def followerTasks(self, followers=None):
+        """Returns task objects for the followers of this task (by default all of them)."""
+        if followers == None:
+            followers = self.followers
+
+        tasks = []
+        for follower in followers:
+            taskDict = self.asDict()
+            taskDict.update(follower)
+            taskDict["followers"] = []
+            tasks.append(self.__class__.fromDict(taskDict))
+
+        return tasks
+
+    def resultKey(self):
+        """Returns a key identifying the results of this run (see parameterHash)."""
+        return parameterHash(self.__class__.short_name, self.__class__.version,
+                dict((p.name, p.asDict()) for p in self.modelParameters))
+
     def latexBody(self):
         """Returns the body of the LaTeX PDF used to generate result e-mails."""
 
@@ -112,14 +160,20 @@ class ModelTask(object):
         return "\n".join(p.asTextRow() for p in self.modelParameters)
 
     def getAttachments(self):
-        pdf = self.generatePDF()
+        attach = []
+        for name, path in self.resultFiles():
+            with open(path, 'rb') as f:
+                attach.append((name, f.read()))
+
+        return attach
 
-        attach = [('results.pdf', pdf)]
+    def resultFiles(self):
+        """Generates the results PDF, returning (name, path) pairs for it and every attachment."""
+        files = [('results.pdf', self.generatePDFFile())]
         for attachment in self.__class__.attachments:
-            with open(os.path.join(self.workingDirectory, attachment)) as f:
-                attach.append((attachment, f.read()))
+            files.append((attachment, os.path.join(self.workingDirectory, attachment)))
 
-        return attach
+        return files
 
     def prepareGraphs(self):
         """A step in the standard model run to prepare output graphs."""
@@ -132,6 +186,14 @@ class ModelTask(object):
     def generatePDF(self):
         """Generates a PDF using the LaTeX template, our model's LaTeX body and PDFLatex.""" 
 
+        with open(self.generatePDFFile(), 'rb') as f:
+            pdf = f.read()
+
+        return pdf
+
+    def generatePDFFile(self):
+        """Generates the results PDF in the working directory, returning its path."""
+
         latex = config.latexResultTemplate.generate(model_results=self.latexBody(), task=self)
         logging.info(latex)
 
@@ -150,10 +212,7 @@ class ModelTask(object):
             if retCode != 0:
                 raise LatexError("Bad exit code from latex")
 
-        with open(pdfOutputPath, 'rb') as f:
-            pdf = f.read()
-
-        return pdf
+        return pdfOutputPath
 
 
     def failureEmail(self):
@@ -162,27 +221,67 @@ class ModelTask(object):
                 config.failureEmailSubject.generate(task=self),
                 config.failureEmailTemplate.generate(task=self))
 
-    def resultsEmail(self, attachments):
-        """Returns an e-mail object for yielding a results e-mail for the user."""
-        return Email(self.emailAddress,
+    def resultsEmail(self, attachments, links=[]):
+        """Returns an e-mail object for yielding a results e-mail for the user.
+
+        Results are either attached or, when delivered by link, listed as
+        (name, url) download links in the body.
+        """
+        email = Email(self.emailAddress,
                 config.resultsEmailSubject.generate(task=self),
-                config.resultsEmailBodyTemplate.generate(task=self),
+                config.resultsEmailBodyTemplate.generate(task=self, links=links,
+                    linkExpiry=time.strftime("%B %d, %Y", time.localtime(time.time() + config.artifactTTL * 3600))),
                 attachments)
+        email.links = links
+        return email
+
+    def deliverResults(self, files):
+        """Returns the results e-mail for a list of (name, path) result files.
+
+        Depending on resultsDelivery, the files are either read in as attachments
+        or copied to the artifact store and linked to.
+        """
+        if config.resultsDelivery == "link":
+            store = artifact_store.getArtifactStore()
+            links = [(name, store.link(store.putFile(path), name)) for (name, path) in files]
+            return self.resultsEmail([], links)
+
+        attachments = []
+        for name, path in files:
+            with open(path, 'rb') as f:
+                attachments.append((name, f.read()))
+
+        return self.resultsEmail(attachments)
 
     def runModel(self):
         """Performs model-specific steps for execution."""
         logging.warning("Called default run model - this should be overridden")
 
     def run(self):
-        """Runs the model with parameters, and returns results email object."""
+        """Runs the model with parameters, and returns results email object.
 
-        logging.info("Running default task for '%s'", self.emailAddress)
+        Results of identical earlier runs are served from the result cache
+        (if it is enabled) without running the model at all.
+        """
+
+        cache = result_cache.getResultCache()
         self.createWorkingDirectory()
         try:
+            if cache != None:
+                files = cache.get(self.resultKey(), self.workingDirectory)
+                if files != None:
+                    logging.info("Found results for task '%s' in the result cache", self.taskId)
+                    return self.deliverResults(files)
+
+            logging.info("Running default task for '%s'", self.emailAddress)
             self.prepareExecution()
             self.runModel()
             self.prepareGraphs()
-            return self.resultsEmail(self.getAttachments())
+            files = self.resultFiles()
+            if cache != None:
+                cache.put(self.resultKey(), files)
+
+            return self.deliverResults(files)
         finally:
             if os.path.exists(self.workingDirectory):
                 shutil.rmtree(self.workingDirectory)
@@ -0,0 +1,146 @@
+# For distribution details, see LICENSE
+"""HTTP client used by the workers to talk to the queue daemon."""
+import time
+import errno
+import random
+import socket
+import urllib
+import httplib
+import logging
+import threading
+import wire
+
+class QueueClientError(RuntimeError): pass
+
+class QueueClient(object):
+    """Keep-alive JSON client for the queue's HTTP API (thread safe).
+
+    Requests are made over a pool of persistent connections shared by every
+    thread of the worker, so a busy worker keeps a handful of connections
+    open instead of opening a new one per request. Failed requests are retried
+    with exponential backoff and random jitter, so that a fleet of workers
+    does not hammer a queue that is restarting all at the same moment. A
+    request that fails on a pooled connection the server has already closed
+    is retried on a fresh connection straight away.
+
+    Every request carries the queue secret and returns the decoded response,
+    raising a QueueClientError if it cannot be made. POST bodies are sent in
+    wireFormat (see npsgd.wire), or form-encoded if it is None.
+    """
+
+    def __init__(self, host, port, secret, timeout, retries, poolSize, backoff=0.5, maxBackoff=30, wireFormat=None):
+        self.host       = host
+        self.port       = port
+        self.secret     = secret
+        self.timeout    = timeout
+        self.retries    = retries
+        self.poolSize   = poolSize
+        self.backoff    = backoff
+        self.maxBackoff = maxBackoff
+        self.wireFormat = wireFormat
+        self.idle       = []
+        self.lock       = threading.Lock()
+
+    def connection(self):
+        """Returns an idle pooled connection (and True), or a new one (and False)."""
+        with self.lock:
+            if len(self.idle) > 0:
+                return self.idle.pop(), True
+
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.poolSize:
+                self.idle.append(conn)
+                return
+
+        conn.close()
+
+    def isStale(self, e):
+        """Whether an error on a reused connection means the server had closed it."""
+        if isinstance(e, (httplib.BadStatusLine, httplib.CannotSendRequest)):
+            return True
+
+        return isinstance(e, socket.error) and not isinstance(e, socket.timeout) and \
+                e.errno in [errno.EPIPE, errno.ECONNRESET]
+
+    def sleepTime(self, attempt):
+        return min(self.maxBackoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def attempt(self, method, path, params, timeout):
+        """Makes one request over a pooled connection, returning (status, body, content type)."""
+        if method == "POST":
+            body, headers = wire.encodeRequest(params, self.wireFormat)
+        else:
+            path, body = "%s?%s" % (path, urllib.urlencode(wire.formArguments(params))), None
+            headers = {}
+            if self.wireFormat != None:
+                headers["Accept"] = wire.contentType(self.wireFormat)
+
+        while True:
+            conn, reused = self.connection()
+            conn.timeout = timeout
+            if conn.sock != None:
+                conn.sock.settimeout(timeout)
+
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if reused and self.isStale(e):
+                    continue
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(conn)
+
+            return response.status, data, response.getheader("Content-Type")
+
+    def request(self, method, path, params={}, timeout=None, retries=None):
+        """Makes a request to the queue, retrying failures with jittered backoff.
+
+        Requests that must not be repeated should pass retries=0.
+        """
+        if timeout == None:
+            timeout = self.timeout
+        if retries == None:
+            retries = self.retries
+
+        params = dict(params)
+        params["secret"] = self.secret
+        attempt = 0
+        while True:
+            try:
+                status, data, contentType = self.attempt(method, path, params, timeout)
+                if status != 200:
+                    raise QueueClientError("HTTP status %d from %s" % (status, path))
+
+                try:
+                    return wire.decodeResponse(data, contentType)
+                except wire.WireError, e:
+                    raise QueueClientError("Bad response from %s: %s" % (path, e))
+            except (httplib.HTTPException, socket.error, QueueClientError), e:
+                if attempt >= retries:
+                    raise QueueClientError("Request to %s failed: %s" % (path, e))
+
+                sleepTime = self.sleepTime(attempt)
+                attempt += 1
+                logging.warning("Request to %s failed (%s), retry #%d in %.1fs", path, e, attempt, sleepTime)
+                time.sleep(sleepTime)
+
+    def get(self, path, params={}, **kwargs):
+        return self.request("GET", path, params, **kwargs)
+
+    def post(self, path, params={}, **kwargs):
+        return self.request("POST", path, params, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
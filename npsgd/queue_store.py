@@ -0,0 +1,592 @@
+# For distribution details, see LICENSE
+"""Disk persistence backends for the queue daemon.
+
+Three stores are available. The shelve store re-serializes the whole queue
+whenever it changes. The journal store appends one small record per state
+change to a write-ahead log and periodically compacts the log into a snapshot,
+so that the cost of persistence is proportional to the change rather than
+to the size of the queue. The sqlite store keeps tasks, leases and codes in
+indexed tables and updates single rows in a transaction per change, which
+also allows the backlog to be queried directly on disk.
+"""
+import os
+import json
+import time
+import Queue
+import anydbm
+import shelve
+import pickle
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+class QueueState(object):
+    """Plain (dictionary-based) image of everything the queue persists.
+
+    Tasks and confirmations are held as task dictionaries (see ModelTask.asDict)
+    so that they can be serialized without any knowledge of the models.
+    """
+
+    def __init__(self, idCounter=0, tasks=[], confirmations={}, confirmedCodes={}):
+        self.idCounter      = idCounter
+        self.tasks          = OrderedDict((t["taskId"], t) for t in tasks)
+        self.confirmations  = OrderedDict(confirmations)
+        self.confirmedCodes = dict(confirmedCodes)
+
+    def touchId(self, taskId):
+        self.idCounter = max(self.idCounter, taskId)
+
+    def apply(self, record):
+        """Replays a single journal record against this state.
+
+        Replaying is idempotent so that records written while a snapshot was
+        being taken can safely be applied on top of that snapshot.
+        """
+        op = record["op"]
+        if op == "create":
+            self.confirmations[record["code"]] = record["task"]
+            self.touchId(record["task"]["taskId"])
+        elif op == "confirm":
+            task = self.confirmations.pop(record["code"], None)
+            if task != None:
+                self.tasks[task["taskId"]] = task
+            if "time" in record:
+                self.confirmedCodes[record["code"]] = record["time"]
+        elif op == "lease":
+            pass
+        elif op == "complete":
+            self.tasks.pop(record["taskId"], None)
+        elif op in ["fail", "expire"]:
+            self.tasks.pop(record["taskId"], None)
+            if record["task"] != None:
+                self.tasks[record["task"]["taskId"]] = record["task"]
+                self.touchId(record["task"]["taskId"])
+        elif op == "expire_codes":
+            for code in record["codes"]:
+                self.confirmations.pop(code, None)
+        else:
+            logging.warning("Ignoring unknown journal record '%s'", op)
+
+    def asDict(self):
+        return {
+            "idCounter":      self.idCounter,
+            "tasks":          self.tasks.values(),
+            "confirmations":  self.confirmations,
+            "confirmedCodes": self.confirmedCodes
+        }
+
+    @classmethod
+    def fromDict(cls, d):
+        return cls(d["idCounter"], d["tasks"], d["confirmations"], d.get("confirmedCodes", {}))
+
+class QueueStore(object):
+    """Abstract base class for queue persistence.
+
+    The queue calls one of the task* methods for every change in state, passing
+    task ids and task dictionaries. The store may ask the queue for a complete
+    image of its state through the state source (a callable returning a
+    QueueState) whenever it needs one.
+
+    With autoSync set, every change is durable by the time its method returns.
+    Otherwise changes only become durable on the next call to sync.
+    """
+
+    def __init__(self):
+        self.stateSource = None
+        self.autoSync    = True
+
+    def setStateSource(self, stateSource):
+        self.stateSource = stateSource
+
+    def load(self):
+        """Returns the QueueState persisted on disk."""
+        raise NotImplementedError()
+
+    def checkpoint(self):
+        """Writes out the complete current state of the queue."""
+        pass
+
+    def sync(self):
+        """Makes all changes so far durable."""
+        pass
+
+    def taskCreated(self, code, taskDict):     pass
+    def taskConfirmed(self, code, taskId):     pass
+    def taskFollowed(self, taskId, leaderId):  pass
+    def taskLeased(self, taskId):              pass
+    def taskCompleted(self, taskId):           pass
+    def taskFailed(self, taskId, taskDict):    pass
+    def taskExpired(self, taskId, taskDict):   pass
+    def confirmationsExpired(self, codes):     pass
+
+    def close(self):
+        pass
+
+class ShelveQueueStore(QueueStore):
+    """Store that re-pickles the whole queue into a shelve on every major change."""
+
+    def __init__(self, path):
+        QueueStore.__init__(self)
+        self.lock  = threading.RLock()
+        self.dirty = False
+        try:
+            self.shelve = shelve.open(path)
+        except anydbm.error:
+            logging.warning("Queue file '%s' is corrupt, moving it aside and starting afresh", path)
+            os.rename(path, "%s.corrupt-%d" % (path, time.time()))
+            self.shelve = shelve.open(path)
+
+    def load(self):
+        state = QueueState()
+        if self.shelve.has_key("idCounter"):
+            state.idCounter = self.shelve["idCounter"]
+
+        if self.shelve.has_key("taskQueue"):
+            state.tasks = OrderedDict((t["taskId"], t) for t in self.shelve["taskQueue"])
+        else:
+            logging.info("Unable to read task queue from disk db, starting fresh")
+
+        if self.shelve.has_key("confirmationMap"):
+            state.confirmations = OrderedDict(self.shelve["confirmationMap"])
+        else:
+            logging.info("Unable to read confirmation map from disk db, starting fresh")
+
+        if self.shelve.has_key("confirmedCodes"):
+            state.confirmedCodes = self.shelve["confirmedCodes"]
+
+        return state
+
+    def checkpoint(self):
+        """Serializes the task queue, confirmation map and id counter to disk using the queue shelve."""
+        state = self.stateSource()
+        try:
+            with self.lock:
+                self.shelve["taskQueue"]       = state.tasks.values()
+                self.shelve["confirmationMap"] = dict(state.confirmations)
+                self.shelve["idCounter"]       = state.idCounter
+                self.shelve["confirmedCodes"]  = state.confirmedCodes
+                self.shelve.sync()
+        except pickle.PicklingError, e:
+            logging.warning("Unable sync task queue and confirmation error to disk due to a pickling (serialization error): %s", e)
+            return
+
+        self.dirty = False
+        logging.info("Synced queue and confirmation map to disk")
+
+    def sync(self):
+        if self.dirty:
+            self.checkpoint()
+
+    def changed(self):
+        """Rewrites the shelve now, or on the next sync when changes are batched."""
+        self.dirty = True
+        if self.autoSync:
+            self.sync()
+
+    def taskCreated(self, code, taskDict):
+        self.changed()
+
+    def taskConfirmed(self, code, taskId):
+        self.changed()
+
+    def taskCompleted(self, taskId):
+        self.changed()
+
+    def taskFailed(self, taskId, taskDict):
+        self.changed()
+
+    def taskExpired(self, taskId, taskDict):
+        self.changed()
+
+    def confirmationsExpired(self, codes):
+        if len(codes) > 0:
+            self.changed()
+
+    def close(self):
+        self.shelve.close()
+
+class JournalQueueStore(QueueStore):
+    """Store that appends state changes to a write-ahead log (thread safe).
+
+    Each change is written as one line of JSON and fsynced (or, if changes are
+    batched, fsynced once per batch on sync). After a configurable
+    number of records the full state is written to a snapshot file and the
+    journal is truncated. On startup the snapshot is loaded and the journal
+    tail is replayed on top of it.
+    """
+
+    def __init__(self, path, snapshotInterval):
+        QueueStore.__init__(self)
+        self.snapshotPath     = "%s.snapshot" % path
+        self.journalPath      = "%s.journal"  % path
+        self.snapshotInterval = snapshotInterval
+        self.recordCount      = 0
+        self.lock             = threading.RLock()
+        self.journalFile      = None
+
+    def load(self):
+        if os.path.exists(self.snapshotPath):
+            with open(self.snapshotPath) as f:
+                state = QueueState.fromDict(json.load(f, object_pairs_hook=OrderedDict))
+        else:
+            logging.info("No queue snapshot on disk, starting fresh")
+            state = QueueState()
+
+        replayed = 0
+        if os.path.exists(self.journalPath):
+            with open(self.journalPath) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning("Ignoring torn record at the end of the queue journal")
+                        break
+
+                    state.apply(record)
+                    replayed += 1
+
+        logging.info("Replayed %d journal records on top of queue snapshot", replayed)
+        self.journalFile = open(self.journalPath, "a")
+        self.recordCount = replayed
+        return state
+
+    def append(self, op, **fields):
+        """Appends a single record to the journal, compacting it when it grows too long."""
+        fields["op"] = op
+        line = json.dumps(fields)
+        with self.lock:
+            self.journalFile.write(line + "\n")
+            self.recordCount += 1
+            if self.autoSync:
+                self.sync()
+
+            if self.recordCount >= self.snapshotInterval:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """Writes a snapshot of the whole queue and truncates the journal."""
+        with self.lock:
+            state = self.stateSource()
+            tmpPath = "%s.tmp" % self.snapshotPath
+            with open(tmpPath, "w") as f:
+                json.dump(state.asDict(), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpPath, self.snapshotPath)
+
+            self.journalFile.close()
+            self.journalFile = open(self.journalPath, "w")
+            self.recordCount = 0
+
+        logging.info("Wrote queue snapshot and truncated journal")
+
+    def sync(self):
+        with self.lock:
+            self.journalFile.flush()
+            os.fsync(self.journalFile.fileno())
+
+    def taskCreated(self, code, taskDict):
+        self.append("create", code=code, task=taskDict)
+
+    def taskConfirmed(self, code, taskId):
+        self.append("confirm", code=code, taskId=taskId, time=time.time())
+
+    def taskLeased(self, taskId):
+        self.append("lease", taskId=taskId)
+
+    def taskCompleted(self, taskId):
+        self.append("complete", taskId=taskId)
+
+    def taskFailed(self, taskId, taskDict):
+        self.append("fail", taskId=taskId, task=taskDict)
+
+    def taskExpired(self, taskId, taskDict):
+        self.append("expire", taskId=taskId, task=taskDict)
+
+    def confirmationsExpired(self, codes):
+        if len(codes) > 0:
+            self.append("expire_codes", codes=codes)
+
+    def close(self):
+        with self.lock:
+            if self.journalFile != None:
+                self.journalFile.close()
+
+class SqliteQueueStore(QueueStore):
+    """Store that keeps the queue in indexed sqlite tables (thread safe).
+
+    Tasks (pending, processing or following an identical task), leases,
+    unconfirmed and recently confirmed codes each get a table, and every
+    change touches only the rows involved.
+    The database runs in WAL mode: each change is its own statement and a
+    transaction is committed on sync (or after every change with autoSync).
+    A corrupt database is moved aside rather than deleted.
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS tasks (
+            taskId       INTEGER PRIMARY KEY,
+            state        TEXT NOT NULL,
+            modelName    TEXT NOT NULL,
+            modelVersion TEXT NOT NULL,
+            task         TEXT NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)",
+        "CREATE INDEX IF NOT EXISTS tasks_model ON tasks (modelName, modelVersion, state)",
+        """CREATE TABLE IF NOT EXISTS leases (
+            taskId   INTEGER PRIMARY KEY,
+            leasedAt REAL NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS confirmations (
+            code      TEXT PRIMARY KEY,
+            taskId    INTEGER NOT NULL,
+            createdAt REAL NOT NULL,
+            task      TEXT NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS confirmations_task ON confirmations (taskId)",
+        "CREATE INDEX IF NOT EXISTS confirmations_created ON confirmations (createdAt)",
+        """CREATE TABLE IF NOT EXISTS confirmed_codes (
+            code        TEXT PRIMARY KEY,
+            confirmedAt REAL NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS confirmed_codes_time ON confirmed_codes (confirmedAt)",
+        """CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value INTEGER NOT NULL)"""
+    ]
+
+    def __init__(self, path, codeTimeout):
+        QueueStore.__init__(self)
+        self.path        = path
+        self.codeTimeout = codeTimeout
+        self.lock        = threading.RLock()
+        self.db          = None
+        try:
+            self.connect()
+        except sqlite3.DatabaseError, e:
+            logging.warning("Queue database '%s' is corrupt (%s), moving it aside and starting afresh", path, e)
+            if self.db != None:
+                self.db.close()
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(path + suffix):
+                    os.rename(path + suffix, "%s.corrupt-%d%s" % (path, time.time(), suffix))
+            self.connect()
+
+    def connect(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        (check,) = self.db.execute("PRAGMA quick_check").fetchone()
+        if check != "ok":
+            raise sqlite3.DatabaseError(check)
+
+        for statement in self.schema:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def load(self):
+        """Reads the queue, returning tasks that were leased before the restart to the pending state.
+
+        The queue requeues those tasks (their leases died with the old
+        process), and only their rows are updated to match. Other rows keep
+        their state.
+        """
+        state = QueueState()
+        with self.lock:
+            requeued = self.db.execute("UPDATE tasks SET state = 'pending' WHERE state = 'processing'").rowcount
+            self.db.execute("DELETE FROM leases")
+            self.db.commit()
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if requeued > 0:
+                logging.info("Returned %d tasks leased before the restart to the queue", requeued)
+
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'idCounter'").fetchone()
+            if row != None:
+                state.idCounter = row[0]
+
+            state.tasks = OrderedDict((taskId, json.loads(task)) for (taskId, task) in
+                    self.db.execute("SELECT taskId, task FROM tasks ORDER BY taskId"))
+            state.confirmations = OrderedDict((code, json.loads(task)) for (code, task) in
+                    self.db.execute("SELECT code, task FROM confirmations ORDER BY createdAt"))
+            state.confirmedCodes = dict(self.db.execute("SELECT code, confirmedAt FROM confirmed_codes"))
+
+        logging.info("Read %d tasks and %d codes from the queue database", len(state.tasks), len(state.confirmations))
+        return state
+
+    def sync(self):
+        with self.lock:
+            self.db.commit()
+
+    def changed(self):
+        if self.autoSync:
+            self.sync()
+
+    def touchId(self, taskId):
+        self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('idCounter', 0)")
+        self.db.execute("UPDATE meta SET value = max(value, ?) WHERE key = 'idCounter'", (taskId,))
+
+    def insertTask(self, task):
+        self.db.execute("INSERT OR REPLACE INTO tasks (taskId, state, modelName, modelVersion, task) VALUES (?, 'pending', ?, ?, ?)",
+                (task["taskId"], task["modelName"], task["modelVersion"], json.dumps(task)))
+
+    def deleteTask(self, taskId):
+        self.db.execute("DELETE FROM tasks WHERE taskId = ?", (taskId,))
+        self.db.execute("DELETE FROM leases WHERE taskId = ?", (taskId,))
+
+    def taskCreated(self, code, taskDict):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO confirmations (code, taskId, createdAt, task) VALUES (?, ?, ?, ?)",
+                    (code, taskDict["taskId"], time.time(), json.dumps(taskDict)))
+            self.touchId(taskDict["taskId"])
+            self.changed()
+
+    def taskConfirmed(self, code, taskId):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT task FROM confirmations WHERE code = ?", (code,)).fetchone()
+            if row != None:
+                self.insertTask(json.loads(row[0]))
+                self.db.execute("DELETE FROM confirmations WHERE code = ?", (code,))
+
+            self.db.execute("INSERT OR REPLACE INTO confirmed_codes (code, confirmedAt) VALUES (?, ?)", (code, now))
+            self.db.execute("DELETE FROM confirmed_codes WHERE confirmedAt < ?", (now - self.codeTimeout,))
+            self.changed()
+
+    def taskFollowed(self, taskId, leaderId):
+        """Marks a task as waiting on an identical one, it is removed when its leader finishes."""
+        with self.lock:
+            self.db.execute("UPDATE tasks SET state = 'following' WHERE taskId = ?", (taskId,))
+            self.changed()
+
+    def taskLeased(self, taskId):
+        with self.lock:
+            self.db.execute("UPDATE tasks SET state = 'processing' WHERE taskId = ?", (taskId,))
+            self.db.execute("INSERT OR REPLACE INTO leases (taskId, leasedAt) VALUES (?, ?)", (taskId, time.time()))
+            self.changed()
+
+    def taskCompleted(self, taskId):
+        with self.lock:
+            self.deleteTask(taskId)
+            self.changed()
+
+    def taskFailed(self, taskId, taskDict):
+        with self.lock:
+            self.deleteTask(taskId)
+            if taskDict != None:
+                self.insertTask(taskDict)
+                self.touchId(taskDict["taskId"])
+            self.changed()
+
+    def taskExpired(self, taskId, taskDict):
+        self.taskFailed(taskId, taskDict)
+
+    def confirmationsExpired(self, codes):
+        with self.lock:
+            self.db.executemany("DELETE FROM confirmations WHERE code = ?", [(code,) for code in codes])
+            self.changed()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+class QueueStoreWriter(threading.Thread):
+    """Group commit thread sitting in front of a queue store.
+
+    Request handlers hand their state changes to this thread instead of
+    writing to disk themselves. Changes are applied to the underlying store
+    in batches, collected for at most flushInterval seconds or batchSize
+    changes, and made durable with a single sync per batch. Callers that need
+    to know when their changes hit the disk can ask for a callback with flush.
+    """
+
+    def __init__(self, store, flushInterval, batchSize):
+        threading.Thread.__init__(self)
+        self.daemon        = True
+        self.store         = store
+        self.flushInterval = flushInterval
+        self.batchSize     = batchSize
+        self.queue         = Queue.Queue()
+        self.store.autoSync = False
+
+    def submit(self, method, *args):
+        self.queue.put((method, args))
+
+    def taskCreated(self, code, taskDict):
+        self.submit("taskCreated", code, taskDict)
+
+    def taskConfirmed(self, code, taskId):
+        self.submit("taskConfirmed", code, taskId)
+
+    def taskFollowed(self, taskId, leaderId):
+        self.submit("taskFollowed", taskId, leaderId)
+
+    def taskLeased(self, taskId):
+        self.submit("taskLeased", taskId)
+
+    def taskCompleted(self, taskId):
+        self.submit("taskCompleted", taskId)
+
+    def taskFailed(self, taskId, taskDict):
+        self.submit("taskFailed", taskId, taskDict)
+
+    def taskExpired(self, taskId, taskDict):
+        self.submit("taskExpired", taskId, taskDict)
+
+    def confirmationsExpired(self, codes):
+        if len(codes) > 0:
+            self.submit("confirmationsExpired", codes)
+
+    def flush(self, callback):
+        """Calls callback (from the writer thread) once all changes so far are durable."""
+        self.queue.put((None, callback))
+
+    def nextBatch(self):
+        """Blocks for a first change, then gathers more until the batch is full or the interval is up."""
+        batch = [self.queue.get()]
+        deadline = time.time() + self.flushInterval
+        while len(batch) < self.batchSize:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(True, remaining))
+            except Queue.Empty:
+                break
+
+        return batch
+
+    def commit(self, batch):
+        callbacks = []
+        for method, args in batch:
+            if method == None:
+                callbacks.append(args)
+                continue
+
+            try:
+                getattr(self.store, method)(*args)
+            except Exception:
+                logging.exception("Queue store failed to record '%s'", method)
+
+        try:
+            self.store.sync()
+        except Exception:
+            logging.exception("Queue store failed to sync to disk")
+
+        logging.debug("Committed %d queue changes to disk", len(batch) - len(callbacks))
+        for callback in callbacks:
+            callback()
+
+    def run(self):
+        logging.info("Queue store writer booting up...")
+        done = False
+        while not done:
+            batch = self.nextBatch()
+            if ("stop", None) in batch:
+                batch.remove(("stop", None))
+                done = True
+
+            self.commit(batch)
+
+    def close(self):
+        """Writes out everything still pending and stops the thread."""
+        self.queue.put(("stop", None))
+        self.join()
@@ -0,0 +1,120 @@
+# For distribution details, see LICENSE
+"""Content-addressed disk cache of model results, used by the workers.
+
+Results are keyed by a hash of the model name, model version and the values
+of its parameters (see ModelTask.resultKey) so that identical runs can be
+answered without executing the model again.
+"""
+import os
+import json
+import uuid
+import shutil
+import logging
+from config import config
+
+class ResultCache(object):
+    """Size-bounded, least recently used cache of result files on local disk.
+
+    Each entry is a directory named by its key holding the result files and
+    a manifest that records their order. Entries are written to a temporary
+    directory and renamed into place, so concurrent workers (processes) on
+    one machine can safely share the cache. Directory modification times
+    double as the LRU clock.
+    """
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes  = maxBytes
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def entryPath(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, destination):
+        """Links the result files stored for key into destination, returning their (name, path) list, or None.
+
+        The entry may be evicted by another worker at any time, but the links
+        (copies if the file system has none) stay readable until the caller
+        removes them.
+        """
+        path = self.entryPath(key)
+        files = []
+        try:
+            with open(os.path.join(path, "manifest.json")) as f:
+                names = json.load(f)
+
+            for name in names:
+                target = os.path.join(destination, name)
+                try:
+                    os.link(os.path.join(path, name), target)
+                except OSError:
+                    shutil.copyfile(os.path.join(path, name), target)
+                files.append((name, target))
+
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            #Leave nothing behind that a model run could write through into the cache
+            for name, target in files:
+                os.remove(target)
+            return None
+
+        return files
+
+    def put(self, key, files):
+        """Copies a list of (name, path) result files in under key, evicting old entries if the cache is too large."""
+        path = self.entryPath(key)
+        if os.path.exists(path):
+            return
+
+        tmpPath = os.path.join(self.directory, ".tmp-%s" % uuid.uuid4())
+        try:
+            os.makedirs(tmpPath)
+            for name, filePath in files:
+                shutil.copyfile(filePath, os.path.join(tmpPath, name))
+
+            with open(os.path.join(tmpPath, "manifest.json"), 'w') as f:
+                json.dump([name for (name, filePath) in files], f)
+
+            os.rename(tmpPath, path)
+        except (IOError, OSError), e:
+            logging.warning("Unable to store results in cache: %s", e)
+            shutil.rmtree(tmpPath, True)
+            return
+
+        self.evict()
+
+    def entrySize(self, path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in maxBytes."""
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.entryPath(key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+
+            try:
+                entries.append((os.path.getmtime(path), self.entrySize(path), path))
+            except OSError:
+                continue
+
+        totalSize = sum(size for (mtime, size, path) in entries)
+        entries.sort()
+        for mtime, size, path in entries:
+            if totalSize <= self.maxBytes:
+                break
+
+            logging.info("Evicting '%s' from the result cache", os.path.basename(path))
+            shutil.rmtree(path, True)
+            totalSize -= size
+
+resultCache = None
+def getResultCache():
+    """Returns the result cache for this machine, or None if caching is switched off."""
+    global resultCache
+    if resultCache == None and config.resultCacheDirectory != "":
+        resultCache = ResultCache(config.resultCacheDirectory, config.resultCacheSize * 1024 * 1024)
+
+    return resultCache
@@ -5,9 +5,30 @@
 import os
 import logging
 import subprocess
+import multiprocessing
 from model_task import ModelTask
 from config import config
 
+def splitRange(start, end, step, count):
+    """Splits the points start, start+step, ..., end into at most count disjoint sub-ranges.
+
+    Returns a list of (start, end) pairs, each aligned to step and in order.
+    """
+    numPoints = int(round((end - start) / step)) + 1
+    count     = max(1, min(count, numPoints))
+    ranges = []
+    for i in xrange(count):
+        first = i * numPoints / count
+        last  = (i + 1) * numPoints / count - 1
+        ranges.append((start + first * step, start + last * step))
+
+    return ranges
+
+def splitSamples(numSamples, count):
+    """Splits numSamples into count (nearly) equal sample counts that add back up to numSamples."""
+    count = max(1, min(count, numSamples))
+    return [numSamples / count + (1 if i < numSamples % count else 0) for i in xrange(count)]
+
 class StandaloneError(RuntimeError): pass
 class StandaloneTask(ModelTask):
     """Abstract base task for standalone models.
@@ -15,6 +36,10 @@ class StandaloneTask(ModelTask):
     This class is meant to be the superclass of the user's various
     standalone models. These will generally compiled models, but can include
     anything that needs to be launched in a subprocess
+
+    Models can split a run into shards that execute as parallel subprocesses
+    by overriding executableShards (e.g. with splitSamples for Monte Carlo runs
+    or splitRange for wavelength sweeps) and mergeShards to combine the outputs.
     """
 
     abstractModel = "StandaloneTask"
@@ -28,24 +53,86 @@ class StandaloneTask(ModelTask):
                 "*"
         ]
 
+    def shardCount(self):
+        """Returns the number of shards a run should be split into on this machine."""
+        if config.modelShards > 0:
+            return config.modelShards
+
+        return max(1, multiprocessing.cpu_count() / config.workerSlots)
+
+    def executableShards(self, count):
+        """Returns a list of executable parameter lists, one per shard (at most count).
+
+        By default a model runs as a single unsharded process.
+        """
+        return [self.executableParameters()]
+
+    def mergeShards(self, count):
+        """Combines the outputs of count shards in the working directory into the final outputs."""
+        raise StandaloneError("Model '%s' runs shards but does not merge them" % self.__class__.short_name)
+
     def runModel(self):
         """Spawns a python subprocess of 'executable' class variable and executes.
 
         This method is meant to run standalone binaries of models. It stores the
         stdout/stderr in class variables called self.stdout and self.stderr.
+        If the model splits its run into several shards, they are run in parallel
+        and merged with mergeShards.
         """
 
+        shards = self.executableShards(self.shardCount())
+        if len(shards) == 1:
+            self.runExecutable(shards[0])
+        else:
+            self.runShards(shards)
+            self.mergeShards(len(shards))
+
+        logging.info("Subprocess all done")
+
+    def runExecutable(self, parameters):
         exe = self.__class__.executable
 
-        logging.info("Launching subprocess '%s %s'", exe, " ".join(self.executableParameters()))
-        mProcess = subprocess.Popen([exe] + self.executableParameters(),
+        logging.info("Launching subprocess '%s %s'", exe, " ".join(parameters))
+        mProcess = subprocess.Popen([exe] + parameters,
                 cwd=self.workingDirectory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         self.stdout, self.stderr = mProcess.communicate()
         logging.info("Stdout was: --------\n%s\n-----",  self.stdout)
         logging.info("Stderr was: --------\n%s\n-----",  self.stderr)
 
         if mProcess.returncode != 0:
-            raise ExecutableError("Bad return code '%s' from '%s'" % (mProcess.returnCode, exe))
+            raise StandaloneError("Bad return code '%s' from '%s'" % (mProcess.returncode, exe))
 
-        logging.info("Subprocess all done")
+    def runShards(self, shards):
+        """Runs every shard as a parallel subprocess, waiting for all of them to finish.
+
+        Shard output goes to files in the working directory so that a chatty shard
+        can never block on a full pipe while we wait on another one.
+        """
+        exe = self.__class__.executable
+        processes = []
+        for i, parameters in enumerate(shards):
+            logging.info("Launching shard %d: '%s %s'", i, exe, " ".join(parameters))
+            stdout = open(os.path.join(self.workingDirectory, "shard_%d.stdout" % i), "w+")
+            stderr = open(os.path.join(self.workingDirectory, "shard_%d.stderr" % i), "w+")
+            processes.append((subprocess.Popen([exe] + parameters, cwd=self.workingDirectory,
+                stdout=stdout, stderr=stderr), stdout, stderr))
+
+        failed = []
+        self.stdout, self.stderr = ("", "")
+        for i, (mProcess, stdout, stderr) in enumerate(processes):
+            mProcess.wait()
+            for f in (stdout, stderr):
+                f.seek(0)
+            self.stdout += stdout.read()
+            self.stderr += stderr.read()
+            stdout.close()
+            stderr.close()
+
+            if mProcess.returncode != 0:
+                failed.append((i, mProcess.returncode))
+
+        logging.info("Stdout was: --------\n%s\n-----",  self.stdout)
+        logging.info("Stderr was: --------\n%s\n-----",  self.stderr)
 
+        if len(failed) > 0:
+            raise StandaloneError("Bad return codes (shard, code) %s from '%s'" % (failed, exe))
@@ -5,8 +5,12 @@
 import os
 import sys
 import time
+import uuid
+import heapq
 import logging
+import itertools
 import threading
+from collections import deque
 
 class TaskQueueException(RuntimeError): pass
 
@@ -14,93 +18,239 @@ class TaskQueue(object):
     """Main queue object (thread safe).
 
     Contains two internal queues: one for actually holding requests, and one
-    for holding the tasks that are currently being processed. This way, if 
-    a task fails to process we can cycle it back into the requests queue a 
+    for holding the tasks that are currently being processed. This way, if
+    a task fails to process we can cycle it back into the requests queue a
     few times to see if the error was transient.
+
+    Requests are kept in one FIFO lane per (model name, model version) pair,
+    with every entry tagged by a sequence number so that the overall arrival
+    order is preserved across lanes. Processing tasks are kept in a hash from
+    task id to (task, timestamp), along with a min-heap of (timestamp, task id)
+    lease entries so the stalest lease can be found without a scan. Entries
+    are never removed from the middle of the heap: an entry whose timestamp no
+    longer matches the hash (the task was touched or finished) is simply
+    discarded when it reaches the top.
+
+    Identical requests (see TaskRecord.resultKey) are coalesced: while one is
+    pending or processing, later ones are attached to it as followers instead
+    of being queued again.
     """
     def __init__(self):
-        self.requests        = []
-        self.processingTasks = []
+        self.lanes           = {}
+        self.numRequests     = 0
+        self.processingTasks = {}
+        self.leaseHeap       = []
+        self.leaders         = {}
+        self.tailSequence    = itertools.count()
+        self.headSequence    = itertools.count(-1, -1)
         self.lock = threading.RLock()
 
+    def taskLane(self, task):
+        return (task.modelName, task.modelVersion)
+
     def allRequests(self):
         """Returns all requests in processing or requests queue.
-        
+
         This is really only useful for serializing the queue to disk."""
         with self.lock:
-            return self.requests + self.processingTasks
+            entries = []
+            for lane in self.lanes.itervalues():
+                entries.extend(lane)
+            entries.sort()
 
+            return [task for (seq, task) in entries] + \
+                    [task for (task, taskTime) in self.processingTasks.itervalues()]
 
     def putTask(self, request):
-        """Puts a model into the queue for worker processing."""
+        """Puts a model into the queue for worker processing.
+
+        Returns the task that will actually be run: either the request itself or
+        an identical task already in the queue that the request now follows.
+        """
         with self.lock:
-            self.requests.append(request)
+            key = request.resultKey()
+            leader = self.leaders.get(key)
+            if leader != None and leader is not request:
+                leader.addFollower(request)
+                logging.info("Task '%s' follows identical task '%s'", request.taskId, leader.taskId)
+                return leader
+
+            self.leaders[key] = request
+            self.lanes.setdefault(self.taskLane(request), deque()).append(
+                    (self.tailSequence.next(), request))
+            self.numRequests += 1
 
-        logging.info("Added task to model queue as number %d", len(self.requests))
+        logging.info("Added task to model queue as number %d", self.numRequests)
+        return request
 
     def putTaskHead(self, request):
         """Puts a model into queue at the head (useful for peeking)."""
         with self.lock:
-            self.requests.insert(0,request)
-
+            self.leaders[request.resultKey()] = request
+            self.lanes.setdefault(self.taskLane(request), deque()).appendleft(
+                    (self.headSequence.next(), request))
+            self.numRequests += 1
 
     def putProcessingTask(self, task):
         """Puts a model into the queue for worker processing."""
         now = time.time()
         with self.lock:
-            self.processingTasks.append((task, now))
-    
+            self.processingTasks[task.taskId] = (task, now)
+            self.pushLease(task.taskId, now)
+
+    def pushLease(self, taskId, leaseTime):
+        """Adds a lease entry to the heap, rebuilding it once stale entries dominate."""
+        heapq.heappush(self.leaseHeap, (leaseTime, taskId))
+        if len(self.leaseHeap) > 2 * len(self.processingTasks) + 64:
+            self.leaseHeap = [(t, taskId) for (taskId, (e, t)) in self.processingTasks.iteritems()]
+            heapq.heapify(self.leaseHeap)
+
+    def isLiveLease(self, entry):
+        leaseTime, taskId = entry
+        return taskId in self.processingTasks and self.processingTasks[taskId][1] == leaseTime
+
+    def popLane(self, laneKey):
+        """Pops the head of a given lane, discarding the lane once it is empty."""
+        lane = self.lanes[laneKey]
+        seq, task = lane.popleft()
+        if len(lane) == 0:
+            del self.lanes[laneKey]
+        self.numRequests -= 1
+        return task
+
     def pullNextVersioned(self, modelVersions):
-        """Pulls the next model from the worker queue that matches versions."""
+        """Pulls the next model from the worker queue that matches versions.
+
+        Only the heads of the lanes the worker supports are examined, so this
+        is proportional to the number of versions rather than the queue length.
+        """
+        versions = set(tuple(v) for v in modelVersions)
+        with self.lock:
+            heads = [(self.lanes[v][0][0], v) for v in versions if v in self.lanes]
+            if len(heads) == 0:
+                return None
+
+            seq, laneKey = min(heads)
+            return self.popLane(laneKey)
+
+    def leaseNextVersioned(self, modelVersions, maxTasks):
+        """Atomically moves up to maxTasks matching tasks into the processing set.
+
+        Returns the (possibly empty) list of tasks that were leased, oldest first.
+        Each task is given a fresh lease token.
+        """
+        leased = []
+        with self.lock:
+            while len(leased) < maxTasks:
+                task = self.pullNextVersioned(modelVersions)
+                if task == None:
+                    break
+
+                task.leaseToken = uuid.uuid4().hex
+                self.putProcessingTask(task)
+                leased.append(task)
+
+        return leased
+
+    def modelVersions(self):
+        """Returns the set of (model name, version) pairs of every pending or processing task."""
+        with self.lock:
+            versions = set(self.lanes)
+            versions.update(self.taskLane(task) for (task, taskTime) in self.processingTasks.itervalues())
+            return versions
+
+    def pullTasksNotMatching(self, modelVersions):
+        """Pulls every queued task whose (model name, version) is not in modelVersions."""
+        versions = set(tuple(v) for v in modelVersions)
         with self.lock:
-            for i,task in enumerate(self.requests):
-                if [task.__class__.short_name, task.__class__.version] in modelVersions:
-                    del self.requests[i]
-                    return task
+            pulled = []
+            for laneKey in [k for k in self.lanes if k not in versions]:
+                while laneKey in self.lanes:
+                    task = self.popLane(laneKey)
+                    if self.leaders.get(task.resultKey()) is task:
+                        del self.leaders[task.resultKey()]
+                    pulled.append(task)
 
-        return None
+            return pulled
 
-    
     def pullNextTask(self):
         """Pulls a model from the worker queue."""
         with self.lock:
-            return self.requests.pop(0)
+            if self.numRequests == 0:
+                raise IndexError("pop from empty queue")
 
-    def touchProcessingTaskById(self, taskId):
-        """Update timestamp on a task that is currently processing."""
+            seq, laneKey = min((lane[0][0], k) for (k, lane) in self.lanes.iteritems())
+            return self.popLane(laneKey)
+
+    def touchProcessingTaskById(self, taskId, leaseToken):
+        """Update timestamp on a task that is currently processing, provided the lease token matches."""
 
         now = time.time()
         with self.lock:
-            for i, (task, taskTime) in enumerate(self.processingTasks):
-                if task.taskId == taskId:
-                    self.processingTasks[i] = (task, now)
-                    break
-            else:
+            if taskId not in self.processingTasks:
                 raise TaskQueueException("Invalid id '%s'" % taskId)
 
+            task, taskTime = self.processingTasks[taskId]
+            if task.leaseToken != leaseToken:
+                raise TaskQueueException("Stale lease for id '%s'" % taskId)
+
+            self.processingTasks[taskId] = (task, now)
+            self.pushLease(taskId, now)
+
     def hasProcessingTaskById(self, taskId):
         with self.lock:
-            return any(e.taskId == taskId for (e,t) in self.processingTasks)
+            return taskId in self.processingTasks
+
+    def popProcessingTask(self, taskId):
+        """Removes a task from processing; identical requests will no longer follow it."""
+        task = self.processingTasks.pop(taskId)[0]
+        key = task.resultKey()
+        if self.leaders.get(key) is task:
+            del self.leaders[key]
+
+        return task
+
+    def oldestProcessingTime(self):
+        """Returns the timestamp of the stalest processing task, or None if nothing is processing."""
+        with self.lock:
+            while len(self.leaseHeap) > 0 and not self.isLiveLease(self.leaseHeap[0]):
+                heapq.heappop(self.leaseHeap)
+
+            if len(self.leaseHeap) == 0:
+                return None
+
+            return self.leaseHeap[0][0]
 
     def pullProcessingTasksOlderThan(self, oldTime):
         """Pulls tasks out of the processing queue that are stale."""
 
         with self.lock:
-            expireTasks = [e for (e,t) in self.processingTasks if t <= oldTime]
-            self.processingTasks = [(e,t) for (e,t) in self.processingTasks if t > oldTime]
+            expired = []
+            while len(self.leaseHeap) > 0 and self.leaseHeap[0][0] <= oldTime:
+                entry = heapq.heappop(self.leaseHeap)
+                if self.isLiveLease(entry):
+                    expired.append(self.popProcessingTask(entry[1]))
 
-            return expireTasks
+            return expired
 
-    def pullProcessingTaskById(self, taskId):
+    def pullProcessingTaskById(self, taskId, leaseToken):
+        """Pulls a task out of processing, provided the lease token matches."""
         with self.lock:
-            possibleTasks = [e for (e,t) in self.processingTasks if e.taskId == taskId]
-            self.processingTasks = [(e,t) for (e,t) in self.processingTasks if e.taskId != taskId]
+            if taskId not in self.processingTasks:
+                raise TaskQueueException("Invalid id '%s'" % taskId)
+
+            if self.processingTasks[taskId][0].leaseToken != leaseToken:
+                raise TaskQueueException("Stale lease for id '%s'" % taskId)
 
-            if len(possibleTasks) == 0:
+            return self.popProcessingTask(taskId)
+
+    def getProcessingTaskById(self, taskId):
+        with self.lock:
+            if taskId not in self.processingTasks:
                 raise TaskQueueException("Invalid id '%s'" % taskId)
 
-            return possibleTasks[0]
+            return self.processingTasks[taskId][0]
 
     def isEmpty(self):
         with self.lock:
-            return len(self.requests) == 0
+            return self.numRequests == 0
@@ -0,0 +1,119 @@
+# For distribution details, see LICENSE
+"""Module containing the lightweight task representation used by the queue daemon."""
+from email_manager import Email
+from config import config
+from model_task import parameterHash
+import model_manager
+
+class TaskRecord(object):
+    """A task as the queue sees it: a task dictionary (see ModelTask.asDict).
+
+    The queue never runs models, so it does not need model classes or
+    parameter objects to route, lease and persist tasks. A record exposes the
+    few fields the queue uses and only instantiates the real model task
+    (through the model manager) when it has to, e.g. to write a failure e-mail.
+
+    While the task is leased, leaseToken identifies the lease so that a
+    worker whose lease has since expired cannot complete the task.
+    """
+
+    def __init__(self, taskDict):
+        self.taskDict   = taskDict
+        self.key        = None
+        self.leaseToken = None
+        if "followers" not in self.taskDict:
+            self.taskDict["followers"] = []
+
+    @property
+    def taskId(self):
+        return self.taskDict["taskId"]
+
+    @taskId.setter
+    def taskId(self, taskId):
+        self.taskDict["taskId"] = taskId
+
+    @property
+    def failureCount(self):
+        return self.taskDict["failureCount"]
+
+    @failureCount.setter
+    def failureCount(self, failureCount):
+        self.taskDict["failureCount"] = failureCount
+
+    @property
+    def followers(self):
+        return self.taskDict["followers"]
+
+    @property
+    def emailAddress(self):
+        return self.taskDict["emailAddress"]
+
+    @property
+    def visibleId(self):
+        return self.taskDict["visibleId"]
+
+    @property
+    def modelName(self):
+        return self.taskDict["modelName"]
+
+    @property
+    def modelVersion(self):
+        return self.taskDict["modelVersion"]
+
+    def asDict(self):
+        """Returns a copy of the task dictionary, safe to hand to another thread."""
+        taskDict = dict(self.taskDict)
+        taskDict["followers"] = list(self.followers)
+        return taskDict
+
+    def resultKey(self):
+        """Returns a key identifying the results of this run (see parameterHash)."""
+        if self.key == None:
+            self.key = parameterHash(self.modelName, self.modelVersion, self.taskDict["modelParameters"])
+        return self.key
+
+    def followerDict(self):
+        """Returns the parts of this task that differ between identical requests."""
+        return {
+            "emailAddress": self.emailAddress,
+            "taskId":       self.taskId,
+            "visibleId":    self.visibleId
+        }
+
+    def addFollower(self, record):
+        """Attaches an identical task (and its own followers) to this one, so that it is not rerun."""
+        known = set(f["taskId"] for f in self.followers)
+        known.add(self.taskId)
+        for follower in [record.followerDict()] + record.followers:
+            if follower["taskId"] not in known:
+                known.add(follower["taskId"])
+                self.followers.append(follower)
+
+    def followerTasks(self):
+        """Returns records for the followers of this task."""
+        records = []
+        for follower in self.followers:
+            taskDict = self.asDict()
+            taskDict.update(follower)
+            taskDict["followers"] = []
+            records.append(TaskRecord(taskDict))
+
+        return records
+
+    def task(self):
+        """Instantiates the model task, raising InvalidModelError if its model is not loaded."""
+        return model_manager.modelManager.getModelFromTaskDict(self.taskDict)
+
+    def failureEmail(self):
+        """Returns the model's failure e-mail, or a lost task e-mail if the model is gone."""
+        try:
+            return self.task().failureEmail()
+        except model_manager.InvalidModelError:
+            return self.lostEmail()
+
+    def lostEmail(self):
+        """Returns an e-mail telling the requester that the model of this task no longer exists."""
+        subject = config.lostTaskEmailSubject.generate(full_name=self.taskDict["modelFullName"],
+                visibleId=self.visibleId)
+        body = config.lostTaskEmailTemplate.generate()
+        return Email(self.emailAddress, subject, body)
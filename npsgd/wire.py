@@ -0,0 +1,138 @@
+# For distribution details, see LICENSE
+"""Message codec for requests between the NPSGD daemons.
+
+Requests to the queue were originally form-encoded, with structured values
+(tasks, model versions, leases) embedded as JSON strings under a '_json'
+suffixed name. A request may instead carry its arguments as one message in
+the body, encoded as msgpack (when msgpack 0.5.2 or later is installed) or
+compact JSON. The format is given by the Content-Type of the body, which also
+carries the codec version, e.g. "application/x-msgpack; npsgd-wire=1".
+Responses are encoded the same way when the Accept header asks for it, and
+are plain JSON otherwise, so older clients keep working.
+"""
+import json
+import urllib
+from config import config
+
+#Strings must decode to unicode (as they do from JSON), which needs the
+#raw=False option of msgpack 0.5.2. Older versions are treated as missing.
+msgpackMinimumVersion = (0, 5, 2)
+try:
+    import msgpack
+    if msgpack.version < msgpackMinimumVersion:
+        msgpack = None
+except ImportError:
+    msgpack = None
+
+wireVersion = 1
+contentTypes = {
+    "msgpack": "application/x-msgpack",
+    "json":    "application/json"
+}
+
+class WireError(ValueError): pass
+
+def requestFormat():
+    """Returns the format to send requests in ("msgpack", "json" or None for forms), from the config."""
+    if config.queueWireFormat == "form":
+        return None
+    elif config.queueWireFormat == "auto":
+        return "msgpack" if msgpack != None else "json"
+    elif config.queueWireFormat == "msgpack" and msgpack == None:
+        raise WireError("queueWireFormat is msgpack but msgpack %s or later is not installed" % \
+                ".".join(str(v) for v in msgpackMinimumVersion))
+
+    return config.queueWireFormat
+
+def contentType(format):
+    return "%s; npsgd-wire=%d" % (contentTypes[format], wireVersion)
+
+def parseContentType(header):
+    """Returns the (format, version) of a Content-Type header, with a format of None if it is not a message."""
+    parts = [p.strip() for p in (header or "").split(";")]
+    format = None
+    for f, mimeType in contentTypes.iteritems():
+        if parts[0].lower() == mimeType:
+            format = f
+
+    version = None
+    for part in parts[1:]:
+        if part.startswith("npsgd-wire="):
+            try:
+                version = int(part[len("npsgd-wire="):])
+            except ValueError:
+                raise WireError("Bad wire version in '%s'" % header)
+
+    return format, version
+
+def isMessage(header):
+    return parseContentType(header)[0] != None
+
+def acceptedFormat(acceptHeader):
+    """Returns the format a response should be sent in for an Accept header, or None for plain JSON."""
+    accept = (acceptHeader or "").lower()
+    if msgpack != None and contentTypes["msgpack"] in accept:
+        return "msgpack"
+    elif contentTypes["json"] in accept:
+        return "json"
+
+    return None
+
+def encode(message, format):
+    """Encodes a message, returning the body and its Content-Type."""
+    if format == "msgpack":
+        body = msgpack.packb(message)
+    else:
+        body = json.dumps(message, separators=(",", ":"))
+
+    return body, contentType(format)
+
+def decode(body, header):
+    """Decodes a message body given its Content-Type, raising a WireError if it cannot be read."""
+    format, version = parseContentType(header)
+    if format == None:
+        raise WireError("Not a message: '%s'" % header)
+
+    if version != None and version > wireVersion:
+        raise WireError("Unsupported wire version %d" % version)
+
+    try:
+        if format == "msgpack":
+            if msgpack == None:
+                raise WireError("Received msgpack but the msgpack module is not installed")
+            return msgpack.unpackb(body, raw=False)
+        else:
+            return json.loads(body)
+    except WireError:
+        raise
+    except Exception, e:
+        raise WireError("Bad %s message: %s" % (format, e))
+
+def formArguments(params):
+    """Converts a message to form arguments, JSON encoding structured values under '<name>_json'."""
+    arguments = {}
+    for name, value in params.iteritems():
+        if isinstance(value, (list, tuple, dict)):
+            arguments["%s_json" % name] = json.dumps(value, separators=(",", ":"))
+        else:
+            arguments[name] = value
+
+    return arguments
+
+def encodeRequest(params, format):
+    """Returns the (body, headers) of a POST of params, in the given format or as a form if it is None."""
+    if format == None:
+        return urllib.urlencode(formArguments(params)), {"Content-Type": "application/x-www-form-urlencoded"}
+
+    body, header = encode(params, format)
+    return body, {"Content-Type": header, "Accept": header}
+
+def decodeResponse(body, header):
+    """Decodes a response: a message if its Content-Type says so, JSON otherwise."""
+    if isMessage(header):
+        return decode(body, header)
+
+    try:
+        return json.loads(body)
+    except ValueError, e:
+        raise WireError("Bad response: %s" % e)
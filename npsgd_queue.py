@@ -12,9 +12,9 @@ responsible for sending out confirmation code e-mail messages.
 """
 import os
 import sys
-import anydbm
-import shelve
+import time
 import logging
+import functools
 import tornado.web
 import tornado.ioloop
 import tornado.escape
@@ -26,10 +26,14 @@ from optparse import OptionParser
 import npsgd.email_manager
 from npsgd.email_manager import Email
 from npsgd import model_manager
+from npsgd import wire
 from npsgd.config import config
 from npsgd.task_queue import TaskQueue
 from npsgd.task_queue import TaskQueueException
-from npsgd.confirmation_map import ConfirmationMap
+from npsgd.task_record import TaskRecord
+from npsgd.confirmation_map import ConfirmationMap, RecentCodeSet
+from npsgd.queue_store import QueueState, QueueStoreWriter
+from npsgd.queue_store import ShelveQueueStore, JournalQueueStore, SqliteQueueStore
 from npsgd.model_manager import modelManager
 
 glb = None
@@ -37,191 +41,333 @@ glb = None
 
 class QueueGlobals(object):
     """Queue state objects along with disk serialization mechanisms for them."""
+    confirmSweepBatch = 1000
 
-    def __init__(self, shelve):
-        self.shelve          = shelve
-        self.shelveLock      = threading.RLock() 
+    def __init__(self, store):
         self.idLock          = threading.RLock()
         self.taskQueue       = TaskQueue()
         self.confirmationMap = ConfirmationMap()
-        if shelve.has_key("idCounter"):
-            self.idCounter = shelve["idCounter"]
-        else:
-            self.idCounter = 0
-
-        self.loadDiskTaskQueue()
-        self.loadConfirmationMap()
-        self.expireWorkerTaskThread = ExpireWorkerTaskThread(self.taskQueue)
+        self.confirmedCodes  = RecentCodeSet(config.confirmedCodeTimeout.total_seconds())
+
+        state = store.load()
+        self.idCounter = state.idCounter
+        self.loadDiskTaskQueue(state.tasks.values())
+        self.loadConfirmationMap(state.confirmations)
+        self.confirmedCodes.load(state.confirmedCodes)
+
+        self.store = None
+        self.ioloop = tornado.ioloop.IOLoop.instance()
+        store.setStateSource(self.currentState)
+        self.store = QueueStoreWriter(store, config.queueFlushInterval, config.queueFlushBatchSize)
+        self.store.start()
+        self.waitingWorkers = []
+        self.leaseTimeout = None
+        self.confirmationSweeper = tornado.ioloop.PeriodicCallback(self.expireConfirmations,
+                config.confirmSweepInterval * 1000, self.ioloop)
+        self.confirmationSweeper.start()
         self.lastWorkerCheckin = datetime(1,1,1)
+        self.workerSlots = {}
+        self.modelsLoaded = False
 
-    def loadDiskTaskQueue(self):
-        """Load task queue from disk using the shelve reserved for the queue."""
+    def loadDiskTaskQueue(self, taskDicts):
+        """Load task queue from the task dictionaries read by the queue store.
 
-        if not self.shelve.has_key("taskQueue"):
-            logging.info("Unable to read task queue from disk db, starting fresh")
-            return
+        Tasks are kept as raw records; whether their models still exist is only
+        checked once the models have been loaded (see dropLostTasks).
+        """
 
         logging.info("Reading task queue from disk")
-        readTasks   = 0
-        failedTasks = 0
-        taskDicts = self.shelve["taskQueue"]
         for taskDict in taskDicts:
-            try:
-                task = modelManager.getModelFromTaskDict(taskDict)
-            except model_manager.InvalidModelError, e:
-                emailAddress = taskDict["emailAddress"]
-                subject = config.lostTaskEmailSubject.generate(full_name=taskDict["modelFullName"], 
-                        visibleId=taskDict["visibleId"])
-                body = config.lostTaskEmailTemplate.generate()
-                emailObject = Email(emailAddress, subject, body)
-                logging.info("Invalid model-version pair, notifying %s", emailAddress)
-                npsgd.email_manager.backgroundEmailSend(Email(emailAddress, subject, body))
-                failedTasks += 1
-                continue
-            
-            readTasks += 1
-            self.taskQueue.putTask(task)
-
-        logging.info("Read %s tasks, failed while reading %s tasks", readTasks, failedTasks)
+            self.taskQueue.putTask(TaskRecord(taskDict))
 
-    def loadConfirmationMap(self):
-        """Load confirmation map ([code, modelDict] pairs) from shelve reserved for the queue."""
+        logging.info("Read %s tasks", len(taskDicts))
 
-        if not self.shelve.has_key("confirmationMap"):
-            logging.info("Unable to read confirmation map from disk db, starting fresh")
-            return
+    def loadConfirmationMap(self, confirmationMapEntries):
+        """Load confirmation map (code -> modelDict) from the entries read by the queue store."""
 
         logging.info("Reading confirmation map from disk")
-        confirmationMapEntries = self.shelve["confirmationMap"]
-
-        readCodes = 0
-        failedCodes = 0
         for code, taskDict in confirmationMapEntries.iteritems():
-            try:
-                task = modelManager.getModelFromTaskDict(taskDict)
-            except model_manager.InvalidModelError, e:
-                emailAddress = taskDict["emailAddress"]
-                subject = config.confirmationFailedEmailSubject.generate(full_name=taskDict["modelFullName"], 
-                        visibleId=taskDict["visibleId"])
-                body = config.confirmationFailedEmailTemplate.generate(code=code)
-                emailObject = Email(emailAddress, subject, body)
-                logging.info("Invalid model-version pair, notifying %s", emailAddress)
-                npsgd.email_manager.backgroundEmailSend(Email(emailAddress, subject, body))
-                failedCodes += 1
-                continue
+            self.confirmationMap.putRequestWithCode(TaskRecord(taskDict), code)
+
+        logging.info("Read %s codes", len(confirmationMapEntries))
+
+    def loadModels(self):
+        """Loads the models (in a background thread) so the port can open right away."""
+        model_manager.useManifests()
+        model_manager.setupModels()
+        self.ioloop.add_callback(self.dropLostTasks)
+        model_manager.setVersionReferences(self.referencedVersions)
+        model_manager.startScannerThread()
+
+    def referencedVersions(self):
+        """Returns the (model name, version) pairs of every task the queue holds (thread safe)."""
+        return self.taskQueue.modelVersions() | self.confirmationMap.modelVersions()
+
+    def dropLostTasks(self):
+        """Drops tasks and codes whose model version no longer exists, notifying their requesters."""
+        versions = set(modelManager.modelVersions())
+        lostTasks = self.taskQueue.pullTasksNotMatching(versions)
+        for task in lostTasks:
+            for t in [task] + task.followerTasks():
+                logging.info("Invalid model-version pair, notifying %s", t.emailAddress)
+                npsgd.email_manager.backgroundEmailSend(t.lostEmail())
+                self.store.taskExpired(t.taskId, None)
+
+        lostCodes = self.confirmationMap.pullRequestsMatching(
+                lambda request: (request.modelName, request.modelVersion) not in versions)
+        for code, request in lostCodes:
+            subject = config.confirmationFailedEmailSubject.generate(full_name=request.taskDict["modelFullName"],
+                    visibleId=request.visibleId)
+            body = config.confirmationFailedEmailTemplate.generate(code=code)
+            logging.info("Invalid model-version pair, notifying %s", request.emailAddress)
+            npsgd.email_manager.backgroundEmailSend(Email(request.emailAddress, subject, body))
+        self.store.confirmationsExpired([code for (code, request) in lostCodes])
+
+        logging.info("Models loaded, dropped %d lost tasks and %d lost codes", len(lostTasks), len(lostCodes))
+        self.modelsLoaded = True
+
+    def currentState(self):
+        """Returns a serializable image of the task queue, confirmation map, confirmed codes and id counter.
+
+        The store asks for this from its writer thread. The image is then built
+        on the IOLoop, between two handlers, so that it never catches a change
+        half made (e.g. a task already out of the confirmation map but not yet
+        in the task queue).
+        """
+        if threading.current_thread() is not self.store or not self.ioloop.running():
+            return self.buildState()
 
-            readCodes += 1
-            self.confirmationMap.putRequestWithCode(task, code)
+        built = threading.Event()
+        states = []
+        def build():
+            states.append(self.buildState())
+            built.set()
 
-        logging.info("Read %s codes, failed while reading %s codes", readCodes, failedCodes)
+        self.ioloop.add_callback(build)
+        while not built.wait(1):
+            if not self.ioloop.running():
+                return self.buildState()
 
+        return states[0]
 
-    def syncShelve(self):
-        """Serializes the task queue, confirmation map and id counter to disk using the queue shelve."""
-        try:
-            with self.shelveLock:
-                self.shelve["taskQueue"]        = [e.asDict() \
-                        for e in self.taskQueue.allRequests()]
-                self.shelve["confirmationMap"]  = dict( (code, task.asDict())\
-                        for (code, task) in self.confirmationMap.getRequestsWithCodes())
-
-                with self.idLock:
-                    self.shelve["idCounter"] = self.idCounter
-        except pickle.PicklingError, e:
-            logging.warning("Unable sync task queue and confirmation error to disk due to a pickling (serialization error): %s", e)
+    def buildState(self):
+        with self.idLock:
+            idCounter = self.idCounter
+
+        return QueueState(idCounter,
+                [e.asDict() for e in self.taskQueue.allRequests()],
+                dict((code, task.asDict()) for (code, task) in self.confirmationMap.getRequestsWithCodes()),
+                self.confirmedCodes.entries())
+
+    def expireConfirmations(self):
+        """Sweeps expired confirmation codes in bounded batches (IOLoop thread only).
+
+        A full batch yields back to the IOLoop and continues on the next
+        iteration so a large backlog of codes never stalls request handling.
+        """
+        self.confirmedCodes.prune()
+        codes = self.confirmationMap.expireConfirmations(self.confirmSweepBatch)
+        self.store.confirmationsExpired(codes)
+        if len(codes) == self.confirmSweepBatch:
+            self.ioloop.add_callback(self.expireConfirmations)
+
+    def dispatchWaitingWorkers(self):
+        """Hands queued tasks to workers that are blocked in a long poll (IOLoop thread only)."""
+        for handler in list(self.waitingWorkers):
+            if self.taskQueue.isEmpty():
+                break
+
+            if handler.leaseTasks():
+                self.waitingWorkers.remove(handler)
+
+    def scheduleLeaseExpiry(self):
+        """Arms a timeout for the moment the stalest lease would expire (IOLoop thread only).
+
+        Leases that are renewed in the meantime are skipped when the timeout
+        fires, which then re-arms itself for the next stalest lease. No timeout
+        is armed while nothing is processing.
+        """
+        if self.leaseTimeout is not None:
             return
 
-        logging.info("Synced queue and confirmation map to disk")
+        oldest = self.taskQueue.oldestProcessingTime()
+        if oldest != None:
+            self.leaseTimeout = self.ioloop.add_timeout(oldest + config.keepAliveTimeout, self.expireLeases)
+
+    def expireLeases(self):
+        """Moves tasks whose workers stopped checking in back into the queue."""
+        self.leaseTimeout = None
+        badTasks = self.taskQueue.pullProcessingTasksOlderThan(time.time() - config.keepAliveTimeout)
+        if len(badTasks) > 0:
+            logging.info("Found %d tasks to expire", len(badTasks))
+
+        for task in badTasks:
+            task.failureCount += 1
+            oldTaskId = task.taskId
+            logging.warning("Task '%s' failed due to timeout (failure #%d)", task.taskId, task.failureCount)
+            if task.failureCount > config.maxJobFailures:
+                logging.warning("Exceeded max job failures, sending fail email")
+                self.sendFailureEmails(task)
+                self.store.taskExpired(oldTaskId, None)
+                for follower in task.followers:
+                    self.store.taskExpired(follower["taskId"], None)
+            else:
+                logging.warning("Inserting task back in to queue with new taskId")
+                task.taskId = self.newTaskId()
+                self.taskQueue.putTask(task)
+                self.store.taskExpired(oldTaskId, task.asDict())
 
-    def touchWorkerCheckin(self):
-        self.lastWorkerCheckin = datetime.now()
+        if len(badTasks) > 0:
+            self.dispatchWaitingWorkers()
+        self.scheduleLeaseExpiry()
 
-    def newTaskId(self):
-        with self.idLock:
-            self.idCounter += 1
-            return self.idCounter
+    def releaseTasks(self, tasks):
+        """Puts leased tasks that never reached their worker back at the head of the queue.
 
-class ExpireWorkerTaskThread(threading.Thread):
-    """Task Expiration Thread
+        This is not a failure of the task, so its failure count is left alone.
+        Tasks that were completed, failed or expired in the meantime are skipped.
+        """
+        for task in reversed(tasks):
+            try:
+                self.taskQueue.pullProcessingTaskById(task.taskId, task.leaseToken)
+            except TaskQueueException:
+                continue
 
-    Moves tasks back into the queue whenever
-    We haven't heard from a worker in a while
-    """
+            logging.info("Returning task '%s' to the queue, its worker never received it", task.taskId)
+            task.leaseToken = None
+            self.taskQueue.putTaskHead(task)
+            self.store.taskFailed(task.taskId, task.asDict())
 
-    def __init__(self, taskQueue):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.taskQueue = taskQueue
-        self.done = threading.Event()
+    def sendFailureEmails(self, task):
+        """Tells the requester of a task, and everyone following it, that it failed."""
+        for t in [task] + task.followerTasks():
+            npsgd.email_manager.backgroundEmailSend(t.failureEmail())
 
-    def run(self):
-        logging.info("Expire worker task thread booting up...")
+    def touchWorkerCheckin(self):
+        self.lastWorkerCheckin = datetime.now()
 
-        while True:
-            self.done.wait(config.keepAliveInterval)
-            if self.done.isSet():
-                break
+    def registerWorker(self, handler):
+        """Records the number of execution slots a worker reports (if it does)."""
+        workerId = handler.argument("worker_id", None)
+        if workerId != None:
+            self.workerSlots[workerId] = (int(handler.argument("slots", 1)), time.time())
 
-            badTasks = self.taskQueue.pullProcessingTasksOlderThan(
-                    time.time() - config.keepAliveTimeout)
+    def liveWorkerSlots(self):
+        """Total execution slots of workers heard from within the keep alive timeout."""
+        cutoff = time.time() - config.keepAliveTimeout
+        for workerId, (slots, lastSeen) in self.workerSlots.items():
+            if lastSeen < cutoff:
+                del self.workerSlots[workerId]
 
-            if len(badTasks) > 0:
-                logging.info("Found %d tasks to expire", len(badTasks))
+        return sum(slots for (slots, lastSeen) in self.workerSlots.itervalues())
 
-            for task in badTasks:
-                task.failureCount += 1
-                logging.warning("Task '%s' failed due to timeout (failure #%d)", task.taskId, task.failureCount)
-                if task.failureCount > config.maxJobFailures:
-                    logging.warning("Exceeded max job failures, sending fail email")
-                    npsgd.email_manager.backgroundEmailSend(task.failureEmail())
-                else:
-                    logging.warning("Inserting task back in to queue with new taskId")
-                    task.taskId = glb.newTaskId()
-                    self.taskQueue.putTask(task)
+    def newTaskId(self):
+        with self.idLock:
+            self.idCounter += 1
+            return self.idCounter
 
 class QueueRequestHandler(tornado.web.RequestHandler):
-    """Superclass to all queue request methods."""
+    """Superclass to all queue request methods.
+
+    Arguments may arrive form-encoded or as a single message in the request
+    body (see npsgd.wire), and are read the same way either way with argument.
+    Responses written through respond are encoded to match the request.
+    """
     def checkSecret(self):
         """Checks the request for a 'secret' parameter that matches the queue's own."""
-        if self.get_argument("secret") == config.requestSecret:
+        if self.argument("secret") == config.requestSecret:
             return True
         else:
-            self.write(tornado.escape.json_encode({"error": "bad_secret"}))
+            self.respond({"error": "bad_secret"})
             return False
 
+    def message(self):
+        """Returns the decoded message in the request body, or None if the request is form-encoded."""
+        if not hasattr(self, "requestMessage"):
+            self.requestMessage = None
+            contentType = self.request.headers.get("Content-Type")
+            try:
+                if wire.isMessage(contentType):
+                    self.requestMessage = wire.decode(self.request.body, contentType)
+            except wire.WireError, e:
+                logging.warning("Bad request message: %s", e)
+                raise tornado.web.HTTPError(415)
+
+        return self.requestMessage
+
+    def argument(self, name, *default):
+        """Returns a request argument (structured values come JSON-encoded as '<name>_json' in forms).
+
+        Like get_argument, a missing argument without a default is an error.
+        """
+        message = self.message()
+        if message != None:
+            if name in message:
+                return message[name]
+            elif len(default) > 0:
+                return default[0]
+            raise tornado.web.HTTPError(400, "Missing argument %s" % name)
+
+        if "%s_json" % name in self.request.arguments:
+            return tornado.escape.json_decode(self.get_argument("%s_json" % name))
+
+        return self.get_argument(name, *default)
+
+    def respond(self, response):
+        """Writes a response, as a message if the request accepts one and as plain JSON otherwise."""
+        format = wire.acceptedFormat(self.request.headers.get("Accept"))
+        if format == None:
+            self.write(tornado.escape.json_encode(response))
+            return
+
+        body, contentType = wire.encode(response, format)
+        self.set_header("Content-Type", contentType)
+        self.write(body)
+
 class ClientModelCreate(QueueRequestHandler):
     """HTTP handler for clients creating a model request (before confirmation)."""
 
+    @tornado.web.asynchronous
     def post(self):
         """Post handler for model requests from the web daemon.
 
         Attempts to build a model from its known models (essentially performing
         parameter verification) then places a request in the queue if it succeeds.
         Additionally, it will send out an e-mail to the user for confirmation of
-        the request
+        the request. The response is only written once the request has been
+        committed to disk.
         """
 
         if not self.checkSecret():
+            self.finish()
             return
 
-        task_json = tornado.escape.json_decode(self.get_argument("task_json"))
-        task = modelManager.getModelFromTaskDict(task_json)
+        if not glb.modelsLoaded:
+            raise tornado.web.HTTPError(503)
+
+        task = modelManager.getModelFromTaskDict(self.argument("task"))
         task.taskId = glb.newTaskId()
-        code = glb.confirmationMap.putRequest(task)
+        code = glb.confirmationMap.putRequest(TaskRecord(task.asDict()))
 
         emailAddress = task.emailAddress
         logging.info("Generated a request for %s, confirmation %s required", emailAddress, code)
         subject = config.confirmEmailSubject.generate(task=task)
         body = config.confirmEmailTemplate.generate(code=code, task=task, expireDelta=config.confirmTimeout)
         emailObject = Email(emailAddress, subject, body)
+        glb.store.taskCreated(code, task.asDict())
+        #Only hand out the code once the queue can no longer forget it
+        glb.store.flush(functools.partial(glb.ioloop.add_callback,
+                functools.partial(self.creationDurable, task, code, emailObject)))
+
+    def creationDurable(self, task, code, emailObject):
         npsgd.email_manager.backgroundEmailSend(emailObject)
-        glb.syncShelve()
-        self.write(tornado.escape.json_encode({
+        self.respond({
             "response": {
                 "task" : task.asDict(),
                 "code" : code
             }    
-        }))
+        })
+        self.finish()
 
 class ClientQueueHasWorkers(QueueRequestHandler):
     """Request handler for the web daemon to check if workers are available.
@@ -237,45 +383,52 @@ class ClientQueueHasWorkers(QueueRequestHandler):
         td = datetime.now() - glb.lastWorkerCheckin
         hasWorkers = (td.seconds + td.days * 24 * 3600) < config.keepAliveTimeout
 
-        self.write(tornado.escape.json_encode({
+        self.respond({
             "response": {
-                "has_workers" : hasWorkers
+                "has_workers"  : hasWorkers,
+                "worker_slots" : glb.liveWorkerSlots()
             }    
-        }))
+        })
 
 
-previouslyConfirmed = set()
 class ClientConfirm(QueueRequestHandler):
     """HTTP handler for clients confirming a model request.
     
     This handler moves requests from the confirmation map to the general
-    request queue for processing.
+    request queue for processing. The response is only written once the
+    confirmation has been committed to disk.
     """
+    @tornado.web.asynchronous
     def get(self, code):
-        global previouslyConfirmed
-
         if not self.checkSecret():
+            self.finish()
             return
 
         try:
-            #Expire old confirmations first, just in case
-            glb.confirmationMap.expireConfirmations()
             confirmedRequest = glb.confirmationMap.getRequest(code)
-            previouslyConfirmed.add(code)
+            glb.confirmedCodes.add(code)
         except KeyError, e:
-            if code in previouslyConfirmed:
-                self.write(tornado.escape.json_encode({
+            if code in glb.confirmedCodes:
+                self.respond({
                     "response": "already_confirmed"
-                }))
+                })
+                self.finish()
                 return
             else:
                 raise tornado.web.HTTPError(404)
 
-        glb.taskQueue.putTask(confirmedRequest)
-        glb.syncShelve()
-        self.write(tornado.escape.json_encode({
+        leader = glb.taskQueue.putTask(confirmedRequest)
+        glb.store.taskConfirmed(code, confirmedRequest.taskId)
+        if leader is not confirmedRequest:
+            glb.store.taskFollowed(confirmedRequest.taskId, leader.taskId)
+        glb.dispatchWaitingWorkers()
+        glb.store.flush(functools.partial(glb.ioloop.add_callback, self.confirmationDurable))
+
+    def confirmationDurable(self):
+        self.respond({
             "response": "okay"
-        }))
+        })
+        self.finish()
 
 
 class WorkerInfo(QueueRequestHandler):
@@ -286,67 +439,60 @@ class WorkerInfo(QueueRequestHandler):
             return
 
         glb.touchWorkerCheckin()
-        self.write("{}")
+        glb.registerWorker(self)
+        self.respond({})
 
-class WorkerTaskKeepAlive(QueueRequestHandler):
-    """HTTP handler for workers pinging the queue while working on a task.
-    
-    Having this request makes sure that we don't time out any jobs that 
-    are currently being handled by some worker. If a worker goes down,
-    we will put the job back into the queue because this request won't have
-    been made.
+class WorkerModelVersions(QueueRequestHandler):
+    """HTTP handler for workers asking which model versions are still in use.
+
+    Workers keep old model versions loaded while the queue holds tasks for them.
     """
-    def get(self, taskIdString):
+
+    def get(self):
         if not self.checkSecret():
             return
-        glb.touchWorkerCheckin()
-        taskId = int(taskIdString)
-        logging.info("Got heartbeat for task id '%s'", taskId)
-        try:
-            task = glb.taskQueue.touchProcessingTaskById(taskId)
-        except TaskQueueException, e:
-            logging.info("Bad keep alive request: no such task id '%s' exists" % taskId)
-            self.write(tornado.escape.json_encode({
-                "error": {"type" : "bad_id" }
-            }))
 
-        self.write("{}")
+        self.respond({
+            "response": {"versions": list(glb.referencedVersions())}
+        })
 
-class WorkerSucceededTask(QueueRequestHandler):
-    """HTTP handler for workers telling the queue that they have succeeded processing.
+class WorkerHeartbeat(QueueRequestHandler):
+    """HTTP handler for the single periodic heartbeat of a worker.
 
-    After this request, the queue no longer needs to keep track of the job in any way
-    and declares it complete.
+    The worker lists the (task id, lease token) pairs of every task it is
+    running and all of their leases are renewed at once. The response lists
+    the task ids whose leases are no longer valid, so the worker can stop
+    working on them.
     """
 
-    def get(self, taskIdString):
+    def post(self):
         if not self.checkSecret():
             return
-        glb.touchWorkerCheckin()
-        taskId = int(taskIdString)
-        try:
-            task = glb.taskQueue.pullProcessingTaskById(taskId)
-        except TaskQueueException, e:
-            logging.info("Bad succeed request: no task id exists")
-            self.write(tornado.escape.json_encode({
-                "error": {"type" : "bad_id" }
-            }))
-            return
-
-        glb.syncShelve()
-        self.write(tornado.escape.json_encode({
-            "status": "okay"
-        }))
 
-class WorkerHasTask(QueueRequestHandler):
-    """HTTP handler for workers ensuring that a job still exists.
-
-    This handler helps eliminate certain race conditions in NPSGD. Before a 
-    worker sends an e-mail with job results, it checks back with the queue to
-    make sure that the job hasn't already been handler by another worker
-    (this could happen if the queue declares that the first worker had timed out).
-    If there is no task with that id still in the processing list then 
-    an e-mail being sent out would be a duplicate.
+        glb.touchWorkerCheckin()
+        glb.registerWorker(self)
+        leases = self.argument("leases")
+        revoked = []
+        for taskId, leaseToken in leases:
+            try:
+                glb.taskQueue.touchProcessingTaskById(taskId, leaseToken)
+            except TaskQueueException, e:
+                logging.info("Revoking lease on task '%s': %s", taskId, e)
+                revoked.append(taskId)
+
+        logging.info("Got heartbeat for %d tasks (%d revoked)", len(leases), len(revoked))
+        self.respond({
+            "revoked": revoked
+        })
+
+class WorkerCompleteTask(QueueRequestHandler):
+    """HTTP handler for workers claiming the right to deliver the results of a task.
+
+    The worker presents the lease token it was handed with the task. If the
+    lease is still current the task is completed on the spot and the worker
+    is told to send the results (to the requester and everyone following the
+    task). A lease that has expired, or been handed to another worker since,
+    gets a "no", so results are only ever delivered once.
     """
 
     def get(self, taskIdString):
@@ -355,15 +501,22 @@ class WorkerHasTask(QueueRequestHandler):
 
         glb.touchWorkerCheckin()
         taskId = int(taskIdString)
-        logging.info("Got 'has task' request for task of id '%d'", taskId)
-        if glb.taskQueue.hasProcessingTaskById(taskId):
-            self.write(tornado.escape.json_encode({
-                "response": "yes"
-            }))
-        else:
-            self.write(tornado.escape.json_encode({
+        try:
+            task = glb.taskQueue.pullProcessingTaskById(taskId, self.argument("lease_token"))
+        except TaskQueueException, e:
+            logging.info("Refusing to complete task '%s': %s", taskId, e)
+            self.respond({
                 "response": "no"
-            }))
+            })
+            return
+
+        glb.store.taskCompleted(taskId)
+        for follower in task.followers:
+            glb.store.taskCompleted(follower["taskId"])
+        self.respond({
+            "response": "yes",
+            "followers": task.followers
+        })
 
 class WorkerFailedTask(QueueRequestHandler):
     """HTTP handler for workers reporting failure to complete a job.
@@ -379,12 +532,12 @@ class WorkerFailedTask(QueueRequestHandler):
         glb.touchWorkerCheckin()
         taskId = int(taskIdString)
         try:
-            task = glb.taskQueue.pullProcessingTaskById(taskId)
+            task = glb.taskQueue.pullProcessingTaskById(taskId, self.argument("lease_token"))
         except TaskQueueException, e:
             logging.info("Bad failed request: no such task id exists, ignoring request")
-            self.write(tornado.escape.json_encode({
+            self.respond({
                 "error": {"type" : "bad_id" }
-            }))
+            })
             return
 
         task.failureCount += 1
@@ -393,42 +546,131 @@ class WorkerFailedTask(QueueRequestHandler):
 
         if task.failureCount >= config.maxJobFailures:
             logging.warning("Max job failures found, sending failure email")
-            npsgd.email_manager.backgroundEmailSend(task.failureEmail())
+            glb.sendFailureEmails(task)
+            glb.store.taskFailed(taskId, None)
+            for follower in task.followers:
+                glb.store.taskFailed(follower["taskId"], None)
         else:
             logging.warning("Returning task to queue for another attempt")
             glb.taskQueue.putTask(task)
+            glb.store.taskFailed(taskId, task.asDict())
+            glb.dispatchWaitingWorkers()
 
-        self.write(tornado.escape.json_encode({
+        self.respond({
             "status": "okay"
-        }))
+        })
 
 
 class WorkerTaskRequest(QueueRequestHandler):
-    """HTTP handler for workers grabbings tasks off the queue."""
+    """HTTP handler for workers grabbings tasks off the queue.
+
+    Workers may pass a 'wait' argument (in seconds). If no task matching their
+    model versions is available, the request is then held open (a long poll)
+    until one is queued or the wait runs out.
+
+    Workers may also pass 'max_tasks' to lease up to that many tasks in one
+    request, in which case the response holds a list under 'tasks' rather
+    than a single 'task'.
+    """
+
+    @tornado.web.asynchronous
     def post(self):
         if not self.checkSecret():
+            self.finish()
             return
 
-        modelVersions = tornado.escape.json_decode(self.get_argument("model_versions_json"))
+        self.modelVersions = self.argument("model_versions")
+        self.batched       = self.argument("max_tasks", None) != None
+        self.maxTasks      = max(1, int(self.argument("max_tasks", 1)))
+        self.timeout       = None
+        wait = min(float(self.argument("wait", 0)), config.longPollTimeout)
 
         glb.touchWorkerCheckin()
-        logging.info("Received worker task request with models %s", modelVersions)
+        glb.registerWorker(self)
+        logging.info("Received worker task request for %d tasks with models %s", self.maxTasks, self.modelVersions)
+        if self.leaseTasks():
+            return
+        elif wait > 0:
+            self.timeout = glb.ioloop.add_timeout(time.time() + wait, self.waitExpired)
+            glb.waitingWorkers.append(self)
+        else:
+            self.sendNoTask()
+
+    def leaseTasks(self):
+        """Leases tasks for this worker and responds, returning False if there were none.
+
+        Tasks are released again if the worker hangs up before the response
+        is written out (see responseLost).
+        """
+        tasks = glb.taskQueue.leaseNextVersioned(self.modelVersions, self.maxTasks)
+        if len(tasks) == 0:
+            return False
+
+        if self.timeout is not None:
+            glb.ioloop.remove_timeout(self.timeout)
+            self.timeout = None
+
+        stream = self.request.connection.stream
+        if stream.closed():
+            logging.info("Worker hung up before its tasks were sent")
+            glb.releaseTasks(tasks)
+            return True
+
+        for task in tasks:
+            glb.store.taskLeased(task.taskId)
+        glb.scheduleLeaseExpiry()
+
+        taskDicts = [task.asDict() for task in tasks]
+        for task, taskDict in zip(tasks, taskDicts):
+            taskDict["leaseToken"] = task.leaseToken
+
+        if self.batched:
+            self.respond({
+                "tasks": taskDicts
+            })
+        else:
+            self.respond({
+                "task": taskDicts[0]
+            })
+        self.finish()
+
+        #finish clears our close callback, watch the connection until the response is out
+        if stream.writing():
+            stream.set_close_callback(functools.partial(self.responseLost, tasks))
+
+        return True
+
+    def responseLost(self, tasks):
+        """Called when the connection closes after the response was queued; releases the tasks if it never went out."""
+        if self.request.connection.stream.writing():
+            logging.info("Worker hung up before its tasks were sent")
+            glb.releaseTasks(tasks)
+            glb.dispatchWaitingWorkers()
+
+    def sendNoTask(self):
         if glb.taskQueue.isEmpty():
-            self.write(tornado.escape.json_encode({
+            self.respond({
                 "status": "empty_queue"
-            }))
+            })
         else:
-            task = glb.taskQueue.pullNextVersioned(modelVersions)
-            if task == None:
-                logging.info("Found no models in queue matching worker's supported versions")
-                self.write(tornado.escape.json_encode({
-                    "status": "no_version"
-                }))
-            else:
-                glb.taskQueue.putProcessingTask(task)
-                self.write(tornado.escape.json_encode({
-                    "task": task.asDict()
-                }))
+            logging.info("Found no models in queue matching worker's supported versions")
+            self.respond({
+                "status": "no_version"
+            })
+        self.finish()
+
+    def waitExpired(self):
+        self.timeout = None
+        glb.waitingWorkers.remove(self)
+        glb.touchWorkerCheckin()
+        self.sendNoTask()
+
+    def on_connection_close(self):
+        if self in glb.waitingWorkers:
+            logging.info("Worker hung up while waiting for a task")
+            glb.waitingWorkers.remove(self)
+            glb.ioloop.remove_timeout(self.timeout)
+            self.timeout = None
 
 def main():
     global glb
@@ -444,39 +686,43 @@ def main():
 
     config.loadConfig(options.config)
     config.setupLogging(options.log)
-    model_manager.setupModels()
-    model_manager.startScannerThread()
+    npsgd.email_manager.setupOutbox("queue")
 
     if not os.path.exists(os.path.dirname(config.queueFile)):
         logging.warning("Queue directory does not exist, attempting to create")
         os.makedirs(os.path.dirname(config.queueFile))
 
-    try:
-        queueShelve  = shelve.open(config.queueFile)
-    except anydbm.error:
-        logging.warning("Queue file '%s' is corrupt, removing and starting afresh", config.queueFile)
-        os.remove(config.queueFile)
-        queueShelve = shelve.open(config.queueFile)
+    if config.queueStore == "journal":
+        queueStore = JournalQueueStore(config.queueFile, config.queueSnapshotInterval)
+    elif config.queueStore == "sqlite":
+        queueStore = SqliteQueueStore("%s.sqlite" % config.queueFile, config.confirmedCodeTimeout.total_seconds())
+    else:
+        queueStore = ShelveQueueStore(config.queueFile)
 
     try:
-        glb = QueueGlobals(queueShelve)
+        glb = QueueGlobals(queueStore)
         queueHTTP = tornado.httpserver.HTTPServer(tornado.web.Application([
             (r"/worker_info", WorkerInfo),
             (r"/client_model_create", ClientModelCreate),
             (r"/client_queue_has_workers", ClientQueueHasWorkers),
             (r"/client_confirm/(\w+)", ClientConfirm),
             (r"/worker_failed_task/(\d+)", WorkerFailedTask),
-            (r"/worker_succeed_task/(\d+)", WorkerSucceededTask),
-            (r"/worker_has_task/(\d+)",     WorkerHasTask),
-            (r"/worker_keep_alive_task/(\d+)", WorkerTaskKeepAlive),
+            (r"/worker_complete_task/(\d+)", WorkerCompleteTask),
+            (r"/worker_heartbeat", WorkerHeartbeat),
+            (r"/worker_model_versions", WorkerModelVersions),
             (r"/worker_work_task", WorkerTaskRequest)
         ]))
         queueHTTP.listen(options.port)
         logging.info("NPSGD Queue Booted up, serving on port %d", options.port)
+        modelLoader = threading.Thread(target=glb.loadModels)
+        modelLoader.daemon = True
+        modelLoader.start()
         print >>sys.stderr, "NPSGD queue server listening on %d" % options.port
         tornado.ioloop.IOLoop.instance().start()
     finally:
-        queueShelve.close()
+        if glb != None:
+            glb.store.close()
+        queueStore.close()
 
 
 if __name__ == "__main__":
@@ -20,13 +20,15 @@ import tornado.ioloop
 import tornado.escape
 import tornado.httpclient
 import tornado.httpserver
-import urllib
+import mimetypes
 from optparse import OptionParser
 from datetime import datetime
 
 from npsgd import model_manager
 from npsgd import model_parameters
 from npsgd import ui_modules
+from npsgd import artifact_store
+from npsgd import wire
 
 from npsgd.model_manager import modelManager
 from npsgd.model_task import ModelTask
@@ -126,12 +128,12 @@ class ClientModelRequest(tornado.web.RequestHandler):
         logging.info("Making async request to get confirmation number for task")
 
         http = tornado.httpclient.AsyncHTTPClient()
+        body, headers = wire.encodeRequest({
+                "secret": config.requestSecret,
+                "task": task.asDict()}, wire.requestFormat())
         request = tornado.httpclient.HTTPRequest(
                 "http://%s:%s/client_model_create" % (config.queueServerAddress, config.queueServerPort),
-                method="POST",
-                body=urllib.urlencode({
-                    "secret": config.requestSecret,
-                    "task_json": tornado.escape.json_encode(task.asDict())}))
+                method="POST", body=body, headers=headers)
 
         http.fetch(request, self.confirmationNumberCallback)
 
@@ -141,13 +143,13 @@ class ClientModelRequest(tornado.web.RequestHandler):
         if response.error: raise tornado.web.HTTPError(500)
 
         try:
-            json = tornado.escape.json_decode(response.body)
+            json = wire.decodeResponse(response.body, response.headers.get("Content-Type"))
             logging.info(json)
             res = json["response"]
             model = modelManager.getModel(res["task"]["modelName"], res["task"]["modelVersion"])
             task = model.fromDict(res["task"])
             code = res["code"]
-        except KeyError:
+        except (KeyError, wire.WireError):
             logging.info("Bad response from queue server")
             raise tornado.web.HTTPError(500)
 
@@ -206,13 +208,112 @@ class ClientConfirmRequest(tornado.web.RequestHandler):
         else:
             logging.info("Bad response from queue server: %s", res)
             raise tornado.web.HTTPError(500)
-            
+
+class ArtifactDownload(tornado.web.RequestHandler):
+    """Serves result files out of the artifact store (see npsgd.artifact_store).
+
+    Stored files never change (they are named by the hash of their contents),
+    so the key doubles as an ETag and responses may be cached until the file
+    expires. Single byte ranges are honoured so that interrupted downloads of
+    large results can resume. The body is streamed from disk a chunk at a time,
+    waiting for each chunk to reach the socket before reading the next.
+    """
+    chunkSize = 64 * 1024
+
+    def head(self, key, name):
+        self.get(key, name, includeBody=False)
+
+    @tornado.web.asynchronous
+    def get(self, key, name, includeBody=True):
+        store  = artifact_store.getArtifactStore()
+        expiry = store.expiryTime(key)
+        if expiry == None:
+            raise tornado.web.HTTPError(404)
+
+        path = store.path(key)
+        size = os.path.getsize(path)
+        mimeType, encoding = mimetypes.guess_type(name)
+        self.set_header("Content-Type", mimeType or "application/octet-stream")
+        self.set_header("Content-Disposition", "attachment; filename=\"%s\"" % name.replace("\"", ""))
+        self.set_header("ETag", "\"%s\"" % key)
+        self.set_header("Cache-Control", "private, max-age=%d" % max(0, int(expiry - time.time())))
+        self.set_header("Expires", datetime.utcfromtimestamp(expiry))
+        self.set_header("Accept-Ranges", "bytes")
+
+        if key in self.request.headers.get("If-None-Match", ""):
+            self.set_status(304)
+            self.finish()
+            return
+
+        start, end = 0, size - 1
+        byteRange = self.parseRange(self.request.headers.get("Range"), size)
+        if byteRange == False:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+            self.finish()
+            return
+        elif byteRange != None:
+            start, end = byteRange
+            self.set_status(206)
+            self.set_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+
+        self.set_header("Content-Length", end - start + 1)
+        self.flush()
+        if not includeBody:
+            self.finish()
+            return
+
+        self.remaining = end - start + 1
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.sendChunk()
+
+    def parseRange(self, header, size):
+        """Parses a Range header into an inclusive (start, end) pair.
+
+        Returns None to send the whole file (no header, or one we do not
+        support such as multiple ranges) and False if the range is unsatisfiable.
+        """
+        if header == None or not header.startswith("bytes=") or "," in header:
+            return None
+
+        try:
+            first, last = header[len("bytes="):].strip().split("-", 1)
+            if first == "":
+                start, end = max(0, size - int(last)), size - 1
+            else:
+                start = int(first)
+                end = size - 1 if last == "" else min(int(last), size - 1)
+        except ValueError:
+            return None
+
+        if start > end or start >= size:
+            return False
+
+        return start, end
+
+    def sendChunk(self):
+        if self.request.connection.stream.closed():
+            self.file.close()
+            return
+
+        chunk = self.file.read(min(self.chunkSize, self.remaining))
+        self.remaining -= len(chunk)
+        if len(chunk) == 0 or self.remaining <= 0:
+            self.file.close()
+            if len(chunk) > 0:
+                self.request.write(chunk)
+            self.finish()
+            return
+
+        self.request.connection.stream.write(chunk, self.sendChunk)
 
 def setupClientApplication():
     appList = [ 
         (r"/", ClientBaseRequest),
         (r"/confirm_submission/(\w+)", ClientConfirmRequest),
-        (r"/models/(.*)", ClientModelRequest)
+        (r"/models/(.*)", ClientModelRequest),
+        (r"/results/([0-9a-f]{64})/([^/]+)", ArtifactDownload)
     ]
 
     settings = {
@@ -224,6 +325,17 @@ def setupClientApplication():
     return tornado.web.Application(appList, **settings)
 
 
+def expireArtifacts():
+    """Removes expired result files every hour, off the IOLoop since walking the store touches every file."""
+    store = artifact_store.getArtifactStore()
+    while True:
+        try:
+            store.expire()
+        except Exception:
+            logging.exception("Unable to expire the artifact store")
+        time.sleep(3600)
+
+
 def main():
     parser = OptionParser()
     parser.add_option('-c', '--config', dest='config',
@@ -237,12 +349,18 @@ def main():
 
     config.loadConfig(options.config)
     config.setupLogging(options.log)
+    model_manager.useManifests()
     model_manager.setupModels()
     model_manager.startScannerThread()
 
     clientHTTP = tornado.httpserver.HTTPServer(setupClientApplication())
     clientHTTP.listen(options.port)
 
+    if config.resultsDelivery == "link":
+        artifactExpirer = threading.Thread(target=expireArtifacts)
+        artifactExpirer.daemon = True
+        artifactExpirer.start()
+
     logging.info("NPSGD Web Booted up, serving on port %d", options.port)
     print >>sys.stderr, "NPSGD web server running on port %d" % options.port
 
@@ -12,73 +12,190 @@ with the user (via e-mail) or failure back to the queue
 import os
 import sys
 import time
-import json
+import signal
+import socket
 import logging
-import urllib2, urllib
-from threading import Thread, Event
+import multiprocessing
+from threading import Thread, Event, Condition, RLock
 from optparse import OptionParser
 
 from npsgd import model_manager
 from npsgd.config import config
 from npsgd.model_task import ModelTask
 from npsgd.model_manager import modelManager
+from npsgd.queue_client import QueueClient, QueueClientError
 import npsgd.email_manager
+import npsgd.wire
 
-class TaskKeepAliveThread(Thread):
-    """Model keep alive thread.
+class HeartbeatThread(Thread):
+    """Worker heartbeat thread.
 
-    Periodically sends a keepalive (heartbeat) to the server while we are working
-    on a model task so that it doesn't expire our task id. 
+    Periodically sends one heartbeat to the server covering every task the
+    worker is running, so that the server doesn't expire their leases. Tasks
+    whose leases the server reports as revoked are abandoned.
     """
 
-    def __init__(self, keepAliveRequest, taskId):
+    def __init__(self, worker):
         Thread.__init__(self)
-        self.done             = Event()
-        self.keepAliveRequest = keepAliveRequest
-        self.taskId           = taskId
-        self.daemon           = True
+        self.done   = Event()
+        self.worker = worker
+        self.daemon = True
 
     def run(self):
-        fails = 0
         while True:
             self.done.wait(config.keepAliveInterval)
             if self.done.isSet():
                 break
 
             try:
-                logging.info("Making heartbeat request '%s'", self.keepAliveRequest)
-                response = urllib2.urlopen("%s/%s?secret=%s" % (self.keepAliveRequest, self.taskId, config.requestSecret))
-            except urllib2.URLError, e:
-                logging.error("Heartbeat failed to make connection to %s", self.keepAliveRequest)
-                fails += 1
+                self.worker.sendHeartbeat()
+            except Exception:
+                logging.exception("Heartbeat failed")
+
+
+def runTaskProcess(taskObject, connection):
+    """Entry point of a model process: runs the task and sends back its results e-mail."""
+    #Lead a process group of our own, so that stopping the model also stops
+    #any programs it has started (see stopModelProcess)
+    os.setsid()
+    #We were forked from a threaded worker: another thread may have held a
+    #logging lock at the time, and nobody would ever release our copy of it
+    for handler in logging.getLogger().handlers:
+        handler.createLock()
+
+    try:
+        connection.send(("okay", taskObject.run()))
+    except Exception, e:
+        logging.exception("Model task '%s' raised an error", taskObject.taskId)
+        connection.send(("error", str(e)))
+    finally:
+        connection.close()
+
+def stopModelProcess(process):
+    """Terminates a model process along with every program it started."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        #Not yet in a group of its own, so it cannot have started anything
+        process.terminate()
+
+class TaskSlotThread(Thread):
+    """Execution slot thread, which runs one task and then frees its slot."""
+
+    def __init__(self, worker, taskDict):
+        Thread.__init__(self)
+        self.worker   = worker
+        self.taskDict = taskDict
+        self.daemon   = True
 
+    def run(self):
+        try:
+            self.worker.processTask(self.taskDict)
+        except Exception:
+            logging.exception("Unhandled exception in task slot!")
+        finally:
+            self.worker.releaseSlot()
 
 class NPSGDWorker(object):
     """Worker class for executing models and sending out result emails.
 
-    This enters a polling loop where the worker will poll the queue for tasks
-    at a fixed interval. When it finds a task, it will decode it into a model, 
-    then process it using the model's "run" method.
+    This enters a polling loop where the worker will poll the queue for as many
+    tasks as it has free execution slots. When it finds a task, it will decode
+    it into a model, then process it using the model's "run" method in a 
+    process of its own.
     """
     def __init__(self, serverAddress, serverPort):
         self.baseRequest          = "http://%s:%s" % (serverAddress, serverPort)
-        self.infoRequest          = "%s/worker_info"      % self.baseRequest
-        self.taskRequest          = "%s/worker_work_task" % self.baseRequest
-        self.failedTaskRequest    = "%s/worker_failed_task" % self.baseRequest
-        self.hasTaskRequest       = "%s/worker_has_task" % self.baseRequest
-        self.succeedTaskRequest    = "%s/worker_succeed_task" % self.baseRequest
-        self.taskKeepAliveRequest = "%s/worker_keep_alive_task" % self.baseRequest
-        self.requestTimeout  = 100
+        self.infoRequest          = "/worker_info"
+        self.taskRequest          = "/worker_work_task"
+        self.failedTaskRequest    = "/worker_failed_task"
+        self.completeTaskRequest  = "/worker_complete_task"
+        self.heartbeatRequest     = "/worker_heartbeat"
+        self.modelVersionsRequest = "/worker_model_versions"
+        self.requestTimeout  = config.queueRequestTimeout
+        self.client          = QueueClient(serverAddress, serverPort, config.requestSecret,
+                config.queueRequestTimeout, config.queueRequestRetries, config.workerSlots + 2,
+                wireFormat=npsgd.wire.requestFormat())
         self.supportedModels = ["test"]
         self.requestErrors   = 0
         self.maxErrors       = 3 
         self.errorSleepTime    = 10
         self.requestSleepTime = 10
+        self.workerId        = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.slots           = config.workerSlots
+        self.busySlots       = 0
+        self.slotCondition   = Condition()
+        self.leaseLock       = RLock()
+        self.leases          = {}
+        self.processes       = {}
+
+    def acquireSlots(self):
+        """Blocks until at least one execution slot is free, returning the number free."""
+        with self.slotCondition:
+            while self.busySlots >= self.slots:
+                self.slotCondition.wait()
+
+            return self.slots - self.busySlots
+
+    def startSlot(self, taskDict):
+        with self.slotCondition:
+            self.busySlots += 1
+
+        TaskSlotThread(self, taskDict).start()
+
+    def releaseSlot(self):
+        with self.slotCondition:
+            self.busySlots -= 1
+            self.slotCondition.notify()
+
+    def addLease(self, taskId, leaseToken):
+        with self.leaseLock:
+            self.leases[taskId] = leaseToken
+
+    def removeLease(self, taskId):
+        with self.leaseLock:
+            self.leases.pop(taskId, None)
+
+    def revokeLease(self, taskId):
+        """Abandons a task whose lease the server revoked, stopping its model process."""
+        logging.warning("Lease on task '%s' was revoked, abandoning it", taskId)
+        with self.leaseLock:
+            self.leases.pop(taskId, None)
+            process = self.processes.get(taskId)
+            if process != None:
+                stopModelProcess(process)
+
+    def sendHeartbeat(self):
+        """Renews the leases on all running tasks with one request to the server."""
+        with self.leaseLock:
+            leases = self.leases.items()
+
+        logging.info("Making heartbeat request for %d tasks", len(leases))
+        try:
+            decodedResponse = self.client.post(self.heartbeatRequest, {
+                "worker_id": self.workerId,
+                "slots": self.slots,
+                "leases": leases
+            })
+        except QueueClientError, e:
+            logging.error("Heartbeat failed to reach %s: %s", self.baseRequest, e)
+            return
+
+        for taskId in decodedResponse.get("revoked", []):
+            self.revokeLease(taskId)
+
+    def referencedVersions(self):
+        """Returns the model versions the queue still holds tasks for (see model_manager.collectVersions)."""
+        response = self.client.get(self.modelVersionsRequest, retries=0)
+        return response["response"]["versions"]
 
     def getServerInfo(self):
         try:
-            response = urllib2.urlopen("%s?secret=%s" % (self.infoRequest, config.requestSecret))
-        except urllib2.URLError, e:
+            self.client.get(self.infoRequest, {
+                "worker_id": self.workerId,
+                "slots": self.slots
+            })
+        except QueueClientError, e:
             logging.error("Failed to make initial connection to %s", self.baseRequest)
             return
         
@@ -87,6 +204,7 @@ class NPSGDWorker(object):
     def loop(self):
         """Main IO loop."""
         logging.info("Entering event loop")
+        HeartbeatThread(self).start()
         while True:
             try:
                 self.handleEvents()
@@ -95,30 +213,29 @@ class NPSGDWorker(object):
                 
     def handleEvents(self):
         """Workhorse method of actually making requests to the queue for tasks."""
+        freeSlots = self.acquireSlots()
         try:
-            logging.info("Polling %s for tasks" % self.taskRequest)
-            #response = urllib2.urlopen("%s?secret=%s" % (self.taskRequest, config.requestSecret))
-            response = urllib2.urlopen(self.taskRequest, data=urllib.urlencode({
-                "secret": config.requestSecret,
-                "model_versions_json": json.dumps(modelManager.modelVersions())
-            }))
-        except urllib2.URLError, e:
+            logging.info("Polling %s for tasks" % self.baseRequest)
+            decodedResponse = self.client.post(self.taskRequest, {
+                "model_versions": modelManager.modelVersions(),
+                "wait": config.longPollTimeout,
+                "max_tasks": freeSlots,
+                "worker_id": self.workerId,
+                "slots": self.slots
+            }, timeout=config.longPollTimeout + self.requestTimeout)
+        except QueueClientError, e:
             self.requestErrors += 1
-            logging.error("Error making worker request to server, attempt #%d", self.requestErrors + 1)
-            time.sleep(self.errorSleepTime)
-            return
-
-        try:
-            decodedResponse = json.load(response)
-        except ValueError, e:
-            self.requestErrors += 1
-            logging.error("Error decoding server response, attempt #%d", self.requestErrors +1)
+            logging.error("Error making worker request to server (%s), attempt #%d", e, self.requestErrors + 1)
             time.sleep(self.errorSleepTime)
             return
 
         self.requestErrors = 0 
         self.processResponse(decodedResponse)
-        time.sleep(self.requestSleepTime)
+
+        #The queue holds our request open until it has work for us, so we only
+        #need to back off ourselves when long polling is switched off
+        if config.longPollTimeout <= 0:
+            time.sleep(self.requestSleepTime)
 
 
 
@@ -128,60 +245,112 @@ class NPSGDWorker(object):
                 logging.info("No tasks available on server")
             elif response["status"] == "no_version":
                 logging.info("Queue lacks any tasks with our model versions")
+        elif "tasks" in response:
+            for taskDict in response["tasks"]:
+                self.startSlot(taskDict)
         elif "task" in response:
-            self.processTask(response["task"])
+            self.startSlot(response["task"])
 
-    def notifyFailedTask(self, taskId):
+    def notifyFailedTask(self, taskId, leaseToken):
         try:
             logging.info("Notifying server of failed task with id %s", taskId)
-            response = urllib2.urlopen("%s/%s?secret=%s" % (self.failedTaskRequest, taskId, config.requestSecret))
-        except urllib2.URLError, e:
+            self.client.get("%s/%s" % (self.failedTaskRequest, taskId), {"lease_token": leaseToken})
+        except QueueClientError, e:
             logging.error("Failed to communicate failed task to server %s", self.baseRequest)
 
-    def notifySucceedTask(self, taskId):
-        try:
-            logging.info("Notifying server of succeeded task with id %s", taskId)
-            response = urllib2.urlopen("%s/%s?secret=%s" % (self.succeedTaskRequest, taskId, config.requestSecret))
-        except urllib2.URLError, e:
-            logging.error("Failed to communicate succeeded task to server %s", self.baseRequest)
+    def completeTask(self, taskId, leaseToken):
+        """Claims the right to deliver the results of our task from the queue.
 
-    def serverHasTask(self, taskId):
-        """Method for ensuring that the queue still recognizes our task id.
-
-        If the queue has expired the task for some reason (i.e. a timeout)
-        this method will return false. Otherwise, it means we can proceed.
+        Returns the followers of the task (identical requests that should
+        receive the same results), or None if our lease is no longer valid,
+        in which case some other worker is responsible for the task.
         """
         try:
-            logging.info("Making has task request for %s", taskId)
-            response = urllib2.urlopen("%s/%s?secret=%s" % (self.hasTaskRequest, taskId, config.requestSecret))
-        except urllib2.URLError, e:
-            logging.error("Failed to make has task request to server %s", self.baseRequest)
+            logging.info("Making complete task request for %s", taskId)
+            #Not retried: if a first attempt got through, a retry would be refused
+            decodedResponse = self.client.get("%s/%s" % (self.completeTaskRequest, taskId), {
+                "lease_token": leaseToken
+            }, retries=0)
+        except QueueClientError, e:
+            logging.error("Failed to make complete task request to server %s", self.baseRequest)
             raise RuntimeError(e)
 
-        try:
-            decodedResponse = json.load(response)
-        except ValueError, e:
-            logging.error("Bad response from server for has task")
-            raise RuntimeError(e)
-        
         if "response" in decodedResponse and decodedResponse["response"] in ["yes", "no"]:
-            return decodedResponse["response"] == "yes"
+            if decodedResponse["response"] == "yes":
+                return decodedResponse.get("followers", [])
+            else:
+                return None
         else:
             logging.error("Malformed response from server")
-            raise RuntimeError("Malformed response from server for 'has task'")
-        
+            raise RuntimeError("Malformed response from server for 'complete task'")
+
+    def runModelProcess(self, taskObject):
+        """Runs a model task in a child process, returning its results e-mail.
+
+        Raises a RuntimeError if the model fails, the process dies or the
+        model runs for longer than modelRunTimeout (when the process is stopped).
+        """
+        receiver, sender = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target=runTaskProcess, args=(taskObject, sender))
+        process.start()
+        sender.close()
+        with self.leaseLock:
+            self.processes[taskObject.taskId] = process
+            if taskObject.taskId not in self.leases:
+                stopModelProcess(process)
+
+        try:
+            if config.modelRunTimeout > 0 and not receiver.poll(config.modelRunTimeout):
+                logging.warning("Model task '%s' timed out, stopping it", taskObject.taskId)
+                stopModelProcess(process)
+                status, result = ("error", "model ran for longer than %d seconds" % config.modelRunTimeout)
+            else:
+                status, result = receiver.recv()
+        except EOFError:
+            status, result = ("error", "model process exited without a result")
+        finally:
+            receiver.close()
+            process.join()
+            with self.leaseLock:
+                self.processes.pop(taskObject.taskId, None)
+
+        if status != "okay":
+            raise RuntimeError("Model process for task '%s' failed: %s" % (taskObject.taskId, result))
+
+        return result
+
+    def sendResultsEmail(self, email):
+        """Sends a results e-mail, handing it to the background sender if that fails.
+
+        The task is already complete on the queue by now, so the e-mail must
+        not be lost to a transient SMTP error.
+        """
+        try:
+            npsgd.email_manager.blockingEmailSend(email)
+        except Exception:
+            logging.exception("Unable to send results to '%s' now, retrying in the background", email.recipient)
+            npsgd.email_manager.backgroundEmailSend(email)
+
+    def sendFollowerEmails(self, taskObject, followers, resultsEmail):
+        """Fans the results of a task out to each follower's own e-mail address."""
+        for follower in taskObject.followerTasks(followers):
+            logging.info("Sending results of task '%s' to follower '%s'", taskObject.taskId, follower.taskId)
+            self.sendResultsEmail(follower.resultsEmail(resultsEmail.binaryAttachments, resultsEmail.links))
+
     def processTask(self, taskDict):
         """Handle creation and running of a model and setup heartbeat thread.
 
         This is the heart of a worker. When we find a model on the queue, this
         method takes the request and decodes it into something that can be processed.
-        It will then spawn a heartbeat thread that continues to check into the server
-        while we actually enter the models "run" method. From there, it is all up
-        to the model to handle.
+        It will then register the task's lease with the worker heartbeat, which keeps
+        checking into the server while we actually enter the models "run" method in
+        a separate process.
+        From there, it is all up to the model to handle.
         """
         taskId = None
         if "taskId" in taskDict:
             taskId = taskDict["taskId"]
+        leaseToken = taskDict.get("leaseToken")
 
         try:
             try:
@@ -191,32 +360,32 @@ class NPSGDWorker(object):
             except KeyError, e:
                 logging.warning("Was unable to deserialize model task (%s), model task: %s", e, taskDict)
                 if taskId:
-                    self.notifyFailedTask(taskId)
+                    self.notifyFailedTask(taskId, leaseToken)
                 return
 
-            keepAliveThread = TaskKeepAliveThread(self.taskKeepAliveRequest, taskObject.taskId)
-            keepAliveThread.start()
+            self.addLease(taskObject.taskId, leaseToken)
             try:
-                resultsEmail = taskObject.run()
-                logging.info("Model finished running, sending email")
-                if self.serverHasTask(taskObject.taskId):
-                    npsgd.email_manager.blockingEmailSend(resultsEmail)
+                resultsEmail = self.runModelProcess(taskObject)
+                logging.info("Model finished running, completing task")
+                followers = self.completeTask(taskObject.taskId, leaseToken)
+                if followers != None:
+                    self.sendResultsEmail(resultsEmail)
                     logging.info("Email sent, model is 100% complete!")
-                    self.notifySucceedTask(taskObject.taskId)
+                    self.sendFollowerEmails(taskObject, followers, resultsEmail)
                 else:
-                    logging.warning("Skipping task completion since the server forgot about our task")
+                    logging.warning("Skipping task completion since our lease on the task is no longer valid")
 
             except RuntimeError, e:
                 logging.error("Some kind of error during processing model task, notifying server of failure")
                 logging.exception(e)
-                self.notifyFailedTask(taskObject.taskId)
+                self.notifyFailedTask(taskObject.taskId, leaseToken)
 
             finally:
-                keepAliveThread.done.set()
+                self.removeLease(taskObject.taskId)
 
         except: #If all else fails, notify the server that we are going down
             if taskId:
-                self.notifyFailedTask(taskId)
+                self.notifyFailedTask(taskId, leaseToken)
             raise
 
 def main():
@@ -231,10 +400,12 @@ def main():
 
     config.loadConfig(options.config)
     config.setupLogging(options.log)
+    npsgd.email_manager.setupOutbox("worker")
     model_manager.setupModels()
     model_manager.startScannerThread()
 
     worker = NPSGDWorker(config.queueServerAddress, config.queueServerPort)
+    model_manager.setVersionReferences(worker.referencedVersions)
     logging.info("NPSGD Worker booted up, going into event loop")
     worker.getServerInfo()
     worker.loop()
@@ -0,0 +1,4 @@
+"""Unit tests for the NPSGD helper modules.
+
+Run them from the repository root with: python -m unittest discover -s tests -t .
+"""
@@ -0,0 +1,142 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.artifact_store and the download handler of the web daemon."""
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+import tornado.web
+import tornado.testing
+
+import npsgd_web
+from npsgd import artifact_store
+from npsgd.config import config
+from npsgd.artifact_store import ArtifactStore
+
+class ArtifactStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ArtifactStore(os.path.join(self.directory, "store"), 3600)
+        self.advertisedRoot = getattr(config, "advertisedRoot", None)
+
+    def tearDown(self):
+        config.advertisedRoot = self.advertisedRoot
+        shutil.rmtree(self.directory)
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def storedFiles(self):
+        return sorted(name for (root, dirs, files) in os.walk(self.store.directory) for name in files)
+
+    def testFilesAreKeyedByContent(self):
+        key = self.store.putFile(self.writeFile("a.pdf", "results"))
+        self.assertEqual(key, hashlib.sha256("results").hexdigest())
+        self.assertEqual(self.store.putFile(self.writeFile("b.pdf", "results")), key)
+        self.assertEqual(self.storedFiles(), [key])
+        with open(self.store.path(key), "rb") as f:
+            self.assertEqual(f.read(), "results")
+
+    def testExpiryTime(self):
+        key = self.store.putFile(self.writeFile("a.pdf", "results"))
+        os.utime(self.store.path(key), (time.time() - 100, time.time() - 100))
+        self.assertTrue(abs(self.store.expiryTime(key) - (time.time() + 3500)) < 5)
+
+        #Storing the same file again restarts its clock
+        self.store.putFile(self.writeFile("b.pdf", "results"))
+        self.assertTrue(self.store.expiryTime(key) > time.time() + 3590)
+
+        os.utime(self.store.path(key), (time.time() - 3601, time.time() - 3601))
+        self.assertEqual(self.store.expiryTime(key), None)
+        self.assertEqual(self.store.expiryTime("0" * 64), None)
+
+    def testLink(self):
+        config.advertisedRoot = "http://example.com/npsgd/"
+        self.assertEqual(self.store.link("ab" * 32, "my results.pdf"),
+                "http://example.com/npsgd/results/%s/my%%20results.pdf" % ("ab" * 32))
+
+    def testExpire(self):
+        old = self.store.putFile(self.writeFile("a.pdf", "old"))
+        new = self.store.putFile(self.writeFile("b.pdf", "new"))
+        os.utime(self.store.path(old), (time.time() - 3601, time.time() - 3601))
+
+        self.store.expire()
+        self.assertEqual(self.storedFiles(), [new])
+
+class ArtifactDownloadTest(tornado.testing.AsyncHTTPTestCase):
+    data = "0123456789" * 10
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        source = os.path.join(self.directory, "results.pdf")
+        with open(source, "wb") as f:
+            f.write(self.data)
+
+        artifact_store.artifactStore = ArtifactStore(os.path.join(self.directory, "store"), 3600)
+        self.key = artifact_store.artifactStore.putFile(source)
+        #Small chunks, so that a download takes several writes
+        self.chunkSize, npsgd_web.ArtifactDownload.chunkSize = npsgd_web.ArtifactDownload.chunkSize, 16
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        npsgd_web.ArtifactDownload.chunkSize = self.chunkSize
+        artifact_store.artifactStore = None
+        shutil.rmtree(self.directory)
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r"/results/([0-9a-f]{64})/([^/]+)", npsgd_web.ArtifactDownload)
+        ])
+
+    def download(self, headers={}, method="GET", key=None):
+        return self.fetch("/results/%s/results.pdf" % (key or self.key), headers=headers, method=method)
+
+    def testDownload(self):
+        response = self.download()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(response.headers["ETag"], "\"%s\"" % self.key)
+        self.assertEqual(response.headers["Content-Type"], "application/pdf")
+        self.assertEqual(response.headers["Content-Disposition"], "attachment; filename=\"results.pdf\"")
+
+    def testHead(self):
+        response = self.download(method="HEAD")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Length"], str(len(self.data)))
+        self.assertEqual(response.body, "")
+
+    def testUnknownFile(self):
+        self.assertEqual(self.download(key="0" * 64).code, 404)
+
+    def testNotModified(self):
+        response = self.download({"If-None-Match": "\"%s\"" % self.key})
+        self.assertEqual(response.code, 304)
+
+    def testRange(self):
+        response = self.download({"Range": "bytes=10-29"})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.data[10:30])
+        self.assertEqual(response.headers["Content-Range"], "bytes 10-29/100")
+
+    def testOpenAndSuffixRanges(self):
+        self.assertEqual(self.download({"Range": "bytes=95-"}).body, self.data[95:])
+        self.assertEqual(self.download({"Range": "bytes=-5"}).body, self.data[95:])
+        self.assertEqual(self.download({"Range": "bytes=90-500"}).body, self.data[90:])
+
+    def testUnsupportedRangesSendTheWholeFile(self):
+        for header in ["bytes=0-1,5-6", "lines=1-2", "bytes=a-b"]:
+            response = self.download({"Range": header})
+            self.assertEqual((response.code, response.body), (200, self.data))
+
+    def testUnsatisfiableRange(self):
+        response = self.download({"Range": "bytes=100-"})
+        self.assertEqual(response.code, 416)
+        self.assertEqual(response.headers["Content-Range"], "bytes */100")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.confirmation_map: the recent code set."""
+import unittest
+
+from npsgd import confirmation_map
+from npsgd.confirmation_map import RecentCodeSet
+
+class FakeClock(object):
+    """Stands in for the time module, so that the set ages under the test's control."""
+    def __init__(self):
+        self.now = 86400.0
+
+    def time(self):
+        return self.now
+
+class RecentCodeSetTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.realTime, confirmation_map.time = confirmation_map.time, self.clock
+        #One hour buckets over a day
+        self.codes = RecentCodeSet(24 * 3600)
+
+    def tearDown(self):
+        confirmation_map.time = self.realTime
+
+    def testMembership(self):
+        self.codes.add("a")
+        self.codes.add("b")
+        self.assertTrue("a" in self.codes)
+        self.assertFalse("c" in self.codes)
+        self.assertEqual(len(self.codes), 2)
+
+    def testCodesAreForgottenAfterTheTtl(self):
+        self.clock.now += 1800
+        self.codes.add("a")
+
+        #Remembered for at least the ttl...
+        self.clock.now += 24 * 3600 - 1
+        self.assertTrue("a" in self.codes)
+
+        #...and at most one bucket longer
+        self.clock.now += 3600 + 1
+        self.assertFalse("a" in self.codes)
+        self.assertEqual(len(self.codes), 0)
+
+    def testBucketsAreBounded(self):
+        for hour in xrange(24 * 7):
+            self.codes.add("code%d" % hour)
+            self.clock.now += 3600
+
+        self.assertTrue(len(self.codes.buckets) <= 25)
+        self.assertFalse("code0" in self.codes)
+        self.assertTrue("code%d" % (24 * 7 - 1) in self.codes)
+
+    def testEntriesRoundTrip(self):
+        self.codes.add("a")
+        self.clock.now += 7200
+        self.codes.add("b")
+
+        entries = self.codes.entries()
+        self.assertEqual(entries, {"a": 86400.0, "b": 93600.0})
+
+        loaded = RecentCodeSet(24 * 3600)
+        loaded.load(entries)
+        self.assertEqual(loaded.entries(), entries)
+        self.assertTrue("a" in loaded and "b" in loaded)
+
+    def testLoadDropsExpiredEntries(self):
+        loaded = RecentCodeSet(24 * 3600)
+        loaded.load({"old": self.clock.now - 25 * 3600, "new": self.clock.now - 3600})
+        self.assertFalse("old" in loaded)
+        self.assertTrue("new" in loaded)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+# For distribution details, see LICENSE
+"""Tests for the e-mail outbox of npsgd.email_manager."""
+import os
+import time
+import socket
+import smtplib
+import shutil
+import logging
+import tempfile
+import unittest
+
+from npsgd.config import config
+from npsgd.email_manager import Email, Outbox, smtpServer
+
+class OutboxTest(unittest.TestCase):
+    settings = {
+        "maxAttempts":        3,
+        "emailRetryDelay":    10,
+        "emailMaxRetryDelay": 30
+    }
+
+    def setUp(self):
+        self.savedConfig = dict((name, getattr(config, name, None)) for name in self.settings)
+        for name, value in self.settings.iteritems():
+            setattr(config, name, value)
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        for name, value in self.savedConfig.iteritems():
+            setattr(config, name, value)
+
+    def outbox(self, directory=None):
+        """Returns a started outbox without any e-mail threads, so the test takes e-mails itself."""
+        outbox = Outbox(directory)
+        outbox.start(0)
+        return outbox
+
+    def emailFiles(self):
+        return [f for f in os.listdir(self.directory) if f.endswith(".email")]
+
+    def testDueEmailsComeOutInOrder(self):
+        outbox = self.outbox()
+        now = time.time()
+        outbox.schedule(Email("late@example.com", "", ""), now + 0.2)
+        outbox.schedule(Email("soon@example.com", "", ""), now + 0.1)
+        outbox.put(Email("now@example.com", "", ""))
+
+        self.assertEqual([outbox.next().recipient for i in xrange(3)],
+                ["now@example.com", "soon@example.com", "late@example.com"])
+        self.assertTrue(time.time() >= now + 0.2)
+
+    def testFailedEmailsBackOff(self):
+        outbox = Outbox()
+        delays = []
+        for attempts in [1, 2, 3]:
+            email = Email("user@example.com", "", "")
+            email.attempts = attempts
+            outbox.failed(email)
+            delays.append(max(nextAttempt for (nextAttempt, seq, e) in outbox.delayed if e is email) - time.time())
+
+        self.assertTrue(4 < delays[0] <= 15)
+        self.assertTrue(9 < delays[1] <= 30)
+        self.assertTrue(14 < delays[2] <= 45)
+
+    def testEmailsAreDroppedAfterMaxAttempts(self):
+        outbox = self.outbox(self.directory)
+        email = Email("user@example.com", "", "")
+        outbox.put(email)
+        outbox.next()
+        email.attempts = config.maxAttempts + 1
+        logging.disable(logging.WARNING)
+        try:
+            outbox.failed(email)
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(outbox.delayed, [])
+        self.assertEqual(self.emailFiles(), [])
+
+    def testEmailsSurviveARestart(self):
+        first = self.outbox(self.directory)
+        first.put(Email("first@example.com", "Results", "body"))
+        #E-mails are stored before they can be taken for a first attempt
+        first.next()
+        self.assertEqual(len(self.emailFiles()), 1)
+        retried = Email("retried@example.com", "Results", "body")
+        retried.attempts = 1
+        first.failed(retried)
+        self.assertEqual(len(self.emailFiles()), 2)
+
+        second = self.outbox(self.directory)
+        email = second.next()
+        self.assertEqual((email.recipient, email.subject, email.body), ("first@example.com", "Results", "body"))
+        self.assertEqual([e.recipient for (nextAttempt, seq, e) in second.delayed], ["retried@example.com"])
+
+        second.sent(email)
+        self.assertEqual(len(self.emailFiles()), 1)
+
+class SMTPTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = dict((k, getattr(config, k, None)) for k in ["smtpServer", "smtpPort", "smtpTimeout"])
+        #A server that accepts connections but never greets its clients
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        config.smtpServer, config.smtpPort = self.server.getsockname()
+        config.smtpTimeout = 0.2
+
+    def tearDown(self):
+        self.server.close()
+        for k, v in self.settings.iteritems():
+            setattr(config, k, v)
+
+    def testUnresponsiveServerTimesOut(self):
+        started = time.time()
+        self.assertRaises((socket.error, smtplib.SMTPException), smtpServer)
+        self.assertTrue(time.time() - started < 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# For distribution details, see LICENSE
+"""Tests for the incremental model directory scan of npsgd.model_manager."""
+import os
+import imp
+import shutil
+import logging
+import tempfile
+import unittest
+
+from npsgd import model_manager
+from npsgd.config import config
+from npsgd.model_task import ModelTask
+from npsgd.model_manager import ModelManager
+from npsgd.model_parameters import StringParameter, ParameterValue
+
+modelSource = """from npsgd.model_task import ModelTask
+from npsgd.model_parameters import StringParameter
+
+class ScanModel(ModelTask):
+    short_name = "scan"
+    full_name  = "Scan Model"
+    parameters = [StringParameter("x", description=%r)]
+"""
+
+class ModelScanTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.modelDirectory = getattr(config, "modelDirectory", None)
+        config.modelDirectory = self.directory
+        self.modelManager = model_manager.modelManager
+        model_manager.modelManager = ModelManager()
+        model_manager.scannedFiles.clear()
+
+        #Count imports without changing what they do
+        self.imports = []
+        self.loadSource = imp.load_source
+        def loadSource(name, path):
+            self.imports.append(os.path.basename(path))
+            return self.loadSource(name, path)
+        imp.load_source = loadSource
+
+    def tearDown(self):
+        imp.load_source = self.loadSource
+        model_manager.modelManager = self.modelManager
+        model_manager.scannedFiles.clear()
+        config.modelDirectory = self.modelDirectory
+        shutil.rmtree(self.directory)
+
+    def writeModel(self, name, source, mtime):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write(source)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def versions(self):
+        return sorted(v for (n, v) in model_manager.modelManager.modelVersions())
+
+    def testUnchangedFilesAreNotReimported(self):
+        self.writeModel("scan.py", modelSource % "a", 1000)
+        model_manager.setupModels()
+        model_manager.setupModels()
+        self.assertEqual(self.imports, ["scan.py"])
+        self.assertEqual(model_manager.modelManager.modelNames(), ["scan"])
+
+    def testTouchedFilesAreNotReimported(self):
+        self.writeModel("scan.py", modelSource % "a", 1000)
+        model_manager.setupModels()
+        self.writeModel("scan.py", modelSource % "a", 2000)
+        model_manager.setupModels()
+        self.assertEqual(self.imports, ["scan.py"])
+        self.assertEqual(len(self.versions()), 1)
+
+    def testChangedFilesAddAVersion(self):
+        self.writeModel("scan.py", modelSource % "a", 1000)
+        model_manager.setupModels()
+        self.writeModel("scan.py", modelSource % "changed", 2000)
+        model_manager.setupModels()
+        self.assertEqual(self.imports, ["scan.py", "scan.py"])
+        self.assertEqual(len(self.versions()), 2)
+
+    def testBrokenFilesAreNotRetriedUntilChanged(self):
+        self.writeModel("broken.py", "this is not python", 1000)
+        logging.disable(logging.ERROR)
+        try:
+            model_manager.setupModels()
+            model_manager.setupModels()
+            self.assertEqual(self.imports, ["broken.py"])
+
+            self.writeModel("broken.py", modelSource % "fixed", 2000)
+            model_manager.setupModels()
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(self.imports, ["broken.py", "broken.py"])
+        self.assertEqual(model_manager.modelManager.modelNames(), ["scan"])
+
+    def testRemovedFilesAreForgotten(self):
+        path = self.writeModel("scan.py", modelSource % "a", 1000)
+        model_manager.setupModels()
+        os.remove(path)
+        model_manager.setupModels()
+        self.assertEqual(model_manager.scannedFiles, {})
+
+class CollectVersionsTest(unittest.TestCase):
+    def model(self, parameterClass):
+        return type("CollectModel", (ModelTask,), {
+            "short_name": "collect",
+            "full_name":  "Collect Model",
+            "parameters": [parameterClass("x")]
+        })
+
+    def testValueClassesOfUnloadedModelsAreDropped(self):
+        class OldParameter(StringParameter): pass
+
+        manager = ModelManager()
+        old = self.model(OldParameter)
+        manager.addModel(old, "1")
+        manager.addModel(self.model(StringParameter), "2")
+        old.parameters[0].withValue("a")
+        self.assertTrue(OldParameter in ParameterValue.valueClasses)
+
+        self.assertEqual(manager.collectVersions([], 0), [("collect", "1")])
+        self.assertFalse(OldParameter in ParameterValue.valueClasses)
+
+if __name__ == "__main__":
+    unittest.main()
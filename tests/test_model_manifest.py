@@ -0,0 +1,127 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.model_manifest: describing models and rebuilding them."""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from npsgd import model_manifest
+from npsgd.config import config
+from npsgd.model_task import ModelTask
+from npsgd.model_manifest import describeModel, modelFromManifest, loadManifest, ManifestError
+from npsgd.model_parameters import SelectParameter, BooleanParameter, StringParameter, \
+        RangeParameter, FloatParameter, IntegerParameter, ValidationError
+
+class ManifestModel(ModelTask):
+    short_name = "manifest"
+    full_name  = "Manifest Model"
+    subtitle   = "A model described by a manifest"
+    version    = "1"
+
+    parameters = [
+        SelectParameter("shape", options=["round", "square"], description="Shape"),
+        BooleanParameter("flag", description="Flag", default=True, helpText="A <flag>"),
+        StringParameter("label", description="Label", units="u"),
+        RangeParameter("wavelength", description="Wavelength", rangeStart=400, rangeEnd=700,
+            step=5, units="nm", default=(450, 500)),
+        FloatParameter("ratio", description="Ratio", rangeStart=0.5, rangeEnd=2.0, default=1.0),
+        IntegerParameter("count", description="Count", rangeStart=1, rangeEnd=10, default=3)
+    ]
+
+modelSource = """from npsgd.model_task import ModelTask
+from npsgd.model_parameters import StringParameter
+
+print "models may print while they are imported"
+
+class FileModel(ModelTask):
+    short_name = "file"
+    full_name  = "File Model"
+    parameters = [StringParameter("x", description="X")]
+"""
+
+def roundTrip(cls):
+    """Rebuilds a model class the way the daemons do, through JSON."""
+    rebuilt = modelFromManifest(json.loads(json.dumps(describeModel(cls))))
+    rebuilt.version = cls.version
+    return rebuilt
+
+taskParameters = {
+    "shape":      {"name": "shape",      "value": "square"},
+    "flag":       {"name": "flag",       "value": False},
+    "label":      {"name": "label",      "value": "hello"},
+    "wavelength": {"name": "wavelength", "value": "420-480"},
+    "ratio":      {"name": "ratio",      "value": "1.5"},
+    "count":      {"name": "count",      "value": "7"}
+}
+
+class ModelFromManifestTest(unittest.TestCase):
+    def testDeclarationsRoundTrip(self):
+        rebuilt = roundTrip(ManifestModel)
+        self.assertEqual((rebuilt.short_name, rebuilt.full_name, rebuilt.subtitle),
+                (ManifestModel.short_name, ManifestModel.full_name, ManifestModel.subtitle))
+        self.assertTrue(issubclass(rebuilt, ModelTask))
+
+        for (original, copy) in zip(ManifestModel.parameters, rebuilt.parameters):
+            self.assertEqual(copy.__class__, original.__class__)
+            self.assertEqual(copy.value, original.value)
+            #Other attributes come back as JSON types (e.g. a tuple default as a list)
+            self.assertEqual(json.loads(json.dumps(copy.__dict__)), json.loads(json.dumps(original.__dict__)))
+            self.assertEqual(copy.asHTML(), original.asHTML())
+
+    def testTasksRoundTrip(self):
+        rebuilt = roundTrip(ManifestModel)
+        original = ManifestModel("a@example.com", 1, taskParameters, visibleId="v1")
+        copy = rebuilt.fromDict(original.asDict())
+
+        self.assertEqual(copy.asDict(), original.asDict())
+        self.assertEqual(copy.resultKey(), original.resultKey())
+        self.assertEqual([p.asTextRow() for p in copy.modelParameters],
+                [p.asTextRow() for p in original.modelParameters])
+
+    def testValidationIsKept(self):
+        rebuilt = roundTrip(ManifestModel)
+        for name, value in [("shape", "oval"), ("wavelength", "300-500"), ("ratio", "2.5")]:
+            parameters = dict(taskParameters)
+            parameters[name] = {"name": name, "value": value}
+            self.assertRaises(ValidationError, rebuilt, "a@example.com", 1, parameters)
+
+    def testUnknownParameterType(self):
+        manifest = describeModel(ManifestModel)
+        manifest["parameters"][0]["type"] = "ModelTask"
+        self.assertRaises(ManifestError, modelFromManifest, manifest)
+
+class LoadManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = dict((k, getattr(config, k, None)) for k in ["modelDirectory", "modelManifestDirectory"])
+        config.modelDirectory = self.directory
+        config.modelManifestDirectory = os.path.join(self.directory, "manifests")
+
+        self.modelFile = os.path.join(self.directory, "file_model.py")
+        with open(self.modelFile, "w") as f:
+            f.write(modelSource)
+
+    def tearDown(self):
+        for k, v in self.settings.iteritems():
+            setattr(config, k, v)
+        shutil.rmtree(self.directory)
+
+    def testManifestIsBuiltAndCached(self):
+        manifest = loadManifest(self.modelFile, "v1")
+        self.assertEqual([m["short_name"] for m in manifest], ["file"])
+        self.assertEqual(os.listdir(config.modelManifestDirectory), ["v1.json"])
+
+        #The cached copy is used even once the file is gone
+        os.remove(self.modelFile)
+        self.assertEqual(loadManifest(self.modelFile, "v1"), manifest)
+        self.assertRaises(ManifestError, loadManifest, self.modelFile, "v2")
+
+    def testBrokenFile(self):
+        with open(self.modelFile, "w") as f:
+            f.write("this is not python")
+        self.assertRaises(ManifestError, loadManifest, self.modelFile, "v1")
+        self.assertEqual(os.listdir(config.modelManifestDirectory) if os.path.exists(config.modelManifestDirectory) else [], [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.model_parameters: declarations and their (slotted) values."""
+import pickle
+import unittest
+
+from npsgd.model_parameters import *
+
+class NormalisedParameter(FloatParameter):
+    """A declaration whose setValue keeps an attribute besides value."""
+
+    def setValue(self, value):
+        FloatParameter.setValue(self, value)
+        self.fraction = self.value / self.rangeEnd
+
+class ParameterValueTest(unittest.TestCase):
+    #(declaration, value to set, value expected back)
+    cases = [
+        (SelectParameter("colour", options=["red", "green"]), "green", "green"),
+        (BooleanParameter("verbose"), 1, True),
+        (StringParameter("label", default="none"), "it's", "it's"),
+        (RangeParameter("wavelength", rangeStart=400, rangeEnd=700, default=(400, 700)), "450-500", (450.0, 500.0)),
+        (FloatParameter("thickness", rangeStart=0, rangeEnd=5, default=1), "2.5", 2.5),
+        (IntegerParameter("samples", rangeStart=1, rangeEnd=100, step=1, default=10), "42", 42)
+    ]
+
+    def testWithValue(self):
+        for declaration, value, expected in self.cases:
+            default = declaration.value
+            parameterValue = declaration.withValue(value)
+            self.assertEqual(parameterValue.value, expected)
+            self.assertEqual(parameterValue.name, declaration.name)
+            self.assertEqual(declaration.value, default)
+
+    def testDictRoundTrip(self):
+        for declaration, value, expected in self.cases:
+            d = declaration.withValue(value).asDict()
+            self.assertEqual(d, {"name": declaration.name, "value": expected})
+            self.assertEqual(declaration.fromDict(d).value, expected)
+            self.assertEqual(declaration.withValue(value).fromDict(d).value, expected)
+
+    def testValuesRenderLikeDeclarations(self):
+        for declaration, value, expected in self.cases:
+            copy = declaration.__class__.__new__(declaration.__class__)
+            copy.__dict__.update(declaration.__dict__)
+            copy.setValue(value)
+
+            parameterValue = declaration.withValue(value)
+            self.assertEqual(parameterValue.asHTML(), copy.asHTML())
+            self.assertEqual(parameterValue.asMatlabCode(), copy.asMatlabCode())
+            self.assertEqual(parameterValue.asTextRow(), copy.asTextRow())
+
+    def testPickle(self):
+        for declaration, value, expected in self.cases:
+            for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+                parameterValue = pickle.loads(pickle.dumps(declaration.withValue(value), protocol))
+                self.assertEqual(parameterValue.value, expected)
+                self.assertEqual(parameterValue.name, declaration.name)
+
+    def testValueWithWrongName(self):
+        declaration = FloatParameter("thickness", default=1)
+        self.assertRaises(ValidationError, declaration.fromDict, {"name": "width", "value": 1})
+
+    def testValidation(self):
+        declaration = RangeParameter("wavelength", rangeStart=400, rangeEnd=700)
+        self.assertRaises(ValidationError, declaration.withValue, "500-450")
+        self.assertRaises(ValidationError, declaration.withValue, "300-450")
+
+    def testExtraAttributes(self):
+        declaration = NormalisedParameter("load", rangeStart=0, rangeEnd=10, default=5)
+        parameterValue = declaration.withValue(2)
+        self.assertEqual(parameterValue.fraction, 0.2)
+        self.assertEqual(declaration.fraction, 0.5)
+
+        other = declaration.withValue(8)
+        self.assertEqual(other.fraction, 0.8)
+        self.assertEqual(parameterValue.fraction, 0.2)
+
+    def testRetainValueClasses(self):
+        declaration = NormalisedParameter("load", rangeStart=0, rangeEnd=10, default=5)
+        parameterValue = declaration.withValue(2)
+        FloatParameter("thickness").withValue(1)
+        self.assertTrue(NormalisedParameter in ParameterValue.valueClasses)
+
+        ParameterValue.retainValueClasses(set([FloatParameter]))
+        self.assertFalse(NormalisedParameter in ParameterValue.valueClasses)
+        self.assertTrue(FloatParameter in ParameterValue.valueClasses)
+
+        #Values keep working, and new ones get a fresh value class
+        self.assertEqual(parameterValue.fraction, 0.2)
+        self.assertEqual(declaration.withValue(4).fraction, 0.4)
+        self.assertTrue(NormalisedParameter in ParameterValue.valueClasses)
+
+if __name__ == "__main__":
+    unittest.main()
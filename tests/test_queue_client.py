@@ -0,0 +1,84 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.queue_client against a small keep-alive HTTP server."""
+import json
+import logging
+import urlparse
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from npsgd.queue_client import QueueClient, QueueClientError
+
+class EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers with the request's arguments and the client port it came from.
+
+    Statuses queued on the server's failures list are returned first.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def respond(self, query):
+        if len(self.server.failures) > 0:
+            body, status = "{}", self.server.failures.pop()
+        else:
+            arguments = dict((k, v[0]) for (k, v) in urlparse.parse_qs(query).iteritems())
+            body, status = json.dumps({"arguments": arguments, "port": self.client_address[1]}), 200
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        self.respond(self.rfile.read(int(self.headers["Content-Length"])))
+
+    def log_message(self, format, *args):
+        pass
+
+class EchoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class QueueClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = EchoServer(("127.0.0.1", 0), EchoHandler)
+        self.server.failures = []
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.client = QueueClient("127.0.0.1", self.server.server_address[1], "secret", 5, 2, 2,
+                backoff=0.001)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def testRequestsCarryTheSecret(self):
+        response = self.client.post("/echo", {"task_id": 4})
+        self.assertEqual(response["arguments"], {"task_id": "4", "secret": "secret"})
+        response = self.client.get("/echo", {"task_id": 5})
+        self.assertEqual(response["arguments"], {"task_id": "5", "secret": "secret"})
+
+    def testConnectionsAreReused(self):
+        ports = set(self.client.get("/echo")["port"] for i in xrange(5))
+        self.assertEqual(len(ports), 1)
+        self.assertEqual(len(self.client.idle), 1)
+
+    def testFailuresAreRetried(self):
+        self.server.failures = [500, 503]
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(self.client.get("/echo")["arguments"], {"secret": "secret"})
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def testNoRetries(self):
+        self.server.failures = [500]
+        self.assertRaises(QueueClientError, self.client.get, "/echo", retries=0)
+        self.assertEqual(self.client.get("/echo", retries=0)["arguments"], {"secret": "secret"})
+
+if __name__ == "__main__":
+    unittest.main()
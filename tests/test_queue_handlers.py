@@ -0,0 +1,219 @@
+# For distribution details, see LICENSE
+"""Tests for the worker request handlers of the queue daemon."""
+import time
+import urllib
+import logging
+import unittest
+import tornado.web
+import tornado.escape
+import tornado.ioloop
+import tornado.testing
+from datetime import timedelta
+
+import npsgd_queue
+from npsgd.config import config
+from npsgd.queue_store import QueueStore, QueueState
+from npsgd import task_queue, wire
+from tests.test_task_queue import record, taskIds, FakeClock
+
+class MemoryQueueStore(QueueStore):
+    """Store that starts out empty and keeps nothing."""
+    def load(self):
+        return QueueState()
+
+class QueueHandlerTest(tornado.testing.AsyncHTTPTestCase):
+    settings = {
+        "requestSecret":        "secret",
+        "longPollTimeout":      60,
+        "keepAliveTimeout":     60,
+        "maxJobFailures":       3,
+        "confirmSweepInterval": 60,
+        "confirmedCodeTimeout": timedelta(days=7),
+        "queueFlushInterval":   0.001,
+        "queueFlushBatchSize":  100
+    }
+
+    def setUp(self):
+        self.savedConfig = dict((name, getattr(config, name, None)) for name in self.settings)
+        for name, value in self.settings.iteritems():
+            setattr(config, name, value)
+
+        npsgd_queue.glb = npsgd_queue.QueueGlobals(MemoryQueueStore())
+        self.glb = npsgd_queue.glb
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        self.glb.confirmationSweeper.stop()
+        self.glb.store.close()
+        npsgd_queue.glb = None
+        for name, value in self.savedConfig.iteritems():
+            setattr(config, name, value)
+
+    def get_new_ioloop(self):
+        #The queue keeps its timers on the global IOLoop
+        return tornado.ioloop.IOLoop.instance()
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r"/worker_heartbeat", npsgd_queue.WorkerHeartbeat),
+            (r"/worker_work_task", npsgd_queue.WorkerTaskRequest)
+        ])
+
+    def post(self, path, **arguments):
+        """Starts a POST request; self.response() waits for it."""
+        arguments["secret"] = config.requestSecret
+        self.http_client.fetch(self.get_url(path), self.stop, method="POST",
+                body=urllib.urlencode(arguments))
+
+    def response(self):
+        response = self.wait()
+        self.assertEqual(response.code, 200)
+        return tornado.escape.json_decode(response.body)
+
+    def requestTask(self, versions=[("a", "1")], **arguments):
+        self.post("/worker_work_task", model_versions_json=tornado.escape.json_encode(versions),
+                **arguments)
+
+    def queueTask(self, task):
+        self.glb.taskQueue.putTask(task)
+        self.glb.dispatchWaitingWorkers()
+
+class WorkerTaskRequestTest(QueueHandlerTest):
+    def testQueuedTask(self):
+        self.glb.taskQueue.putTask(record(1))
+        self.requestTask()
+        self.assertEqual(self.response()["task"]["taskId"], 1)
+        self.assertTrue(self.glb.taskQueue.hasProcessingTaskById(1))
+
+    def testNoTask(self):
+        self.requestTask()
+        self.assertEqual(self.response(), {"status": "empty_queue"})
+
+        self.glb.taskQueue.putTask(record(1, modelName="b"))
+        self.requestTask()
+        self.assertEqual(self.response(), {"status": "no_version"})
+
+    def testLongPollGetsNewTask(self):
+        self.requestTask(wait=10)
+        self.io_loop.add_timeout(time.time() + 0.05, lambda: self.queueTask(record(1)))
+        self.assertEqual(self.response()["task"]["taskId"], 1)
+        self.assertEqual(self.glb.waitingWorkers, [])
+
+    def testLongPollIgnoresOtherVersions(self):
+        self.requestTask(wait=0.2)
+        self.io_loop.add_timeout(time.time() + 0.05, lambda: self.queueTask(record(1, modelName="b")))
+        self.assertEqual(self.response(), {"status": "no_version"})
+        self.assertEqual(self.glb.waitingWorkers, [])
+        self.assertFalse(self.glb.taskQueue.isEmpty())
+
+    def testMaxTasks(self):
+        for taskId in [1, 2, 3]:
+            self.glb.taskQueue.putTask(record(taskId))
+
+        self.requestTask(max_tasks=2)
+        self.assertEqual([t["taskId"] for t in self.response()["tasks"]], [1, 2])
+        self.requestTask(max_tasks=2)
+        self.assertEqual([t["taskId"] for t in self.response()["tasks"]], [3])
+
+    def testLongPollWithMaxTasks(self):
+        self.requestTask(wait=10, max_tasks=5)
+        def queueTasks():
+            self.glb.taskQueue.putTask(record(1))
+            self.queueTask(record(2))
+
+        self.io_loop.add_timeout(time.time() + 0.05, queueTasks)
+        self.assertEqual([t["taskId"] for t in self.response()["tasks"]], [1, 2])
+
+    def testWaitIsCapped(self):
+        config.longPollTimeout = 0.05
+        started = time.time()
+        self.requestTask(wait=10)
+        self.assertEqual(self.response(), {"status": "empty_queue"})
+        self.assertTrue(time.time() - started < 5)
+
+    def testTasksForAHungUpWorkerAreReleased(self):
+        self.requestTask(wait=10)
+        def hangUp():
+            #The worker is gone, but the queue has not noticed yet
+            stream = self.glb.waitingWorkers[0].request.connection.stream
+            stream.set_close_callback(None)
+            stream.close()
+            self.queueTask(record(1))
+
+        self.io_loop.add_timeout(time.time() + 0.05, hangUp)
+        self.assertEqual(self.wait().code, 599)
+        self.assertEqual(self.glb.waitingWorkers, [])
+        self.assertFalse(self.glb.taskQueue.hasProcessingTaskById(1))
+
+        task = self.glb.taskQueue.pullNextTask()
+        self.assertEqual((task.taskId, task.failureCount, task.leaseToken), (1, 0, None))
+
+    def testReleasedTasksKeepTheirPlace(self):
+        for taskId in [1, 2, 3]:
+            self.glb.taskQueue.putTask(record(taskId))
+
+        self.glb.releaseTasks(self.glb.taskQueue.leaseNextVersioned([("a", "1")], 2))
+        self.requestTask(max_tasks=3)
+        self.assertEqual([(t["taskId"], t["failureCount"]) for t in self.response()["tasks"]],
+                [(1, 0), (2, 0), (3, 0)])
+
+class WireMessageTest(QueueHandlerTest):
+    def postMessage(self, body, contentType):
+        self.http_client.fetch(self.get_url("/worker_work_task"), self.stop, method="POST",
+                body=body, headers={"Content-Type": contentType, "Accept": contentType})
+        return self.wait()
+
+    def testMessageRequest(self):
+        self.glb.taskQueue.putTask(record(1))
+        body, contentType = wire.encode({"secret": config.requestSecret, "model_versions": [["a", "1"]]}, "json")
+        response = self.postMessage(body, contentType)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(wire.decode(response.body, response.headers["Content-Type"])["task"]["taskId"], 1)
+
+    def testUnreadableMessages(self):
+        logging.disable(logging.WARNING)
+        try:
+            for contentType in ["application/json; npsgd-wire=x",
+                    "application/json; npsgd-wire=%d" % (wire.wireVersion + 1)]:
+                self.assertEqual(self.postMessage("{}", contentType).code, 415)
+            self.assertEqual(self.postMessage("{", wire.contentType("json")).code, 415)
+        finally:
+            logging.disable(logging.NOTSET)
+
+class WorkerHeartbeatTest(QueueHandlerTest):
+    def setUp(self):
+        QueueHandlerTest.setUp(self)
+        self.clock = FakeClock()
+        self.realTime, task_queue.time = task_queue.time, self.clock
+        for taskId in [1, 2]:
+            self.glb.taskQueue.putTask(record(taskId))
+        self.leased = self.glb.taskQueue.leaseNextVersioned([("a", "1")], 2)
+
+    def tearDown(self):
+        task_queue.time = self.realTime
+        QueueHandlerTest.tearDown(self)
+
+    def heartbeat(self, leases, **arguments):
+        self.post("/worker_heartbeat", leases_json=tornado.escape.json_encode(leases), **arguments)
+        return self.response()
+
+    def testRenewsEveryLease(self):
+        self.clock.now += 10
+        leases = [(task.taskId, task.leaseToken) for task in self.leased]
+        self.assertEqual(self.heartbeat(leases), {"revoked": []})
+        self.assertEqual(self.glb.taskQueue.oldestProcessingTime(), self.clock.now)
+
+    def testRevokesStaleLeases(self):
+        self.clock.now += 10
+        first = self.leased[0]
+        response = self.heartbeat([(first.taskId, first.leaseToken), (2, "stale"), (9, "unknown")])
+        self.assertEqual(response, {"revoked": [2, 9]})
+        self.assertEqual(taskIds(self.glb.taskQueue.pullProcessingTasksOlderThan(self.clock.now - 1)), [2])
+
+    def testRegistersWorkerSlots(self):
+        self.heartbeat([], worker_id="w1", slots=4)
+        self.assertEqual(self.glb.workerSlots["w1"][0], 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.queue_store: journal replay and restarts of the stores."""
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+from npsgd.queue_store import QueueState, JournalQueueStore, SqliteQueueStore
+
+def task(taskId):
+    return {"taskId": taskId, "modelName": "a", "modelVersion": "1", "failureCount": 0}
+
+class QueueStateApplyTest(unittest.TestCase):
+    journal = [
+        {"op": "create",  "code": "c1", "task": task(1)},
+        {"op": "create",  "code": "c2", "task": task(2)},
+        {"op": "create",  "code": "c3", "task": task(3)},
+        {"op": "confirm", "code": "c1", "taskId": 1, "time": 50.0},
+        {"op": "confirm", "code": "c2", "taskId": 2, "time": 60.0},
+        {"op": "lease",   "taskId": 1},
+        {"op": "fail",    "taskId": 1, "task": dict(task(1), failureCount=1)},
+        {"op": "expire",  "taskId": 2, "task": task(7)},
+        {"op": "complete", "taskId": 1},
+        {"op": "expire_codes", "codes": ["c3"]}
+    ]
+
+    def replay(self, records, state=None):
+        state = state or QueueState()
+        for record in records:
+            state.apply(record)
+        return state
+
+    def testCreateAndConfirm(self):
+        state = self.replay(self.journal[:4])
+        self.assertEqual(list(state.tasks), [1])
+        self.assertEqual(list(state.confirmations), ["c2", "c3"])
+        self.assertEqual(state.confirmedCodes, {"c1": 50.0})
+        self.assertEqual(state.idCounter, 3)
+
+    def testFailedTaskIsRequeued(self):
+        state = self.replay(self.journal[:7])
+        self.assertEqual(state.tasks[1]["failureCount"], 1)
+
+    def testExpiredTaskGetsNewId(self):
+        state = self.replay(self.journal[:8])
+        self.assertEqual(list(state.tasks), [1, 7])
+        self.assertEqual(state.idCounter, 7)
+
+    def testFullReplay(self):
+        state = self.replay(self.journal)
+        self.assertEqual(list(state.tasks), [7])
+        self.assertEqual(list(state.confirmations), [])
+        self.assertEqual(state.confirmedCodes, {"c1": 50.0, "c2": 60.0})
+
+    def testReplayOnSnapshotIsIdempotent(self):
+        #Records written while a snapshot was taken are replayed on top of it
+        for split in xrange(len(self.journal) + 1):
+            snapshot = self.replay(self.journal[:split])
+            state = self.replay(self.journal[max(0, split - 3):], snapshot)
+            self.assertEqual(state.asDict(), self.replay(self.journal).asDict())
+
+    def testConfirmWithoutTime(self):
+        state = self.replay([self.journal[0], {"op": "confirm", "code": "c1", "taskId": 1}])
+        self.assertEqual(list(state.tasks), [1])
+        self.assertEqual(state.confirmedCodes, {})
+
+    def testUnknownRecord(self):
+        logging.disable(logging.WARNING)
+        try:
+            state = self.replay([{"op": "rewind"}])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(state.asDict(), QueueState().asDict())
+
+class JournalQueueStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "queue")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testSnapshotAndJournal(self):
+        #Codes are kept oldest first, which is not the order a dict would give
+        codes = ["k%d" % i for i in xrange(9, 0, -1)]
+        state = QueueState()
+        for taskId, code in enumerate(codes):
+            state.apply({"op": "create", "code": code, "task": task(taskId)})
+
+        store = JournalQueueStore(self.path, 1000)
+        store.load()
+        store.setStateSource(lambda: state)
+        store.checkpoint()
+        store.taskConfirmed("k7", 2)
+        store.taskCreated("k0", task(9))
+        store.close()
+
+        loaded = JournalQueueStore(self.path, 1000).load()
+        self.assertEqual(list(loaded.confirmations), [c for c in codes if c != "k7"] + ["k0"])
+        self.assertEqual(list(loaded.tasks), [2])
+        self.assertEqual(loaded.idCounter, 9)
+
+class SqliteQueueStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "queue.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rowStates(self, store):
+        return dict(store.db.execute("SELECT taskId, state FROM tasks"))
+
+    def testRestartKeepsRowStates(self):
+        store = SqliteQueueStore(self.path, 3600)
+        for taskId in [1, 2, 3, 4]:
+            store.taskCreated("c%d" % taskId, task(taskId))
+            store.taskConfirmed("c%d" % taskId, taskId)
+        store.taskFollowed(3, 2)
+        store.taskLeased(1)
+        store.taskLeased(2)
+        store.taskCompleted(2)
+        store.close()
+
+        store = SqliteQueueStore(self.path, 3600)
+        loaded = store.load()
+        self.assertEqual(list(loaded.tasks), [1, 3, 4])
+        self.assertEqual(loaded.idCounter, 4)
+
+        #Leases died with the old process, everything else is as it was
+        self.assertEqual(self.rowStates(store), {1: "pending", 3: "following", 4: "pending"})
+        self.assertEqual(store.db.execute("SELECT count(*) FROM leases").fetchone()[0], 0)
+        store.close()
+
+if __name__ == "__main__":
+    unittest.main()
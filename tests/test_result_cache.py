@@ -0,0 +1,79 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.result_cache."""
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+from npsgd.result_cache import ResultCache
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.directory, "cache"), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def age(self, key, mtime):
+        os.utime(self.cache.entryPath(key), (mtime, mtime))
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def contents(self, files):
+        contents = []
+        for name, path in files:
+            with open(path, "rb") as f:
+                contents.append((name, f.read()))
+        return contents
+
+    def get(self, key):
+        destination = tempfile.mkdtemp(dir=self.directory)
+        return self.cache.get(key, destination)
+
+    def testRoundTrip(self):
+        self.cache.put("k1", [("results.pdf", self.writeFile("a", "%PDF")), ("a.csv", self.writeFile("b", "1,2"))])
+        self.assertEqual(self.contents(self.get("k1")), [("results.pdf", "%PDF"), ("a.csv", "1,2")])
+        self.assertEqual(self.get("k2"), None)
+
+    def testResultsOutliveEviction(self):
+        self.cache.put("k1", [("a.csv", self.writeFile("a", "1,2"))])
+        files = self.get("k1")
+        self.assertFalse(files[0][1].startswith(self.cache.directory))
+
+        shutil.rmtree(self.cache.entryPath("k1"))
+        self.assertEqual(self.contents(files), [("a.csv", "1,2")])
+
+    def testExistingEntryIsKept(self):
+        self.cache.put("k1", [("a.csv", self.writeFile("a", "old"))])
+        self.cache.put("k1", [("a.csv", self.writeFile("b", "new"))])
+        self.assertEqual(self.contents(self.get("k1")), [("a.csv", "old")])
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        data = self.writeFile("data", "x" * 40)
+        self.cache.put("k1", [("a", data)])
+        self.cache.put("k2", [("a", data)])
+        self.age("k1", 1000)
+        self.age("k2", 2000)
+        self.get("k1")
+
+        self.cache.put("k3", [("a", data)])
+        self.assertEqual(sorted(os.listdir(self.cache.directory)), ["k1", "k3"])
+
+    def testFailedPutLeavesNothing(self):
+        logging.disable(logging.WARNING)
+        try:
+            self.cache.put("k1", [("a.csv", os.path.join(self.directory, "missing"))])
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(self.get("k1"), None)
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.standalone_task: splitting runs into shards."""
+import unittest
+
+from npsgd.standalone_task import splitRange, splitSamples
+
+class SplitRangeTest(unittest.TestCase):
+    def assertCovers(self, ranges, start, end, step):
+        """Checks that ranges cover every point of start..end exactly once, in order."""
+        self.assertAlmostEqual(ranges[0][0], start)
+        self.assertAlmostEqual(ranges[-1][1], end)
+        for (first, last) in ranges:
+            self.assertTrue(first <= last)
+        for (prev, next) in zip(ranges, ranges[1:]):
+            self.assertAlmostEqual(next[0], prev[1] + step)
+
+    def testEvenSplit(self):
+        self.assertEqual(splitRange(0, 9, 1, 2), [(0, 4), (5, 9)])
+
+    def testUnevenSplit(self):
+        ranges = splitRange(400.0, 700.0, 5.0, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertCovers(ranges, 400.0, 700.0, 5.0)
+        sizes = [int(round((last - first) / 5.0)) + 1 for (first, last) in ranges]
+        self.assertEqual(sum(sizes), 61)
+        self.assertTrue(max(sizes) - min(sizes) <= 1)
+
+    def testFractionalStep(self):
+        ranges = splitRange(1.0, 3.0, 0.1, 3)
+        self.assertCovers(ranges, 1.0, 3.0, 0.1)
+
+    def testMoreShardsThanPoints(self):
+        self.assertEqual(splitRange(0, 2, 1, 8), [(0, 0), (1, 1), (2, 2)])
+
+    def testSinglePoint(self):
+        self.assertEqual(splitRange(5, 5, 1, 4), [(5, 5)])
+
+    def testAtLeastOneShard(self):
+        self.assertEqual(splitRange(0, 9, 1, 0), [(0, 9)])
+
+class SplitSamplesTest(unittest.TestCase):
+    def testSplits(self):
+        for numSamples in [1, 7, 100, 1001]:
+            for count in [1, 2, 3, 8]:
+                samples = splitSamples(numSamples, count)
+                self.assertEqual(sum(samples), numSamples)
+                self.assertEqual(len(samples), min(count, numSamples))
+                self.assertTrue(max(samples) - min(samples) <= 1)
+
+    def testExample(self):
+        self.assertEqual(splitSamples(10, 3), [4, 3, 3])
+
+    def testAtLeastOneShard(self):
+        self.assertEqual(splitSamples(10, 0), [10])
+
+if __name__ == "__main__":
+    unittest.main()
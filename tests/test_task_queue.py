@@ -0,0 +1,251 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.task_queue."""
+import time
+import unittest
+
+from npsgd import task_queue
+from npsgd.task_queue import TaskQueue, TaskQueueException
+from npsgd.task_record import TaskRecord
+
+def record(taskId, modelName="a", modelVersion="1", x=None):
+    """Returns a task record of the given model version.
+
+    Records with the same model version and x are identical. By default x is
+    unique to taskId, so that the record never follows another task.
+    """
+    if x == None:
+        x = "x%d" % taskId
+
+    return TaskRecord({
+        "taskId":          taskId,
+        "modelName":       modelName,
+        "modelVersion":    modelVersion,
+        "emailAddress":    "user%d@example.com" % taskId,
+        "visibleId":       "v%d" % taskId,
+        "failureCount":    0,
+        "modelParameters": {"x": {"name": "x", "value": x}}
+    })
+
+def taskIds(tasks):
+    return [task.taskId for task in tasks]
+
+class TaskQueueLaneTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = TaskQueue()
+        for taskId, modelName, modelVersion in [(1, "a", "1"), (2, "b", "1"), (3, "a", "2"),
+                (4, "a", "1"), (5, "b", "1")]:
+            self.queue.putTask(record(taskId, modelName, modelVersion))
+
+    def pullAll(self, versions):
+        pulled = []
+        task = self.queue.pullNextVersioned(versions)
+        while task != None:
+            pulled.append(task)
+            task = self.queue.pullNextVersioned(versions)
+
+        return pulled
+
+    def testArrivalOrderAcrossLanes(self):
+        versions = [("a", "1"), ("b", "1"), ("a", "2")]
+        self.assertEqual(taskIds(self.pullAll(versions)), [1, 2, 3, 4, 5])
+        self.assertTrue(self.queue.isEmpty())
+
+    def testOnlyMatchingLanes(self):
+        self.assertEqual(self.queue.pullNextVersioned([["b", "1"]]).taskId, 2)
+        self.assertEqual(self.queue.pullNextVersioned([["b", "1"]]).taskId, 5)
+        self.assertEqual(self.queue.pullNextVersioned([["b", "1"]]), None)
+        self.assertEqual(self.queue.pullNextVersioned([["c", "1"]]), None)
+        self.assertFalse(self.queue.isEmpty())
+
+    def testEmptyLanesAreDropped(self):
+        self.queue.pullNextVersioned([("a", "2")])
+        self.assertEqual(sorted(self.queue.lanes), [("a", "1"), ("b", "1")])
+
+    def testMaxTasks(self):
+        leased = self.queue.leaseNextVersioned([("a", "1"), ("a", "2")], 2)
+        self.assertEqual(taskIds(leased), [1, 3])
+        self.assertEqual(len(set(task.leaseToken for task in leased)), 2)
+        self.assertTrue(self.queue.hasProcessingTaskById(1))
+        self.assertTrue(self.queue.hasProcessingTaskById(3))
+        self.assertEqual(taskIds(self.queue.leaseNextVersioned([("a", "1"), ("a", "2")], 2)), [4])
+
+    def testPutTaskHead(self):
+        first = self.queue.pullNextTask()
+        self.queue.putTaskHead(first)
+        self.assertEqual(self.queue.pullNextTask().taskId, 1)
+        self.assertEqual(self.queue.pullNextTask().taskId, 2)
+
+    def testPullNextTaskFromEmptyQueue(self):
+        self.assertRaises(IndexError, TaskQueue().pullNextTask)
+
+    def testPullTasksNotMatching(self):
+        lost = self.queue.pullTasksNotMatching([("a", "1")])
+        self.assertEqual(sorted(taskIds(lost)), [2, 3, 5])
+        self.assertEqual(sorted(self.queue.lanes), [("a", "1")])
+
+    def testAllRequests(self):
+        self.queue.putProcessingTask(self.queue.pullNextVersioned([("a", "2")]))
+        self.assertEqual(taskIds(self.queue.allRequests()), [1, 2, 4, 5, 3])
+
+    def testProcessingTasksById(self):
+        task = self.queue.leaseNextVersioned([("a", "1")], 1)[0]
+        self.assertTrue(self.queue.hasProcessingTaskById(1))
+        self.queue.touchProcessingTaskById(1, task.leaseToken)
+        self.assertRaises(TaskQueueException, self.queue.touchProcessingTaskById, 2, task.leaseToken)
+        self.assertEqual(self.queue.pullProcessingTaskById(1, task.leaseToken).taskId, 1)
+        self.assertFalse(self.queue.hasProcessingTaskById(1))
+        self.assertRaises(TaskQueueException, self.queue.pullProcessingTaskById, 1, task.leaseToken)
+
+class FakeClock(object):
+    """Stands in for the time module, so that lease times are under the test's control."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class TaskQueueLeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.realTime, task_queue.time = task_queue.time, self.clock
+        self.queue = TaskQueue()
+        for taskId in [1, 2, 3]:
+            self.queue.putTask(record(taskId))
+
+    def tearDown(self):
+        task_queue.time = self.realTime
+
+    def lease(self):
+        return self.queue.leaseNextVersioned([("a", "1")], 1)[0]
+
+    def testOldestProcessingTime(self):
+        self.assertEqual(self.queue.oldestProcessingTime(), None)
+        self.lease()
+        self.clock.now += 10
+        self.lease()
+        self.assertEqual(self.queue.oldestProcessingTime(), 1000.0)
+
+    def testExpiryOldestFirst(self):
+        for i in xrange(3):
+            self.lease()
+            self.clock.now += 10
+
+        self.assertEqual(taskIds(self.queue.pullProcessingTasksOlderThan(1010.0)), [1, 2])
+        self.assertEqual(self.queue.oldestProcessingTime(), 1020.0)
+        self.assertEqual(self.queue.pullProcessingTasksOlderThan(1010.0), [])
+
+    def testTouchRenewsLease(self):
+        first = self.lease()
+        self.clock.now += 10
+        self.lease()
+        self.clock.now += 10
+        self.queue.touchProcessingTaskById(1, first.leaseToken)
+
+        self.assertEqual(self.queue.oldestProcessingTime(), 1010.0)
+        self.assertEqual(taskIds(self.queue.pullProcessingTasksOlderThan(1015.0)), [2])
+        self.assertTrue(self.queue.hasProcessingTaskById(1))
+
+    def testStaleLeaseToken(self):
+        first = self.lease()
+        self.assertRaises(TaskQueueException, self.queue.touchProcessingTaskById, 1, "stale")
+        self.assertRaises(TaskQueueException, self.queue.touchProcessingTaskById, 1, None)
+        self.assertRaises(TaskQueueException, self.queue.pullProcessingTaskById, 1, "stale")
+        self.assertRaises(TaskQueueException, self.queue.pullProcessingTaskById, 1, None)
+        self.assertEqual(self.queue.pullProcessingTaskById(1, first.leaseToken).taskId, 1)
+        self.assertRaises(TaskQueueException, self.queue.pullProcessingTaskById, 1, first.leaseToken)
+
+    def testFinishedTasksLeaveTheHeap(self):
+        first = self.lease()
+        self.clock.now += 10
+        self.lease()
+        self.queue.pullProcessingTaskById(1, first.leaseToken)
+
+        self.assertEqual(self.queue.oldestProcessingTime(), 1010.0)
+        self.assertEqual(taskIds(self.queue.pullProcessingTasksOlderThan(2000.0)), [2])
+        self.assertEqual(self.queue.oldestProcessingTime(), None)
+
+    def testStaleEntriesAreBounded(self):
+        task = self.lease()
+        for i in xrange(1000):
+            self.clock.now += 1
+            self.queue.touchProcessingTaskById(task.taskId, task.leaseToken)
+
+        self.assertTrue(len(self.queue.leaseHeap) <= 2 * len(self.queue.processingTasks) + 65)
+        self.assertEqual(self.queue.oldestProcessingTime(), self.clock.now)
+
+class TaskQueueCoalescingTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = TaskQueue()
+        self.leader = record(1, x="same")
+        self.assertTrue(self.queue.putTask(self.leader) is self.leader)
+
+    def lease(self):
+        return self.queue.leaseNextVersioned([("a", "1")], 1)[0]
+
+    def testIdenticalRequestFollowsPendingTask(self):
+        self.assertTrue(self.queue.putTask(record(2, x="same")) is self.leader)
+        self.assertEqual(self.leader.followers, [{"taskId": 2, "emailAddress": "user2@example.com",
+            "visibleId": "v2"}])
+        self.assertEqual(self.queue.numRequests, 1)
+
+    def testDifferentRequestsAreQueued(self):
+        for task in [record(2, x="other"), record(3, modelVersion="2", x="same")]:
+            self.assertTrue(self.queue.putTask(task) is task)
+
+        self.assertEqual(self.queue.numRequests, 3)
+        self.assertEqual(self.leader.followers, [])
+
+    def testAddFollowerDedupes(self):
+        follower = record(2, x="same")
+        follower.addFollower(record(3, x="same"))
+        follower.addFollower(self.leader)
+        self.leader.addFollower(follower)
+        self.leader.addFollower(follower)
+        self.leader.addFollower(record(3, x="same"))
+        self.assertEqual([f["taskId"] for f in self.leader.followers], [2, 3])
+
+    def testFollowersComeBackOnComplete(self):
+        self.queue.putTask(record(2, x="same"))
+        leased = self.lease()
+        self.assertTrue(self.queue.putTask(record(3, x="same")) is self.leader)
+
+        task = self.queue.pullProcessingTaskById(1, leased.leaseToken)
+        self.assertEqual([f["taskId"] for f in task.followers], [2, 3])
+
+        #Once the leader is done, identical requests are run again
+        later = record(4, x="same")
+        self.assertTrue(self.queue.putTask(later) is later)
+
+    def testFollowerTasks(self):
+        self.queue.putTask(record(2, x="same"))
+        self.queue.putTask(record(3, x="same"))
+        followers = self.leader.followerTasks()
+
+        self.assertEqual([(t.taskId, t.emailAddress, t.visibleId) for t in followers],
+                [(2, "user2@example.com", "v2"), (3, "user3@example.com", "v3")])
+        for follower in followers:
+            self.assertEqual(follower.resultKey(), self.leader.resultKey())
+            self.assertEqual(follower.followers, [])
+
+    def testFailedLeaderKeepsFollowers(self):
+        self.queue.putTask(record(2, x="same"))
+        leased = self.lease()
+        failed = self.queue.pullProcessingTaskById(1, leased.leaseToken)
+        failed.failureCount += 1
+
+        self.assertTrue(self.queue.putTask(failed) is failed)
+        self.assertTrue(self.queue.putTask(record(3, x="same")) is failed)
+        self.assertEqual([f["taskId"] for f in failed.followers], [2, 3])
+
+    def testExpiredLeaderKeepsFollowers(self):
+        self.queue.putTask(record(2, x="same"))
+        self.lease()
+        expired = self.queue.pullProcessingTasksOlderThan(time.time() + 1)
+
+        self.assertEqual(expired, [self.leader])
+        self.assertEqual([f["taskId"] for f in self.leader.followers], [2])
+        later = record(3, x="same")
+        self.assertTrue(self.queue.putTask(later) is later)
+
+if __name__ == "__main__":
+    unittest.main()
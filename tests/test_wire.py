@@ -0,0 +1,87 @@
+# For distribution details, see LICENSE
+"""Tests for npsgd.wire: the message codec between the daemons."""
+import json
+import urlparse
+import unittest
+
+from npsgd import wire
+from npsgd.config import config
+
+message = {
+    "secret":         u"s3cret",
+    "model_versions": [[u"example", u"abc123"]],
+    "leases":         [[4, u"token"]],
+    "task":           {u"taskId": 4, u"emailAddress": u"r\xe9sum\xe9@example.com"},
+    "wait":           60
+}
+
+class WireTest(unittest.TestCase):
+    def setUp(self):
+        self.wireFormat = getattr(config, "queueWireFormat", None)
+
+    def tearDown(self):
+        config.queueWireFormat = self.wireFormat
+
+    def testJsonRoundTrip(self):
+        body, contentType = wire.encode(message, "json")
+        self.assertEqual(contentType, "application/json; npsgd-wire=%d" % wire.wireVersion)
+        self.assertEqual(wire.decode(body, contentType), message)
+
+    @unittest.skipIf(wire.msgpack == None, "msgpack 0.5.2 or later is not installed")
+    def testMsgpackRoundTrip(self):
+        body, contentType = wire.encode(message, "msgpack")
+        self.assertEqual(wire.parseContentType(contentType), ("msgpack", wire.wireVersion))
+        decoded = wire.decode(body, contentType)
+        self.assertEqual(decoded, message)
+        self.assertTrue(isinstance(decoded["secret"], unicode))
+
+    def testParseContentType(self):
+        self.assertEqual(wire.parseContentType("application/json"), ("json", None))
+        self.assertEqual(wire.parseContentType("Application/JSON; npsgd-wire=1"), ("json", 1))
+        self.assertEqual(wire.parseContentType("application/x-www-form-urlencoded"), (None, None))
+        self.assertEqual(wire.parseContentType(None), (None, None))
+        self.assertRaises(wire.WireError, wire.parseContentType, "application/json; npsgd-wire=x")
+
+    def testUnreadableMessages(self):
+        self.assertRaises(wire.WireError, wire.decode, "a=b", "application/x-www-form-urlencoded")
+        self.assertRaises(wire.WireError, wire.decode, "{", "application/json; npsgd-wire=1")
+        self.assertRaises(wire.WireError, wire.decode, "{}",
+                "application/json; npsgd-wire=%d" % (wire.wireVersion + 1))
+
+    def testAcceptedFormat(self):
+        self.assertEqual(wire.acceptedFormat(None), None)
+        self.assertEqual(wire.acceptedFormat("text/html"), None)
+        self.assertEqual(wire.acceptedFormat("application/json; npsgd-wire=1"), "json")
+        if wire.msgpack != None:
+            self.assertEqual(wire.acceptedFormat("application/x-msgpack; npsgd-wire=1"), "msgpack")
+
+    def testFormRequest(self):
+        body, headers = wire.encodeRequest(message, None)
+        self.assertEqual(headers["Content-Type"], "application/x-www-form-urlencoded")
+        arguments = dict(urlparse.parse_qsl(body))
+        self.assertEqual(arguments["wait"], "60")
+        self.assertEqual(json.loads(arguments["leases_json"]), message["leases"])
+        self.assertEqual(json.loads(arguments["task_json"]), message["task"])
+
+    def testMessageRequest(self):
+        body, headers = wire.encodeRequest(message, "json")
+        self.assertEqual(headers["Accept"], headers["Content-Type"])
+        self.assertEqual(wire.decode(body, headers["Content-Type"]), message)
+
+    def testDecodeResponse(self):
+        self.assertEqual(wire.decodeResponse('{"response": "okay"}', "text/html; charset=UTF-8"),
+                {"response": "okay"})
+        body, contentType = wire.encode({"response": "yes"}, "json")
+        self.assertEqual(wire.decodeResponse(body, contentType), {"response": "yes"})
+        self.assertRaises(wire.WireError, wire.decodeResponse, "<html>", "text/html")
+
+    def testRequestFormat(self):
+        config.queueWireFormat = "form"
+        self.assertEqual(wire.requestFormat(), None)
+        config.queueWireFormat = "json"
+        self.assertEqual(wire.requestFormat(), "json")
+        config.queueWireFormat = "auto"
+        self.assertEqual(wire.requestFormat(), "json" if wire.msgpack == None else "msgpack")
+
+if __name__ == "__main__":
+    unittest.main()